@@ -14,56 +14,91 @@ Comparing to the previous code that works on the SSF dataset, this version is si
 import numpy as np
 import os
 import sys
+import contextlib
 import h5pyd as h5py
 import s3fs
 import xarray as xr
-from Climate_Marble_common_functions import latslons_to_idxs, get_descending
+from Climate_Marble_common_functions import latslons_to_idxs, get_output_nc_name, get_bf_name, expand_configs, OrbitContext
+from Climate_Marble_time_functions import jd_window_mask
+from Climate_Marble_io_functions import PrefetchPipeline
+from Climate_Marble_output_functions import grid_dataset
 
 
+def read_ceres_granule(h5f, igranule, julian_bound):
+    """
+    Read the CERES footprints of a granule that fall within the julian time bound.
 
-def main_bf_CERES(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, MODE='ct'):
+    Only the observation time is read for a granule without footprint in the time bound.
+    
+    Args:
+        h5f (hdf5 instance) : instance of a basic fusion file
+        igranule (str)      : CERES granule
+        julian_bound (array): julian time of the first/last descending MODIS granule
+    
+    Returns:
+        None if no footprint is in the time bound, otherwise
+        idx_0 (array)                                              : footprints in the time bound
+        ssf_sw, ssf_mode, ssf_lw, ssf_sza, ssf_vza, ssf_lat, ssf_lon: radiances, mode flags, geometry and geolocation of the granule
+    """
+    # USE time of FOV to select CERES samples
+    ssf_time = h5f['CERES/{}/FM1/Time_and_Position/Time_of_observation'.format(igranule)][:]
+    idx_0 = np.where(jd_window_mask(ssf_time, julian_bound))[0]
+    if len(idx_0) == 0:
+        return None
+
+    ssf_sw   = h5f['CERES/{}/FM1/Radiances/SW_Radiance'.format(igranule)][:]
+    ssf_mode = h5f['CERES/{}/FM1/Radiances/Radiance_Mode_Flags'.format(igranule)][:]
+    ssf_lw   = h5f['CERES/{}/FM1/Radiances/LW_Radiance'.format(igranule)][:]
+    ssf_sza  = h5f['CERES/{}/FM1/Viewing_Angles/Solar_Zenith'.format(igranule)][:]
+    ssf_vza  = h5f['CERES/{}/FM1/Viewing_Angles/Viewing_Zenith'.format(igranule)][:]
+    ssf_lat  = h5f['CERES/{}/FM1/Time_and_Position/Latitude'.format(igranule)][:]
+    ssf_lon  = h5f['CERES/{}/FM1/Time_and_Position/Longitude'.format(igranule)][:]
+    return idx_0, ssf_sw, ssf_mode, ssf_lw, ssf_sza, ssf_vza, ssf_lat, ssf_lon
+
+
+def main_bf_CERES(h5f, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, MODE='ct', orbit=None, PREFETCH_DEPTH=1):
     """
     (This script is adapted for running on AWS cloud)
     
-    The CERES gridded file for each orbit will be generated directly from the basic fusion data files.
+    The CERES gridded results for each orbit will be generated directly from the basic fusion data files,
+    and saved together with the other instruments by main_bf_orbit.
 
     Args:
-        bf_file (str): BF file path
-        output_folder (str): folder storing the gridded results
+        h5f (hdf5 instance): instance of a basic fusion file
         SPATIAL_RESOLUTION (float, optional): spatial resolution of the grid (in degree)
-        VZA_MAX (int, optional): maximum viewing zenith angle considered (in degree)
-        MODE (str, optional): category of CERES scan mode ('ct', 'all')
+        VZA_MAX (int or list, optional): maximum viewing zenith angle considered (in degree)
+        MODE (str or list, optional): category of CERES scan mode ('ct', 'all')
+        orbit (OrbitContext, optional): descending-node analysis of h5f (computed here if not given)
+        PREFETCH_DEPTH (int, optional): number of granules read ahead while the current one is gridded
+
+        VZA_MAX and/or MODE can be lists (one value per configuration, see expand_configs),
+        all configurations are gridded from the same read of the granules.
     
     Returns:
-        there is no return value for this function
+        orbit_ds (xarray Dataset): gridded CERES radiances of the orbit (None if no footprint is available);
+                                   a list of them (one per configuration) when VZA_MAX or MODE is a list
     """
 
     # =============================================================================
     # 1. Initialization
     #    calculate constant parameters
-    #    initialize output arrays and output hdf5 file
+    #    initialize output arrays
     #    check the number of CERES granules 
     # =============================================================================
     print("---->", type(h5f))
-    if type(h5f.fid) is str:
-        output_nc_name = h5f.fid.split('/')[-1].replace('TERRA_BF_L1B', 'CLIMARBLE')
-    else:
-        output_nc_name = h5f.fid.name. \
-            decode("utf-8").split('/')[-1]. \
-            replace('TERRA_BF_L1B', 'CLIMARBLE')
-
-    output_nc_name = output_nc_name.replace('.h5', '.nc')
+    output_nc_name = get_output_nc_name(h5f)
+    configs, MULTI = expand_configs(VZA_MAX=VZA_MAX, MODE=MODE)
+    NUM_CONFIGS = len(configs)
 
     # 
     NUM_POINTS = 1 / SPATIAL_RESOLUTION
     NUM_LATS = int(180 / SPATIAL_RESOLUTION)
     NUM_LONS = int(360 / SPATIAL_RESOLUTION)
     
-    # 
-    orbit_sw_sum  = np.zeros((NUM_LATS, NUM_LONS))
-    orbit_sw_num  = np.zeros((NUM_LATS, NUM_LONS), dtype='int16')
-    orbit_lw_sum  = np.zeros((NUM_LATS, NUM_LONS))
-    orbit_nc_out = os.path.join(output_folder, output_nc_name)
+    # one set of arrays per configuration (VZA_MAX and MODE)
+    orbit_sw_sum  = [np.zeros((NUM_LATS, NUM_LONS)) for config in configs]
+    orbit_sw_num  = [np.zeros((NUM_LATS, NUM_LONS), dtype='int16') for config in configs]
+    orbit_lw_sum  = [np.zeros((NUM_LATS, NUM_LONS)) for config in configs]
 
 
     # =============================================================================
@@ -73,83 +108,96 @@ def main_bf_CERES(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, MODE='
     # =============================================================================
 
     # USE MODIS granules to match first and last time of the descending node
-    t0, t1 = get_descending(h5f, 'CERES')
-    if t0 == 0:
-        print(">> IOError, no available MODIS granule in orbit {}".format(h5f.fid))
-        return
+    if orbit is None:
+        orbit = OrbitContext(h5f)
+    if orbit.julian_bound is None:
+        print(">> IOError, no available MODIS granule in orbit {}".format(get_bf_name(h5f)))
+        return [None] * NUM_CONFIGS if MULTI else None
 
     # GET CERES granules
     CERES_granules = [item[0] for item in h5f['CERES'].items()]
     if len(CERES_granules) == 0:
-        print(">> IOError, no available CERES granule in orbit {}".format(h5f.fid))
-        return
+        print(">> IOError, no available CERES granule in orbit {}".format(get_bf_name(h5f)))
+        return [None] * NUM_CONFIGS if MULTI else None
 
     # LOOP through each CERES granule
-    for igranule in CERES_granules:
-        # USE time of FOV to select CERES samples
-        ssf_time = h5f['CERES/{}/FM1/Time_and_Position/Time_of_observation'.format(igranule)][:]
-        idx_0 = np.where((ssf_time>=t0)&(ssf_time<=t1))[0]
-        if len(idx_0) == 0:
-            continue
-        else:
-            # USE sw_flx, vza, sza, and mode_flg to select required CERES samples   
-            # (edited on Oct. 15, 2019)
-            # these citeria may not be enough, as there are extremely large values in LW radiances in all modes (but not in cross-track mode).
-            # as a result, for all-modes, two additional criteria '0<lw<1000' were added.
-            ssf_sw   = h5f['CERES/{}/FM1/Radiances/SW_Radiance'.format(igranule)][:]
-            ssf_mode = h5f['CERES/{}/FM1/Radiances/Radiance_Mode_Flags'.format(igranule)][:]
-            ssf_lw   = h5f['CERES/{}/FM1/Radiances/LW_Radiance'.format(igranule)][:]
-            ssf_sza  = h5f['CERES/{}/FM1/Viewing_Angles/Solar_Zenith'.format(igranule)][:]
-            ssf_vza  = h5f['CERES/{}/FM1/Viewing_Angles/Viewing_Zenith'.format(igranule)][:]
-
-            if MODE == 'ct':
-                idx_1 = np.where((ssf_sw>0)&(ssf_sw<1000)&(ssf_vza<VZA_MAX)&(ssf_sza<=89.0)&(ssf_mode==0))[0] # cross-track mode only
+    # flat lat/lon cell indexes and radiances of the selected footprints are collected by granule (and configuration)
+    orbit_cells = [[] for config in configs]
+    orbit_sw = [[] for config in configs]
+    orbit_lw = [[] for config in configs]
+    # the next granules are read while the current one is gridded
+    pipeline = PrefetchPipeline(lambda igranule: read_ceres_granule(h5f, igranule, orbit.julian_bound), CERES_granules, PREFETCH_DEPTH)
+    # leaving the block (even on an error) closes the granule iterator (pending reads are cancelled)
+    with contextlib.closing(iter(pipeline)) as granules:
+        for igranule, granule in granules:
+            ssf = granule.result()
+            if ssf is None:
+                continue
             else:
-                idx_1 = np.where((ssf_sw>0)&(ssf_sw<1000)&(ssf_vza<VZA_MAX)&(ssf_sza<=89.0)&(ssf_lw<1000)&(ssf_lw>0))[0] # all modes (check longwave radiances as well (Arp. 23, 2019))
-
-            ## INTERSECT idx_0 and idx_1, and use these indexes to select requried samples
-            ## (edited on July 24, 2019)
-            ## sol should be "TOA Incoming Solar Radiation" but mistakely used "CERES solar zenith at surface" in the processing.
-            idx = np.intersect1d(idx_0, idx_1)
-            lats = h5f['CERES/{}/FM1/Time_and_Position/Latitude'.format(igranule)][:][idx]
-            lons = h5f['CERES/{}/FM1/Time_and_Position/Longitude'.format(igranule)][:][idx]
-            sw = ssf_sw[idx]
-            lw = ssf_lw[idx]
-
-            # Calculate lat/lon indexes of all sample. 
-            # (2018.05.29) Explicitly convert these indexes to integer
-            lats_idx, lons_idx = latslons_to_idxs(lats, lons, NUM_POINTS)
-
-            # BIN data
-            for i, j, isw, ilw in zip(lats_idx, lons_idx, sw, lw):
-                orbit_sw_sum[i, j] += isw
-                orbit_lw_sum[i, j] += ilw
-                orbit_sw_num[i, j] += 1
-
-    # =============================================================================
-    # 3. Save results
-    # =============================================================================
-    coords_lats = np.linspace(90-SPATIAL_RESOLUTION/2, -90+SPATIAL_RESOLUTION/2, NUM_LATS)
-    coords_lons = np.linspace(-180+SPATIAL_RESOLUTION/2, 180-SPATIAL_RESOLUTION/2, NUM_LONS)
-
-    xr_sw_sum = xr.DataArray(orbit_sw_sum, coords=[('latitude', coords_lats), ('longitude', coords_lons)])
-    xr_lw_sum = xr.DataArray(orbit_lw_sum, coords=[('latitude', coords_lats), ('longitude', coords_lons)])
-    xr_sw_num = xr.DataArray(orbit_sw_num, coords=[('latitude', coords_lats), ('longitude', coords_lons)])
-    xr_sw_sum.encoding['_FillValue'] = 0
-    xr_lw_sum.encoding['_FillValue'] = 0
-    xr_sw_num.encoding['_FillValue'] = 0
-    xr_sw_sum.name = 'CERES SW rad sum'
-    xr_lw_sum.name = 'CERES LW rad sum'
-    xr_sw_num.name = 'CERES SW rad num'
-    xr_sw_sum.to_netcdf(orbit_nc_out, 'a')
-    xr_lw_sum.to_netcdf(orbit_nc_out, 'a')
-    xr_sw_num.to_netcdf(orbit_nc_out, 'a')
-    return orbit_nc_out
+                # USE sw_flx, vza, sza, and mode_flg to select required CERES samples   
+                # (edited on Oct. 15, 2019)
+                # these citeria may not be enough, as there are extremely large values in LW radiances in all modes (but not in cross-track mode).
+                # as a result, for all-modes, two additional criteria '0<lw<1000' were added.
+                idx_0, ssf_sw, ssf_mode, ssf_lw, ssf_sza, ssf_vza, ssf_lat, ssf_lon = ssf
+
+                # footprints in the time bound, the masks of the configurations are evaluated on them
+                sw = ssf_sw[idx_0]
+                lw = ssf_lw[idx_0]
+                sza = ssf_sza[idx_0]
+                vza = ssf_vza[idx_0]
+                mode = ssf_mode[idx_0]
+
+                # Calculate lat/lon indexes of all sample. 
+                # (2018.05.29) Explicitly convert these indexes to integer
+                lats = ssf_lat[idx_0]
+                lons = ssf_lon[idx_0]
+                lats_idx, lons_idx = latslons_to_idxs(lats, lons, NUM_POINTS)
+                # lon = -180 is the meridian of lon = 180 and is binned into the last column (as the original loop did)
+                lons_idx[lons_idx==-1] = NUM_LONS - 1
+
+                # lat > -999 and lon > -999 and 0 <= lat/lon indexes < NUM_LATS/NUM_LONS (as for MODIS),
+                # the footprints out of the grid (lat = 90 or -90) are rejected instead of being wrapped
+                valid = (lats>-999)&(lons>-999)&(lats_idx>=0)&(lats_idx<NUM_LATS)&(lons_idx>=0)&(lons_idx<NUM_LONS)
+                cells = np.zeros(len(lats_idx), dtype='int64')
+                cells[valid] = np.ravel_multi_index((lats_idx[valid], lons_idx[valid]), (NUM_LATS, NUM_LONS))
+
+                for iconfig, config in enumerate(configs):
+                    if config['MODE'] == 'ct':
+                        mask = (sw>0)&(sw<1000)&(vza<config['VZA_MAX'])&(sza<=89.0)&(mode==0) # cross-track mode only
+                    else:
+                        mask = (sw>0)&(sw<1000)&(vza<config['VZA_MAX'])&(sza<=89.0)&(lw<1000)&(lw>0) # all modes (check longwave radiances as well (Arp. 23, 2019))
+                    mask &= valid
+
+                    ## INTERSECT the time bound (idx_0) and the mask to select requried samples
+                    ## (edited on July 24, 2019)
+                    ## sol should be "TOA Incoming Solar Radiation" but mistakely used "CERES solar zenith at surface" in the processing.
+                    orbit_cells[iconfig].append(cells[mask])
+                    orbit_sw[iconfig].append(sw[mask])
+                    orbit_lw[iconfig].append(lw[mask])
+    print(">> Prefetch( CERES {} )".format(pipeline))
+
+    # BIN data
+    # all footprints are accumulated in one pass and in the granule order,
+    # so the sums are identical to adding them one by one
+    orbit_ds = []
+    for iconfig in range(NUM_CONFIGS):
+        if len(orbit_cells[iconfig]) > 0:
+            cells = np.concatenate(orbit_cells[iconfig])
+            orbit_sw_sum[iconfig] = np.bincount(cells, weights=np.concatenate(orbit_sw[iconfig]), minlength=NUM_LATS*NUM_LONS).reshape(NUM_LATS, NUM_LONS)
+            orbit_lw_sum[iconfig] = np.bincount(cells, weights=np.concatenate(orbit_lw[iconfig]), minlength=NUM_LATS*NUM_LONS).reshape(NUM_LATS, NUM_LONS)
+            orbit_sw_num[iconfig] = np.bincount(cells, minlength=NUM_LATS*NUM_LONS).reshape(NUM_LATS, NUM_LONS).astype('int16')
+
+        # =============================================================================
+        # 3. Gather results
+        # =============================================================================
+        orbit_ds.append(grid_dataset({'CERES SW rad sum': orbit_sw_sum[iconfig], 'CERES LW rad sum': orbit_lw_sum[iconfig], \
+                                      'CERES SW rad num': orbit_sw_num[iconfig]}, SPATIAL_RESOLUTION))
+    return orbit_ds if MULTI else orbit_ds[0]
 
 
 if __name__ == "__main__":
     bf_file = sys.argv[1]
-    main_bf_CERES(bf_file, '')
+    main_bf_CERES(h5py.File(bf_file, 'r'))
 
 
 
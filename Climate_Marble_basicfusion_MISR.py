@@ -14,50 +14,226 @@ import sys
 import h5pyd as h5py
 import s3fs
 import xarray as xr
-from Climate_Marble_common_functions import get_descending
-from skimage.transform import resize
-from scipy.stats import binned_statistic_dd
+from Climate_Marble_common_functions import get_output_nc_name, get_bf_name, expand_configs, OrbitContext
+from Climate_Marble_output_functions import grid_dataset
+
+
+MISR_BANDS = ['Blue', 'Green', 'Red', 'NIR']
+
+
+class BlockResizer(object):
+    """
+    Bilinear upsampling of MISR sun-view geometry blocks (e.g., 8 x 32) to the radiance block shape (e.g., 128 x 512).
+
+    It gives the same results as skimage.transform.resize(block, output_shape) with the defaults of scikit-image 0.16:
+    pixel centers are aligned, neighbours outside the block are mirrored (mode='reflect'),
+    and the output is clipped to the range of the input block (clip=True), which turns a block containing any NaN into NaN.
+    The neighbour indexes and weights only depend on the shapes, so they are computed once and applied to all blocks at once.
+    
+    Args:
+        input_shape (tuple) : shape of a geometry block
+        output_shape (tuple): shape of the upsampled block
+    """
+
+    def __init__(self, input_shape, output_shape):
+        self.rows = self.axis_weights(input_shape[0], output_shape[0])
+        self.cols = self.axis_weights(input_shape[1], output_shape[1])
+
+    @staticmethod
+    def axis_weights(input_len, output_len):
+        """
+        Return the lower/upper neighbour indexes and the weight of the upper neighbour along one axis.
+        """
+        coords = input_len / output_len * (np.arange(output_len) + 0.5) - 0.5
+        idx_lower = np.floor(coords).astype('int64')
+        idx_upper = np.ceil(coords).astype('int64')
+        weights = coords - idx_lower
+
+        # mirror the neighbours outside [0, input_len-1]
+        idxs = []
+        for idx in (idx_lower, idx_upper):
+            if input_len == 1:
+                idx = np.zeros_like(idx)
+            else:
+                period = 2 * (input_len - 1)
+                idx = np.abs(idx) % period
+                idx = np.where(idx > input_len-1, period - idx, idx)
+            idxs.append(idx)
+        return idxs[0], idxs[1], weights
+
+    def __call__(self, blocks):
+        """
+        Upsample a stack of blocks.
+        
+        Args:
+            blocks (array): geometry blocks (number of blocks x input_shape)
+        
+        Returns:
+            out (array): upsampled blocks (number of blocks x output_shape)
+        """
+        blocks = np.asarray(blocks, dtype='float64')
+        row_lower, row_upper, dr = self.rows
+        col_lower, col_upper, dc = self.cols
+        dr = dr[:, None]
+
+        top = (1 - dc) * blocks[:, row_lower[:, None], col_lower] + dc * blocks[:, row_lower[:, None], col_upper]
+        bottom = (1 - dc) * blocks[:, row_upper[:, None], col_lower] + dc * blocks[:, row_upper[:, None], col_upper]
+        out = (1 - dr) * top + dr * bottom
+
+        # clip to the range of each block (NaN if the block contains NaN)
+        np.clip(out, blocks.min(axis=(1, 2))[:, None, None], blocks.max(axis=(1, 2))[:, None, None], out=out)
+        return out
+
+
+def aggregate_misr_275m(rads, out=None, buffers=None):
+    """
+    Aggregate 275-m MISR radiance blocks to 1.1-km by averaging every 4 x 4 samples.
+
+    Negative (fill) and NaN samples are ignored, and a 4 x 4 box without valid sample gives NaN,
+    the same as np.nanmean after replacing negative values with NaN. All blocks are reduced at once in float32.
+    
+    Args:
+        rads (array)             : 275-m radiances (number of blocks x 512 x 2048)
+        out (array, optional)    : float32 array for the 1.1-km radiances (number of blocks x 128 x 512)
+        buffers (dict, optional) : work buffers, allocated on the first call and reused by later calls of the same shape
+    
+    Returns:
+        out (array): 1.1-km radiances
+    """
+    if buffers is None:
+        buffers = {}
+    if buffers.get('shape') != rads.shape:
+        buffers['shape'] = rads.shape
+        buffers['rads'] = np.empty(rads.shape, dtype='float32')
+        buffers['valid'] = np.empty(rads.shape, dtype='bool')
+
+    num_blocks, num_rows, num_cols = rads.shape
+    box_shape = (num_blocks, num_rows//4, 4, num_cols//4, 4)
+    if out is None:
+        out = np.empty((num_blocks, num_rows//4, num_cols//4), dtype='float32')
+
+    valid = buffers['valid']
+    np.greater_equal(rads, 0, out=valid)
+    work = buffers['rads']
+    work.fill(0)
+    np.copyto(work, rads, where=valid, casting='same_kind')
+
+    np.sum(work.reshape(box_shape), axis=(2, 4), out=out)
+    cnt = np.sum(valid.reshape(box_shape), axis=(2, 4))
+    np.divide(out, cnt, out=out, where=cnt>0)
+    out[cnt==0] = np.nan
+    return out
+
+
+def misr_latslons_to_cells(lats, lons, LAT_EDGES, LON_EDGES):
+    """
+    Determine the flat lat/lon cell indexes of MISR samples.
+
+    Samples are binned as binned_statistic_dd((-lats, lons), bins=[LAT_EDGES, LON_EDGES]) does,
+    i.e. right-open bins except the last one, which also takes samples on the rightmost edge.
+    
+    Args:
+        lats (array)     : latitude of the samples
+        lons (array)     : longitude of the samples
+        LAT_EDGES (array): bin edges of the (negative) latitude
+        LON_EDGES (array): bin edges of the longitude
+    
+    Returns:
+        cells (array): flat indexes in the (NUM_LATS, NUM_LONS) grid, -1 for samples outside the grid
+    """
+    idxs = []
+    for coords, edges in ((lats * -1, LAT_EDGES), (lons, LON_EDGES)):
+        idx = np.digitize(coords, edges) - 1
+        decimal = int(-np.log10(np.diff(edges).min())) + 6
+        on_edge = (coords >= edges[-1]) & (np.around(coords, decimal) == np.around(edges[-1], decimal))
+        idx[on_edge] -= 1
+        idxs.append(idx)
+
+    NUM_LATS = len(LAT_EDGES) - 1
+    NUM_LONS = len(LON_EDGES) - 1
+    valid = (idxs[0]>=0) & (idxs[0]<NUM_LATS) & (idxs[1]>=0) & (idxs[1]<NUM_LONS)
+    cells = np.where(valid, idxs[0]*NUM_LONS + idxs[1], -1)
+    return cells
+
+
+def read_misr_blocks(h5f, MISR_blocks, CAMERA='AN'):
+    """
+    Read lat/lon, spectral radiances, SZA and VZA of the given MISR blocks.
+
+    Each dataset is read with one hyperslab request covering the first to the last given block,
+    instead of loading the whole orbit (or one request per block).
+    
+    Args:
+        h5f (hdf5 instance)   : instance of a basic fusion file
+        MISR_blocks (array)   : MISR blocks to read (starts from 0, increasing)
+        CAMERA (str, optional): MISR camera
+    
+    Returns:
+        lat, lon (array)  : lat/lon of the blocks
+        rads_all (list)   : Blue, Green, Red and NIR radiances of the blocks
+        raw_sza (array)   : solar zenith angle of the blocks
+        raw_vza (array)   : camera zenith angle of the blocks
+    """
+    blk_start = MISR_blocks[0]
+    blk_end = MISR_blocks[-1] + 1
+    blk_select = np.asarray(MISR_blocks) - blk_start
+
+    def read_slab(data_path):
+        slab = h5f[data_path][blk_start:blk_end]
+        if len(blk_select) < blk_end - blk_start:
+            slab = slab[blk_select]
+        return slab
+
+    lat = read_slab('MISR/Geolocation/GeoLatitude')
+    lon = read_slab('MISR/Geolocation/GeoLongitude')
+
+    rads_all = []
+    for iband in MISR_BANDS:
+        rads_all.append(read_slab('MISR/{}/Data_Fields/{}_Radiance'.format(CAMERA, iband)))
+
+    raw_sza = read_slab('MISR/Solar_Geometry/SolarZenith')
+    raw_vza = read_slab('MISR/{}/Sensor_Geometry/{}Zenith'.format(CAMERA, ''.join(c.lower() if i==1 else c for i,c in enumerate(CAMERA))))
+    return lat, lon, rads_all, raw_sza, raw_vza
 
 
 # if __name__ == "__main__":
 #     bf_file = sys.argv[1]
-#     SPATIAL_RESOLUTION=0.5; VZA_MAX=18; CAMERA='AN'; output_folder=''
+#     SPATIAL_RESOLUTION=0.5; VZA_MAX=18; CAMERA='AN'
 
-def main_bf_MISR(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CAMERA='AN'):
+def main_bf_MISR(h5f, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CAMERA='AN', orbit=None):
     """
     (This script is adapted for running on AWS cloud)
     
-    The MISR gridded file for each orbit will be generated directly from the basic fusion data files.
+    The MISR gridded results for each orbit will be generated directly from the basic fusion data files,
+    and saved together with the other instruments by main_bf_orbit.
     
     Args:
-        bf_file (str)                       : BF file path
-        output_folder (str)                 : folder storing the gridded results
+        h5f (hdf5 instance)                 : instance of a basic fusion file
         SPATIAL_RESOLUTION (float, optional): spatial resolution of the grid (in degree)
-        VZA_MAX (int, optional)             : maximum viewing zenith angle considered (in degree)
+        VZA_MAX (int or list, optional)     : maximum viewing zenith angle considered (in degree),
+                                              or a list of thresholds gridded from the same read of the blocks
         CAMERA (str, optional)              : MISR camera
+        orbit (OrbitContext, optional)      : descending-node analysis of h5f (computed here if not given)
     
     Returns:
-        there is no return value for this function
+        orbit_ds (xarray Dataset): gridded MISR radiances of the orbit (None if no block is available);
+                                   a list of them (one per threshold) when VZA_MAX is a list
     """
 
     # =============================================================================
     # 1. Initialization
     #    calculate constant parameters
-    #    initialize output arrays and output hdf5 file
+    #    initialize output arrays
     #    check the number of CERES granules 
     # =============================================================================
 
     print("-------MISR----->", h5f)
-    print("-------FID------<>", h5f.fid)
+    print("-------FID------<>", get_bf_name(h5f))
     print("---->", type(h5f))
-    if type(h5f.fid) is str:
-        output_nc_name = h5f.fid.split('/')[-1].replace('TERRA_BF_L1B', 'CLIMARBLE')
-    else:
-        output_nc_name = h5f.fid.name. \
-            decode("utf-8").split('/')[-1]. \
-            replace('TERRA_BF_L1B', 'CLIMARBLE')
-
-    output_nc_name = output_nc_name.replace('.h5', '.nc')
+    output_nc_name = get_output_nc_name(h5f)
+    configs, MULTI = expand_configs(VZA_MAX=VZA_MAX)
+    NUM_CONFIGS = len(configs)
+    VZA_MAX_ALL = max(config['VZA_MAX'] for config in configs)
 
     # 
     NUM_POINTS = 1 / SPATIAL_RESOLUTION
@@ -67,10 +243,9 @@ def main_bf_MISR(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CAMERA=
     LAT_EDGES = np.arange(-90.0, 90.0001, SPATIAL_RESOLUTION)
     LON_EDGES = np.arange(-180.0, 180.0001, SPATIAL_RESOLUTION)
 
-    # 
-    orbit_radiance_sum  = np.zeros((NUM_LATS, NUM_LONS, 4))
-    orbit_radiance_num  = np.zeros((NUM_LATS, NUM_LONS, 4))
-    orbit_nc_out = os.path.join(output_folder, output_nc_name)
+    # one set of arrays per configuration (VZA_MAX threshold)
+    orbit_radiance_sum  = [np.zeros((NUM_LATS, NUM_LONS, 4)) for config in configs]
+    orbit_radiance_num  = [np.zeros((NUM_LATS, NUM_LONS, 4)) for config in configs]
 
 
     # =============================================================================
@@ -80,96 +255,85 @@ def main_bf_MISR(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CAMERA=
     # =============================================================================
 
     # USE MODIS granules to match first and last time of the descending node
-    MISR_blocks = get_descending(h5f, 'MISR.{}'.format(CAMERA))
-    if MISR_blocks[0] == 0:
-        print(">> IOError( no available MODIS granule in orbit {} )".format(bf_file))
-        return
-
-    # LOAD lat/lon here
-    lat = h5f['MISR/Geolocation/GeoLatitude'][:]
-    lon = h5f['MISR/Geolocation/GeoLongitude'][:]
-
-    # LOAD radiance here
-    MISR_bands = ['Blue', 'Green', 'Red', 'NIR']
-    rads_all = []
-    for iband in MISR_bands:
-        rads_all.append(h5f['MISR/{}/Data_Fields/{}_Radiance'.format(CAMERA, iband)][:])
-
-    # SPECIFY data dimension to interpolate SZA/VZA
+    if orbit is None:
+        orbit = OrbitContext(h5f)
+    MISR_blocks = orbit.misr_blocks
+    if len(MISR_blocks) == 0:
+        print(">> IOError( no available MISR block in orbit {} )".format(output_nc_name))
+        return [None] * NUM_CONFIGS if MULTI else None
+
+    # LOAD lat/lon, radiance and sza/vza of the descending blocks here
+    lat, lon, rads_all, raw_szas, raw_vzas = read_misr_blocks(h5f, MISR_blocks, CAMERA)
+
+    # AGGREGATE 275-m res bands to 1.1-km (all blocks at once, work buffers are shared by the bands)
+    buffers = {}
+    for iband in range(len(MISR_BANDS)):
+        if rads_all[iband].shape[1:] == (512, 2048):
+            rads_all[iband] = aggregate_misr_275m(rads_all[iband], buffers=buffers)
+
+    # INTERPOLATE sza and vza of all blocks to the radiance shape (this part can be replaced by a more accurate function)
     rad_shape = (128, 512)
+    np.place(raw_szas, raw_szas<0, np.nan)
+    np.place(raw_vzas, raw_vzas<0, np.nan)
+    resizer = BlockResizer(raw_szas.shape[1:], rad_shape)
+    blk_szas = resizer(raw_szas)
+    blk_vzas = resizer(raw_vzas)
     
 
-    # LOOP through MISR blocks (starts from 0)
-    for iblk in MISR_blocks:
-
-        # INTERPOLATE sza and vza (this part can be replaced by a more accurate function)
-        raw_sza = h5f['MISR/Solar_Geometry/SolarZenith'][iblk]
-        raw_vza = h5f['MISR/{}/Sensor_Geometry/{}Zenith'.format(CAMERA, ''.join(c.lower() if i==1 else c for i,c in enumerate(CAMERA)))][iblk]
-        np.place(raw_sza, raw_sza<0, np.nan)
-        np.place(raw_vza, raw_vza<0, np.nan)
-        blk_sza = resize(raw_sza, rad_shape)
-        blk_vza = resize(raw_vza, rad_shape)
-
+    # LOOP through MISR blocks (iblk is the position in MISR_blocks)
+    # cell indexes (cell * 4 + band) and radiances of all blocks and bands are collected and binned at once
+    # (for each configuration, selected from the samples of the largest VZA_MAX)
+    orbit_cells = [[] for config in configs]
+    orbit_rads = [[] for config in configs]
+    for iblk in range(len(MISR_blocks)):
+        blk_sza = blk_szas[iblk]
+        blk_vza = blk_vzas[iblk]
 
         # SELECT lat/lon
-        idx_geometry = np.where((blk_sza<89.0) & (blk_vza<VZA_MAX))
+        idx_geometry = np.where((blk_sza<89.0) & (blk_vza<VZA_MAX_ALL))
         select_lat = lat[iblk][idx_geometry]
         select_lon = lon[iblk][idx_geometry]
+        select_vza = blk_vza[idx_geometry]
+        select_cells = misr_latslons_to_cells(select_lat, select_lon, LAT_EDGES, LON_EDGES)
 
 
         # SELECT spectral radiances here
-        # Aggregate 275-m res data to 1.1-km when necessary
         # Separate band by band to allow one (or more) band(s) failure
-        for iband, band_name in enumerate(MISR_bands, start=0):
-            blk_rad = rads_all[iband][iblk]
-            # blk_rad = h5f['MISR/{}/Data_Fields/{}_Radiance'.format(CAMERA, band_name)][iblk]
-
-            if blk_rad.shape == (512, 2048): 
-                # 275-m res band
-                np.place(blk_rad, blk_rad<0, np.nan)
-                fnl_blk_rad = np.nanmean(np.reshape(blk_rad, (blk_rad.shape[0]//4, 4, blk_rad.shape[1]//4,4)), axis=(1,3))
-            else:
-                fnl_blk_rad = blk_rad
-
+        for iband, band_name in enumerate(MISR_BANDS, start=0):
+            fnl_blk_rad = rads_all[iband][iblk]
 
             select_rad = np.nan_to_num(fnl_blk_rad[idx_geometry])
             fnl_idx = np.where((select_rad>0)&(select_rad<1000))[0]
 
-            fnl_lat = select_lat[fnl_idx] * -1
-            fnl_lon = select_lon[fnl_idx]
-            fnl_rad = select_rad[fnl_idx]
+            fnl_idx = fnl_idx[select_cells[fnl_idx]>=0]
 
-            try:
-                rad_sum, binedges, bin_numbers = binned_statistic_dd((fnl_lat, fnl_lon), fnl_rad, bins=[LAT_EDGES, LON_EDGES], statistic='sum')
-                rad_cnt, binedges, bin_numbers = binned_statistic_dd((fnl_lat, fnl_lon), fnl_rad, bins=[LAT_EDGES, LON_EDGES], statistic='count')
+            for iconfig, config in enumerate(configs):
+                cfg_idx = fnl_idx if config['VZA_MAX'] == VZA_MAX_ALL else fnl_idx[select_vza[fnl_idx]<config['VZA_MAX']]
+                orbit_cells[iconfig].append(select_cells[cfg_idx] * 4 + iband)
+                orbit_rads[iconfig].append(select_rad[cfg_idx])
 
-                orbit_radiance_sum[:, :, iband] += rad_sum
-                orbit_radiance_num[:, :, iband] += rad_cnt
-            except ValueError:
-                continue
-
-    # =============================================================================
-    # 3. Save results
-    # =============================================================================
-    orbit_radiance_num = np.array(orbit_radiance_num, dtype='int16')
+    # BIN data
+    # sum and count share the same cell indexes
+    orbit_ds = []
+    for iconfig in range(NUM_CONFIGS):
+        if len(orbit_cells[iconfig]) > 0:
+            cells = np.concatenate(orbit_cells[iconfig])
+            rads = np.concatenate(orbit_rads[iconfig])
+            orbit_radiance_sum[iconfig] = np.bincount(cells, weights=rads, minlength=NUM_LATS*NUM_LONS*4).reshape(NUM_LATS, NUM_LONS, 4)
+            orbit_radiance_num[iconfig] = np.bincount(cells, minlength=NUM_LATS*NUM_LONS*4).reshape(NUM_LATS, NUM_LONS, 4)
 
-    coords_lats = np.linspace(90-SPATIAL_RESOLUTION/2, -90+SPATIAL_RESOLUTION/2, NUM_LATS)
-    coords_lons = np.linspace(-180+SPATIAL_RESOLUTION/2, 180-SPATIAL_RESOLUTION/2, NUM_LONS)
+        # =============================================================================
+        # 3. Gather results
+        # =============================================================================
+        radiance_num = np.array(orbit_radiance_num[iconfig], dtype='int16')
 
-    xr_rad_sum = xr.DataArray(orbit_radiance_sum, coords=[('latitude', coords_lats), ('longitude', coords_lons), ('misr_channel', range(4))])
-    xr_rad_num = xr.DataArray(orbit_radiance_num, coords=[('latitude', coords_lats), ('longitude', coords_lons), ('misr_channel', range(4))])
-    xr_rad_sum.encoding['_FillValue'] = 0
-    xr_rad_num.encoding['_FillValue'] = 0
-    xr_rad_sum.name = 'MISR spec rad sum'
-    xr_rad_num.name = 'MISR spec rad num'
-    xr_rad_sum.to_netcdf(orbit_nc_out, 'a')
-    xr_rad_num.to_netcdf(orbit_nc_out, 'a')
-    return orbit_nc_out
+        orbit_ds.append(grid_dataset({'MISR spec rad sum': orbit_radiance_sum[iconfig], 'MISR spec rad num': radiance_num}, SPATIAL_RESOLUTION, 'misr_channel'))
+    return orbit_ds if MULTI else orbit_ds[0]
 
 
 if __name__ == "__main__":
     bf_file = sys.argv[1]
-    main_bf_MISR(bf_file, '')
+    main_bf_MISR(h5py.File(bf_file, 'r'))
 
 
 
@@ -14,8 +14,8 @@ For each day, the general workflow is:
         (2.1 read MODIS radiance and the corresponding lat/lon, vza/sza;
         (2.2 radiance quality control;
         (2.3 calculate spectral band insolation by cos(sza)*rad_scale/ref_scale
-        (2.4 call sort() to sort discrete MODIS samples into specified grids;
-    3) call save_data_hdf5() to save result arrays.
+        (2.4 call accumulate() to sort discrete MODIS samples into specified grids;
+    3) return result arrays as an xarray Dataset (saved by main_bf_orbit).
 
 
 Modified on Oct 10, 2019
@@ -27,47 +27,109 @@ instead of a day.
 import numpy as np
 import os
 import sys
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import h5pyd as h5py
 import xarray as xr
-from Climate_Marble_common_functions import latslons_to_idxs, get_descending
-from sample2grid_sw import sort
+from Climate_Marble_common_functions import latslons_to_idxs, get_output_nc_name, expand_configs, OrbitContext
+from Climate_Marble_io_functions import PrefetchPipeline
+from Climate_Marble_output_functions import grid_dataset
+from sample2grid_sw import accumulate
 import s3fs
 
 
 
+def read_modis_granule(h5f, igranule, CATEGORY='VIS', executor=None):
+    """
+    Read lat/lon, sza/vza and the spectral radiances (with their scales) of a MODIS granule.
+
+    Each dataset is read with one request and its attributes are read once.
+    With an executor, the (independent) dataset requests are issued concurrently.
+    
+    Args:
+        h5f (hdf5 instance)               : instance of a basic fusion file
+        igranule (str)                    : MODIS granule (e.g., 'granule_2012155_0700')
+        CATEGORY (str, optional)          : category of MODIS radiances ('VIS', 'SWIR', or 'LW')
+        executor (ThreadPoolExecutor, optional): executor issuing the requests concurrently
+    
+    Returns:
+        lats, lons, sza, vza (array): geolocation and sun-view geometry (lines x 1354)
+        mdata (array)               : spectral radiances (channels x lines x 1354)
+        rad_scales, ref_scales (array): radiance and reflectance scales of the channels
+    
+    Raises:
+        KeyError: a dataset is not accessible in the granule
+    """
+    geo_paths = ['MODIS/{}/_1KM/Geolocation/Latitude'.format(igranule),
+                 'MODIS/{}/_1KM/Geolocation/Longitude'.format(igranule),
+                 'MODIS/{}/SolarZenith'.format(igranule),
+                 'MODIS/{}/SensorZenith'.format(igranule)]
+
+    if CATEGORY == 'VIS':
+        fld_paths = ['MODIS/{}/_1KM/Data_Fields/{}'.format(igranule, ifld) for ifld in ['EV_250_Aggr1km_RefSB', 'EV_500_Aggr1km_RefSB']]
+    else:
+        # SWIR ('EV_1KM_RefSB') and LW ('EV_1KM_Emissive') are not available yet
+        fld_paths = []
+
+    def read_dataset(data_path):
+        try:
+            sds = h5f[data_path]
+            data = sds[:]
+            if data_path in fld_paths:
+                attrs = sds.attrs
+                return data, attrs['radiance_scales'], attrs['reflectance_scales']
+            return data
+        except KeyError:
+            raise KeyError(data_path)
+
+    if executor is None:
+        results = [read_dataset(data_path) for data_path in geo_paths + fld_paths]
+    else:
+        results = list(executor.map(read_dataset, geo_paths + fld_paths))
+
+    lats, lons, sza, vza = results[:4]
+    if len(fld_paths) == 0:
+        return lats, lons, sza, vza, np.array([]), np.array([]), np.array([])
 
-def main_bf_MODIS(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CATEGORY='VIS'):
+    mdata = np.concatenate([ifld[0] for ifld in results[4:]])
+    rad_scales = np.concatenate([ifld[1] for ifld in results[4:]])
+    ref_scales = np.concatenate([ifld[2] for ifld in results[4:]])
+    return lats, lons, sza, vza, mdata, rad_scales, ref_scales
+
+
+def main_bf_MODIS(h5f, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CATEGORY='VIS', orbit=None, IO_WORKERS=6, PREFETCH_DEPTH=1):
     """
     An updated function of main_daily, adapted working on the basic fusion files on AWS cloud.
-    The MODIS gridded file for each orbit will be generated directly from the basic fusion data files.
+    The MODIS gridded results for each orbit will be generated directly from the basic fusion data files,
+    and saved together with the other instruments by main_bf_orbit.
     
     Args:
-        bf_file (str)                       : BF file path
-        output_folder (str)                 : folder storing the gridded results
+        h5f (hdf5 instance)                 : instance of a basic fusion file
         SPATIAL_RESOLUTION (float, optional): spatial resolution of the grid (in degree)
-        VZA_MAX (int, optional)             : maximum viewing zenith angle considered (in degree
+        VZA_MAX (int or list, optional)     : maximum viewing zenith angle considered (in degree),
+                                              or a list of thresholds gridded from the same read of the granules
         CATEGORY (str, optional)            : category of MODIS radiances ('VIS', 'SWIR', or 'LW')
+        orbit (OrbitContext, optional)      : descending-node analysis of h5f (computed here if not given)
+        IO_WORKERS (int, optional)          : maximum number of concurrent dataset requests per granule
+        PREFETCH_DEPTH (int, optional)      : number of granules read ahead while the current one is gridded
     
     Returns:
-        there is no return value for this function
+        orbit_ds (xarray Dataset): gridded MODIS radiances of the orbit (None if no granule is available);
+                                   a list of them (one per threshold) when VZA_MAX is a list
     """
 
     # =============================================================================
     # 1. Initialization
     #    calculate constant parameters
-    #    initialize output arrays and output hdf5 file (LW does not use orbit_insolation_sum)
+    #    initialize output arrays (LW does not use orbit_insolation_sum)
     #    fetch basic fusion files
     #    check the number of MODIS granules 
     # =============================================================================
     print("---->", type(h5f))
-    if type(h5f.fid) is str:
-        output_nc_name = h5f.fid.split('/')[-1].replace('TERRA_BF_L1B', 'CLIMARBLE')
-    else:
-        output_nc_name = h5f.fid.name. \
-            decode("utf-8").split('/')[-1]. \
-            replace('TERRA_BF_L1B', 'CLIMARBLE')
-
-    output_nc_name = output_nc_name.replace('.h5', '.nc')
+    output_nc_name = get_output_nc_name(h5f)
+    configs, MULTI = expand_configs(VZA_MAX=VZA_MAX)
+    NUM_CONFIGS = len(configs)
+    VZA_MAX_ALL = max(config['VZA_MAX'] for config in configs)
 
     # 
     NUM_POINTS = 1 / SPATIAL_RESOLUTION
@@ -81,10 +143,14 @@ def main_bf_MODIS(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CATEGO
         NUM_CHAN = 16
     
     # 
-    orbit_radiance_sum = np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN))
-    orbit_radiance_num = np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='int16')
-    orbit_insolation_sum = np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN))
-    orbit_nc_out = os.path.join(output_folder, output_nc_name)
+    # (Fortran-ordered float32/int32 arrays are updated in place by the fortran subroutine)
+    # one set of arrays per configuration (VZA_MAX threshold)
+    orbit_radiance_sum = [np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='float32', order='F') for config in configs]
+    orbit_radiance_num = [np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='int32', order='F') for config in configs]
+    orbit_insolation_sum = [np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='float32', order='F') for config in configs]
+    # orbit_insolation_sum holds the sum of cos(sza) of the valid samples of each channel,
+    # the channel coefficients (rad_scale / ref_scale) are applied when the results are saved
+    orbit_coeffs = [None] * NUM_CONFIGS
 
 
     # =============================================================================
@@ -95,177 +161,145 @@ def main_bf_MODIS(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CATEGO
     # =============================================================================
 
     # USE MODIS granules to find all descending granules
-    MODIS_granules = get_descending(h5f, 'MODIS')
-    if MODIS_granules[0] == 0:
-        print (">> IOError( no available MODIS granule in orbit {} )".format(bf_h5f))
-        return
-
-    for igranule in MODIS_granules:     
-        # =============================================================================
-        # 2.1 MOD03 check
-        #     lat/lon check
-        #     lats, lons, lats_idx, lons_idx will be used in the main fortran subroutine
-        # =============================================================================
-        try:
-            lats = h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(igranule)][:]
-            lons = h5f['MODIS/{}/_1KM/Geolocation/Longitude'.format(igranule)][:]
-        except KeyError:
-            print (">> KeyError( cannot access lat/lon in {} )".format(igranule))
-            continue
-
-        # Calculate lat/lon indexes of all sample. 
-        # (2018.05.29) Explicitly convert these indexes to integer
-        lats_idx, lons_idx = latslons_to_idxs(lats, lons, NUM_POINTS)
-
-        # SZA/VZA check is applied here. 
-        # sza, vza, valid_y, valid_x, valid_num will be used in the main fortran subroutine
-        try:
-            sza = h5f['MODIS/{}/SolarZenith'.format(igranule)][:, :]
-            vza = h5f['MODIS/{}/SensorZenith'.format(igranule)][:, :]
-        except KeyError:
-            print (">> KeyError( cannot access sza/vza in {} )".format(igranule))
-            continue
-        cosine_sza = np.cos(np.deg2rad(sza))
+    if orbit is None:
+        orbit = OrbitContext(h5f)
+    MODIS_granules = orbit.modis_granules
+    if len(MODIS_granules) == 0:
+        print (">> IOError( no available MODIS granule in orbit {} )".format(output_nc_name))
+        return [None] * NUM_CONFIGS if MULTI else None
+
+    # Dataset requests of a granule are independent and issued concurrently,
+    # and the next granules are read while the current one is gridded
+    executor = ThreadPoolExecutor(max_workers=IO_WORKERS) if IO_WORKERS > 1 else None
+    pipeline = PrefetchPipeline(lambda igranule: read_modis_granule(h5f, igranule, CATEGORY, executor), MODIS_granules, PREFETCH_DEPTH)
+
+    # leaving the block (even on an error) closes the granule iterator (pending reads are cancelled),
+    # then shuts down the executor of the dataset requests
+    with executor if executor is not None else contextlib.nullcontext(), contextlib.closing(iter(pipeline)) as granules:
+        for igranule, granule in granules:     
+            # =============================================================================
+            # 2.1 MOD03 check
+            #     lat/lon check
+            #     lats, lons, lats_idx, lons_idx will be used in the main fortran subroutine
+            # =============================================================================
+            try:
+                lats, lons, sza, vza, mdata, rad_scales, ref_scales = granule.result()
+            except KeyError as e:
+                print (">> KeyError( cannot access {} )".format(e.args[0]))
+                continue
+
+            # Calculate lat/lon indexes of all sample. 
+            # (2018.05.29) Explicitly convert these indexes to integer
+            lats_idx, lons_idx = latslons_to_idxs(lats, lons, NUM_POINTS)
+
+            # SZA/VZA check is applied here. 
+            # sza, vza, valid_y, valid_x, valid_num will be used in the main fortran subroutine
+            cosine_sza = np.cos(np.deg2rad(sza))
     
-        # SAMPLE-LEVEL CHECK is applied here
-        # 0 <= SZA <= 89.0  and  0 <= VZA < 40.0 and longitude_indexes >= 0     
-        # Get valid_num, valid_x, valid_y
-        valid_y, valid_x = np.where((sza>=0)&(sza<=89.0)&(vza>=0)&(vza<VZA_MAX)&(lons_idx>=0))
-        valid_num = len(valid_x)
-        if valid_num == 0:
-            print (">> CriteriaError( no valid samples in granule {} )".format(igranule))
-            continue
-
-        # =============================================================================
-        # 2.2 MOD02 radiance check
-        # Since most (not all) bands' (1--7) 65528 suggest saturation, Larry and I decided
-        # to replace all 65528 values with spectral maximum radiance.
-        #
-        # Because 65528 is actually Aggregation Algorithm Failure that not only caused by
-        # the signal saturation, red band is used to determine whether the sample is actually
-        # saturated (red_band != 65528) or is caused by any other issues (red_band == 65528).
-        #
-        # Note that:
-        # 1) Saturated samples in other bands are refilled only when red_band != 65528.
-        # 2) Red band samples are never refilled.
-        # 3) This approach is only applied to VIS category (not for SWIR and LW categories).
-        # =============================================================================
-        mdata = []
-        rad_scales = []
-        ref_scales = []
-
-        if CATEGORY == 'VIS':
-            for ifld in ['EV_250_Aggr1km_RefSB', 'EV_500_Aggr1km_RefSB']:
-                sds = h5f['MODIS/{}/_1KM/Data_Fields/{}'.format(igranule, ifld)]
-                for iband in range(len(sds)):
-                    mdata.append(sds[iband])
-                    rad_scales.append(sds.attrs['radiance_scales'][iband])
-                    ref_scales.append(sds.attrs['reflectance_scales'][iband])
-
-        # elif CATEGORY == 'SWIR':
-        #     sds = h4f.select('EV_1KM_RefSB')
-        #     data_int = sds.get()
-        #     for iband in range(len(data_int)):
-        #         mdata.append(data_int[iband])
-        #         rad_scales.append(sds.attributes()['radiance_scales'][iband])
-        #         rad_offsets.append(sds.attributes()['radiance_offsets'][iband])
-        #         ref_scales.append(sds.attributes()['reflectance_scales'][iband])
-        #         ref_offsets.append(sds.attributes()['reflectance_offsets'][iband])
-
-        # elif CATEGORY == 'LW':
-        #     sds = h4f.select('EV_1KM_Emissive')
-        #     data_int = sds.get()
-        #     for iband in range(len(data_int)):
-        #         mdata.append(data_int[iband])
-        #         rad_scales.append(sds.attributes()['radiance_scales'][iband])
-        #         rad_offsets.append(sds.attributes()['radiance_offsets'][iband])
-
-        # convert data into numpy arrays
-        mdata = np.array(mdata)
-        rad_scales = np.array(rad_scales)
-        ref_scales = np.array(ref_scales)
-
-        # calculate coefficients
-        if CATEGORY in ['VIS', 'SWIR']:
-            coeffs = rad_scales / ref_scales
-        elif CATEGORY == 'LW':
-            coeffs = [0.]*16
-
-        # spectral radiances have been calculated, so we just use it.
-        # for insolation = cos(sza) * rad_scale / ref_scale
-        # for reflected_radiance_max = (32767 - rad_offset) * rad_scale
-        sols = []
-        rads = []
-        rads_max = []
-        for iband in range(NUM_CHAN):
-            tmp_sol = cosine_sza * coeffs[iband]
-
-            tmp_rad = mdata[iband]
-            tmp_rad_max = 32767 * rad_scales[iband]
-            
+            # SAMPLE-LEVEL CHECK is applied here
+            # 0 <= SZA <= 89.0  and  0 <= VZA < 40.0 
+            # lat > -999 and lon > -999 and 0 <= lat/lon indexes < NUM_LATS/NUM_LONS
+            # Get valid_num, valid_x, valid_y
+            # (with the largest VZA_MAX, the samples of each configuration are selected from them in 2.3)
+            valid_y, valid_x = np.where((sza>=0)&(sza<=89.0)&(vza>=0)&(vza<VZA_MAX_ALL)& \
+                                        (lats>-999)&(lons>-999)& \
+                                        (lats_idx>=0)&(lats_idx<NUM_LATS)&(lons_idx>=0)&(lons_idx<NUM_LONS))
+            valid_num = len(valid_x)
+            if valid_num == 0:
+                print (">> CriteriaError( no valid samples in granule {} )".format(igranule))
+                continue
+
+            # =============================================================================
+            # 2.2 MOD02 radiance check
+            # Since most (not all) bands' (1--7) 65528 suggest saturation, Larry and I decided
+            # to replace all 65528 values with spectral maximum radiance.
+            #
+            # Because 65528 is actually Aggregation Algorithm Failure that not only caused by
+            # the signal saturation, red band is used to determine whether the sample is actually
+            # saturated (red_band != 65528) or is caused by any other issues (red_band == 65528).
+            #
+            # Note that:
+            # 1) Saturated samples in other bands are refilled only when red_band != 65528.
+            # 2) Red band samples are never refilled.
+            # 3) This approach is only applied to VIS category (not for SWIR and LW categories).
+            # =============================================================================
+
+            # only the valid samples are kept (samples x channels, Fortran-ordered float32),
+            # so that the fortran subroutine gets them without any hidden copy
+            # for insolation = cos(sza) * rad_scale / ref_scale (cos(sza) only, see above)
+            # for reflected_radiance_max = (32767 - rad_offset) * rad_scale
+            rads = np.asfortranarray(mdata[:, valid_y, valid_x].T, dtype='float32')
+            sols = cosine_sza[valid_y, valid_x].astype('float32')
+            rads_max = (32767 * rad_scales[:NUM_CHAN]).astype('float32')
+            valid_lats_idx = lats_idx[valid_y, valid_x]
+            valid_lons_idx = lons_idx[valid_y, valid_x]
+            valid_vza = vza[valid_y, valid_x]
+
             # Refill only applied to VIS category
-            if (CATEGORY == 'VIS') & (iband > 0):
-                refill_mask = (mdata[0] > 0) & (tmp_rad == -992)
-                num_saturated_samples = len(np.where(refill_mask.ravel()==True)[0])
-                if num_saturated_samples > 0:
-                    # print ">> Warning, band {} has {} saturated samples".format(iband+1, num_saturated_samples)
-                    np.place(tmp_rad, refill_mask, tmp_rad_max)
-
-            sols.append( tmp_sol )
-            rads.append( tmp_rad )
-            rads_max.append( tmp_rad_max )
-        
-        
-        sols = np.array(sols)
-        rads = np.array(rads)
-        sols = np.rollaxis(sols, 0, 3)
-        rads = np.rollaxis(rads, 0, 3)
-        rads_max = np.array(rads_max)
-
-        # =============================================================================
-        # 2.3 Call main fortran subroutine to sort granule samples into lat/lon grids
-        #
-        # Get orbit_insolation_sum, orbit_radiance_sum, orbit_radiance_num
-        # valid lat/lon   (lat != -999 and lon != -999 and idx_lat/lon are valid)
-        # valid radiance  (0 < rad <= rad_max)
-        # =============================================================================
-        try:
-            orbit_insolation_sum, orbit_radiance_sum, orbit_radiance_num = sort(NUM_CHAN, NUM_LATS, NUM_LONS, \
-                valid_num, valid_x, valid_y, \
-                len(lats_idx), lats, lons, lats_idx, lons_idx, \
-                rads, sols, rads_max, \
-                orbit_insolation_sum, orbit_radiance_sum, orbit_radiance_num)
-        except Exception as e:
-            print (">> FunctionError( fortran code went wrong in {}: {} )".format(itime, e))
-            continue
+            if CATEGORY == 'VIS':
+                for iband in range(1, NUM_CHAN):
+                    refill_mask = (rads[:, 0] > 0) & (rads[:, iband] == -992)
+                    rads[refill_mask, iband] = rads_max[iband]
+
+            # =============================================================================
+            # 2.3 Call main fortran subroutine to sort granule samples into lat/lon grids
+            #
+            # Accumulate into orbit_insolation_sum, orbit_radiance_sum, orbit_radiance_num (in place)
+            # valid radiance  (0 < rad <= rad_max), checked for each channel of each sample
+            # The samples of each configuration (VZA < VZA_MAX) are selected from the valid samples of the granule
+            # =============================================================================
+            for iconfig, config in enumerate(configs):
+                if config['VZA_MAX'] == VZA_MAX_ALL:
+                    select_num = valid_num
+                    select_lats_idx, select_lons_idx, select_rads, select_sols = valid_lats_idx, valid_lons_idx, rads, sols
+                else:
+                    select = valid_vza < config['VZA_MAX']
+                    select_num = np.count_nonzero(select)
+                    if select_num == 0:
+                        continue
+                    select_lats_idx, select_lons_idx = valid_lats_idx[select], valid_lons_idx[select]
+                    select_rads, select_sols = np.asfortranarray(rads[select]), sols[select]
+
+                # calculate coefficients
+                # cos(sza) is gridded once for all channels, so the coefficients of the granule are 
+                # only applied relatively to the ones of the orbit (sol_scales = 1 when they are the same)
+                if CATEGORY in ['VIS', 'SWIR']:
+                    coeffs = (rad_scales / ref_scales)[:NUM_CHAN]
+                    if orbit_coeffs[iconfig] is None:
+                        orbit_coeffs[iconfig] = coeffs
+                    sol_scales = (coeffs / orbit_coeffs[iconfig]).astype('float32')
+                elif CATEGORY == 'LW':
+                    orbit_coeffs[iconfig] = np.zeros(NUM_CHAN, dtype='float32')
+                    sol_scales = np.ones(NUM_CHAN, dtype='float32')
+
+                try:
+                    accumulate(NUM_CHAN, NUM_LATS, NUM_LONS, select_num, \
+                        select_lats_idx, select_lons_idx, \
+                        select_rads, select_sols, rads_max, sol_scales, \
+                        orbit_insolation_sum[iconfig], orbit_radiance_sum[iconfig], orbit_radiance_num[iconfig])
+                except Exception as e:
+                    print (">> FunctionError( fortran code went wrong in {}: {} )".format(igranule, e))
+                    continue
+
+    print(">> Prefetch( MODIS {} )".format(pipeline))
 
     # =============================================================================
-    # 4. Save output arrays
+    # 4. Gather output arrays
     # =============================================================================
-    coords_lats = np.linspace(90-SPATIAL_RESOLUTION/2, -90+SPATIAL_RESOLUTION/2, NUM_LATS)
-    coords_lons = np.linspace(-180+SPATIAL_RESOLUTION/2, 180-SPATIAL_RESOLUTION/2, NUM_LONS)
-
-    xr_sw_sum = xr.DataArray(orbit_radiance_sum, coords=[('latitude', coords_lats), ('longitude', coords_lons), ('modis_channel', range(NUM_CHAN))])
-    xr_sw_num = xr.DataArray(orbit_radiance_num, coords=[('latitude', coords_lats), ('longitude', coords_lons), ('modis_channel', range(NUM_CHAN))])
-    xr_sw_sum.encoding['_FillValue'] = 0
-    xr_sw_num.encoding['_FillValue'] = 0
-    xr_sw_sum.name = 'MODIS spec rad sum'
-    xr_sw_num.name = 'MODIS spec rad num'
-    xr_sw_sum.to_netcdf(orbit_nc_out, 'w')
-    xr_sw_num.to_netcdf(orbit_nc_out, 'a')
-
-    if CATEGORY in ['VIS', 'SWIR']:
-        xr_sol_sum = xr.DataArray(orbit_insolation_sum, coords=[('latitude', coords_lats), ('longitude', coords_lons), ('modis_channel', range(NUM_CHAN))])
-        xr_sol_sum.encoding['_FillValue'] = 0
-        xr_sol_sum.name = 'MODIS spec insol sum'
-        xr_sol_sum.to_netcdf(orbit_nc_out, 'a')
-
-    return orbit_nc_out
+    orbit_ds = []
+    for iconfig in range(NUM_CONFIGS):
+        data_vars = {'MODIS spec rad sum': orbit_radiance_sum[iconfig], 'MODIS spec rad num': orbit_radiance_num[iconfig]}
+        if CATEGORY in ['VIS', 'SWIR']:
+            if orbit_coeffs[iconfig] is not None:
+                orbit_insolation_sum[iconfig] *= orbit_coeffs[iconfig]
+            data_vars['MODIS spec insol sum'] = orbit_insolation_sum[iconfig]
+        orbit_ds.append(grid_dataset(data_vars, SPATIAL_RESOLUTION, 'modis_channel'))
+    return orbit_ds if MULTI else orbit_ds[0]
 
 
 if __name__ == "__main__":
     bf_file = sys.argv[1]
-    main_bf_MODIS(bf_file, '')
+    main_bf_MODIS(h5py.File(bf_file, 'r'))
 
 
 
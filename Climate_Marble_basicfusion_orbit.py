@@ -0,0 +1,176 @@
+"""
+Climate Marble@BasicFusion
+
+Grid all instruments (MODIS, MISR and CERES) of a basic fusion (BF) orbit and save them to one orbit product.
+The instrument gridders can run concurrently (PARALLELISM threads), each returning its grids in memory.
+The gridded results of the instruments are kept in memory and written once by write_orbit_product,
+either to a local file or to an in-memory file (e.g., streamed to S3 by work_flow.py).
+Several resolutions (a pyramid) are produced from a single pass over the orbit (see Climate_Marble_pyramid_functions).
+Several QC configurations (VZA_MAX, CATEGORY, CAMERA, MODE) are also gridded from a single read of the orbit
+(see grid_orbit_configs), e.g., for sensitivity studies over VZA thresholds.
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import h5pyd as h5py
+from Climate_Marble_basicfusion_MODIS import main_bf_MODIS
+from Climate_Marble_basicfusion_MISR import main_bf_MISR
+from Climate_Marble_basicfusion_CERES import main_bf_CERES
+from Climate_Marble_common_functions import get_output_nc_name, OrbitContext
+from Climate_Marble_output_functions import write_orbit_product
+from Climate_Marble_pyramid_functions import get_base_resolution, coarsen_dataset
+
+
+###
+def get_config_name(config):
+    """
+    Name of a QC configuration added to the orbit product names (e.g., vza30_VIS_AN_all).
+    """
+    if 'NAME' in config:
+        return config['NAME']
+    return 'vza{:g}_{}_{}_{}'.format(config['VZA_MAX'], config['CATEGORY'], config['CAMERA'], config['MODE'])
+
+
+###
+def grid_orbit_configs(h5f, configs, SPATIAL_RESOLUTION=0.5, orbit=None, PARALLELISM=1):
+    """
+    Grid all instruments of an orbit for several QC configurations, reading each granule/block once.
+
+    MODIS granules are read once per CATEGORY and MISR blocks once per CAMERA (the datasets they read),
+    CERES granules once; VZA_MAX (and the CERES MODE) only select samples, so they are evaluated on the same read.
+    The gridders read independent parts of the BF file and return in-memory results, so they run concurrently
+    in PARALLELISM threads (HSDS requests, numpy and the fortran subroutine release the GIL);
+    the orbit is then gridded in about the time of the slowest instrument instead of the sum of them.
+    
+    Args:
+        h5f (hdf5 instance)                 : instance of a basic fusion file
+        configs (list)                      : QC configurations (dicts with VZA_MAX, CATEGORY, CAMERA and MODE)
+        SPATIAL_RESOLUTION (float, optional): spatial resolution of the grid (in degree)
+        orbit (OrbitContext, optional)      : descending-node analysis of h5f (computed here if not given)
+        PARALLELISM (int, optional)         : number of gridders running at once (1 to run them one after another)
+    
+    Returns:
+        config_datasets (list): instrument -> gridded dataset (None if no result), one dict per configuration
+    """
+    if orbit is None:
+        orbit = OrbitContext(h5f)
+
+    # one gridder call per value of READ_KEY, with one set of grids per distinct selection
+    tasks = []
+    for instrument, READ_KEY, SELECT_KEYS in [('modis', 'CATEGORY', ['VZA_MAX']), ('misr', 'CAMERA', ['VZA_MAX']), ('ceres', None, ['VZA_MAX', 'MODE'])]:
+        groups = {}
+        for iconfig, config in enumerate(configs):
+            selections = groups.setdefault(config[READ_KEY] if READ_KEY else None, [])
+            selection = tuple(config[ikey] for ikey in SELECT_KEYS)
+            if selection not in selections:
+                selections.append(selection)
+
+        for read_value, selections in groups.items():
+            select_params = {ikey: [selection[i] for selection in selections] for i, ikey in enumerate(SELECT_KEYS)}
+            if instrument == 'modis':
+                task = (main_bf_MODIS, dict(CATEGORY=read_value, **select_params))
+            elif instrument == 'misr':
+                task = (main_bf_MISR, dict(CAMERA=read_value, **select_params))
+            else:
+                task = (main_bf_CERES, select_params)
+            tasks.append((instrument, READ_KEY, SELECT_KEYS, read_value, selections) + task)
+
+    def run_task(task):
+        instrument, READ_KEY, SELECT_KEYS, read_value, selections, main_bf, params = task
+        t0 = time.time()
+        datasets = main_bf(h5f, SPATIAL_RESOLUTION=SPATIAL_RESOLUTION, orbit=orbit, **params)
+        print(">> Timing( {} {} {:.2f} s )".format(instrument, read_value or '', time.time() - t0))
+        return datasets
+
+    if PARALLELISM > 1 and len(tasks) > 1:
+        with ThreadPoolExecutor(max_workers=PARALLELISM) as executor:
+            results = list(executor.map(run_task, tasks))
+    else:
+        results = [run_task(task) for task in tasks]
+
+    config_datasets = [{} for config in configs]
+    for task, datasets in zip(tasks, results):
+        instrument, READ_KEY, SELECT_KEYS, read_value, selections = task[:5]
+        for iconfig, config in enumerate(configs):
+            if READ_KEY is None or config[READ_KEY] == read_value:
+                selection = tuple(config[ikey] for ikey in SELECT_KEYS)
+                config_datasets[iconfig][instrument] = datasets[selections.index(selection)]
+    return config_datasets
+
+
+###
+def main_bf_orbit(h5f, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CATEGORY='VIS', CAMERA='AN', MODE='ct', orbit=None, \
+                  OUTPUT_FORMAT='dense', COMPLEVEL=4, SHUFFLE=True, FLOAT32=True, CHUNK_DEGREES=30, CONFIGS=None, PARALLELISM=1):
+    """
+    The gridded file (MODIS, MISR and CERES) for each orbit will be generated directly from the basic fusion data files.
+
+    Args:
+        h5f (hdf5 instance)                 : instance of a basic fusion file
+        output_folder (str)                 : folder storing the gridded results (None to keep the gridded file in memory)
+        SPATIAL_RESOLUTION (float, optional): spatial resolution of the grid (in degree), 
+                                              or a list of resolutions for a pyramid (one file per resolution)
+        VZA_MAX (int, optional)             : maximum viewing zenith angle considered (in degree)
+        CATEGORY (str, optional)            : category of MODIS radiances ('VIS', 'SWIR', or 'LW')
+        CAMERA (str, optional)              : MISR camera
+        MODE (str, optional)                : category of CERES scan mode ('ct', 'all')
+        orbit (OrbitContext, optional)      : descending-node analysis of h5f (computed here if not given)
+        OUTPUT_FORMAT (str, optional)       : 'dense' (global grids) or 'sparse' (touched cells only)
+        COMPLEVEL (int, optional)           : zlib compression level (0 for no compression)
+        SHUFFLE (bool, optional)            : apply the HDF5 shuffle filter before the compression
+        FLOAT32 (bool, optional)            : pack the float sums to float32
+        CHUNK_DEGREES (float, optional)     : size of the lat/lon tiles of the chunks (in degree)
+        CONFIGS (list, optional)            : several QC configurations gridded from one read of the orbit,
+                                              dicts overriding VZA_MAX, CATEGORY, CAMERA and/or MODE 
+                                              (and NAME, added to the file names, see get_config_name)
+        PARALLELISM (int, optional)         : number of instrument gridders running at once (see grid_orbit_configs)
+
+    Returns:
+        orbit_nc_out (str): path of the gridded orbit file, or its content (memoryview) when output_folder is None
+                            (None if no instrument has results); a list of them (one per resolution) for a pyramid;
+                            a dict (configuration name -> orbit_nc_out) with CONFIGS
+    """
+    PYRAMID = isinstance(SPATIAL_RESOLUTION, (list, tuple))
+    SPATIAL_RESOLUTIONS = list(SPATIAL_RESOLUTION) if PYRAMID else [SPATIAL_RESOLUTION]
+
+    # the orbit is gridded once at the base resolution, the levels of the pyramid are block-summed from it
+    BASE_RESOLUTION = get_base_resolution(SPATIAL_RESOLUTIONS) if PYRAMID else SPATIAL_RESOLUTION
+
+    defaults = {'VZA_MAX': VZA_MAX, 'CATEGORY': CATEGORY, 'CAMERA': CAMERA, 'MODE': MODE}
+    configs = [dict(defaults, **iconfig) for iconfig in CONFIGS] if CONFIGS is not None else [defaults]
+    config_names = [get_config_name(config) for config in configs] if CONFIGS is not None else [None]
+    if len(set(config_names)) < len(config_names):
+        raise ValueError("configuration names should be unique: {}".format(config_names))
+
+    # descending node is shared by all instruments
+    if orbit is None:
+        orbit = OrbitContext(h5f)
+
+    # the gridders run concurrently, their results are written by a single writer (write_orbit_product)
+    config_datasets = grid_orbit_configs(h5f, configs, SPATIAL_RESOLUTION=BASE_RESOLUTION, orbit=orbit, PARALLELISM=PARALLELISM)
+
+    config_nc_outs = {}
+    for config_name, instrument_datasets in zip(config_names, config_datasets):
+        orbit_nc_outs = []
+        for ires in SPATIAL_RESOLUTIONS:
+            output_nc_name = get_output_nc_name(h5f, ires if PYRAMID else None, config_name)
+            orbit_nc_out = os.path.join(output_folder, output_nc_name) if output_folder is not None else None
+
+            level_datasets = {}
+            for instrument, ds in instrument_datasets.items():
+                level_datasets[instrument] = coarsen_dataset(ds, BASE_RESOLUTION, ires) if ds is not None else None
+
+            orbit_nc_out = write_orbit_product(level_datasets, orbit_nc_out, OUTPUT_FORMAT=OUTPUT_FORMAT, \
+                COMPLEVEL=COMPLEVEL, SHUFFLE=SHUFFLE, FLOAT32=FLOAT32, CHUNK_DEGREES=CHUNK_DEGREES)
+            if orbit_nc_out is None:
+                print (">> IOError( no gridded result in orbit {} )".format(output_nc_name))
+            orbit_nc_outs.append(orbit_nc_out)
+        config_nc_outs[config_name] = orbit_nc_outs if PYRAMID else orbit_nc_outs[0]
+
+    return config_nc_outs if CONFIGS is not None else config_nc_outs[None]
+
+
+if __name__ == "__main__":
+    bf_file = sys.argv[1]
+    main_bf_orbit(h5py.File(bf_file, 'r'), '')
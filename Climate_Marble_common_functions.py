@@ -13,23 +13,88 @@ import h5pyd as h5py
 import numpy as np
 import os
 import datetime
-import julian
+from fractions import Fraction
+from Climate_Marble_time_functions import granuletime_to_jd, isotime_to_jd, jd_window_mask
+
+
+# Stride through the 1354 columns of a MODIS 1km granule when looking for descending granules,
+# i.e. only columns 0, 451, 902 and 1353 (~32 KB per granule) are read.
+DESCENDING_COLUMN_STRIDE = 451
+
+# A granule is descending when less than DESCENDING_MAX_LINES of its scan lines are not descending.
+DESCENDING_MAX_LINES = 1000
+
+# The number of non-descending lines counted on the strided columns is a lower bound of the count on all the columns
+# (fewer columns are more easily all descending), so a granule rejected from the strided columns is rejected by the
+# full-column rule as well. A granule accepted from the strided columns is checked again with all the columns when
+# its count is within DESCENDING_RECHECK_MARGIN of the threshold, or when it reaches DESCENDING_RECHECK_LATITUDE
+# (turn of the orbit), where the latitude hardly changes from a line to the next and the columns left out can
+# change the classification. It is also checked again when the strided columns contain fill values (-999): the fill
+# values of the other columns are not seen by the strided count, and each of them can add a non-descending line
+# (MOD03 fills whole scans, which the strided columns see as well as the full ones).
+DESCENDING_RECHECK_MARGIN = 500
+DESCENDING_RECHECK_LATITUDE = 75.
 
 
 ###
-def save_data_hdf5(filename, data_path, data):
-    """save data into a hdf5 file
+def get_output_nc_name(h5f, SPATIAL_RESOLUTION=None, CONFIG_NAME=None):
+    """
+    Name of the gridded orbit file of a basic fusion file 
+    (e.g., TERRA_BF_L1B_O69365_20120603070000_F000_V001.h5 -> CLIMARBLE_O69365_20120603070000_F000_V001.nc).
     
-    Create the hdf5 file if the file does not exist.
+    Args:
+        h5f (hdf5 instance)                 : instance of a basic fusion file (h5py or h5pyd)
+        SPATIAL_RESOLUTION (float, optional): resolution added to the name for the levels of a pyramid
+                                              (e.g., CLIMARBLE_O69365_20120603070000_F000_V001_2.5deg.nc)
+        CONFIG_NAME (str, optional)         : name of the QC configuration added to the name
+                                              (e.g., CLIMARBLE_O69365_20120603070000_F000_V001_vza30.nc)
     
-    Arguments:
-        filename {string} -- [output hdf5 file path]
-        data_path {string} -- [data path in the hdf5 file]
-        data {array} -- [data that needs to be saved]
+    Returns:
+        output_nc_name (str): name of the gridded orbit file
+    """
+    return bf_name_to_nc_name(get_bf_name(h5f), SPATIAL_RESOLUTION, CONFIG_NAME)
+
+
+###
+def get_bf_name(h5f):
+    """
+    Path (or HSDS domain) of an opened basic fusion file.
+    
+    Args:
+        h5f (hdf5 instance): instance of a basic fusion file (h5pyd, h5py 2.x with fid, or h5py 3.x)
+    
+    Returns:
+        bf_name (str): path of the basic fusion file
+    """
+    fid = getattr(h5f, 'fid', None)
+    if type(fid) is str:
+        return fid
+    if fid is not None:
+        return fid.name.decode("utf-8")
+    return h5f.filename
+
+
+###
+def bf_name_to_nc_name(bf_name, SPATIAL_RESOLUTION=None, CONFIG_NAME=None):
+    """
+    Name of the gridded orbit file of a basic fusion file given its path (see get_output_nc_name),
+    e.g., to look for an existing orbit product before opening the basic fusion file.
+    
+    Args:
+        bf_name (str)                       : path (or S3/HSDS URL) of the basic fusion file
+        SPATIAL_RESOLUTION (float, optional): resolution added to the name for the levels of a pyramid
+        CONFIG_NAME (str, optional)         : name of the QC configuration added to the name
+    
+    Returns:
+        output_nc_name (str): name of the gridded orbit file
     """
-    with h5py.File(filename, 'a') as h5f:
-        h5f.create_dataset(data_path, data=data, compression='gzip')
-    return
+    output_nc_name = bf_name.split('/')[-1].replace('TERRA_BF_L1B', 'CLIMARBLE')
+
+    if CONFIG_NAME is not None:
+        output_nc_name = output_nc_name.replace('.h5', '_{}.h5'.format(CONFIG_NAME))
+    if SPATIAL_RESOLUTION is not None:
+        return output_nc_name.replace('.h5', '_{:g}deg.nc'.format(SPATIAL_RESOLUTION))
+    return output_nc_name.replace('.h5', '.nc')
 
 
 ###
@@ -70,14 +135,28 @@ def latslons_to_idxs(lats, lons, num):
     lats_dec = lats - lats_int
     lons_dec = lons - lons_int
 
-    # Latitude
-    lats_idx = (90-lats_int) * num - (lats_dec*num).astype('int32')
-    lats_idx[lats>=0] -= 1
+    if float(num).is_integer():
+        # Latitude
+        lats_idx = (90-lats_int) * num - (lats_dec*num).astype('int32')
+        lats_idx[lats>=0] -= 1
 
-    # Longitude
-    lons_idx = (180+lons_int) * num + (lons_dec*num).astype('int32')
-    lons_idx[lons<0] -= 1
-    np.place(lons_idx, lons_idx==360*num, 0)
+        # Longitude
+        lons_idx = (180+lons_int) * num + (lons_dec*num).astype('int32')
+        lons_idx[lons<0] -= 1
+        num_lons = 360 * num
+    else:
+        # (e.g., 2.5 or 0.75 degree) (90-lats_int)*num is not an integer, so the same convention
+        # (cells right-closed for lat >= 0 and lon < 0, left-closed otherwise) is applied to the scaled lat/lon.
+        # The lat/lon are scaled in float64 by the exact fraction of the resolution (q/p degree), so that a lat/lon
+        # on a cell edge is scaled to an integer (the rounded num = 1/resolution would move it to the next cell)
+        resolution = Fraction(1 / float(num)).limit_denominator(10**6)
+        lats_scaled = (90 - lats.astype('float64')) * resolution.denominator / resolution.numerator
+        lats_idx = np.where(lats>=0, np.ceil(lats_scaled)-1, np.floor(lats_scaled))
+
+        lons_scaled = (180 + lons.astype('float64')) * resolution.denominator / resolution.numerator
+        lons_idx = np.where(lons<0, np.ceil(lons_scaled)-1, np.floor(lons_scaled))
+        num_lons = 360 * resolution.denominator / resolution.numerator
+    np.place(lons_idx, lons_idx==num_lons, 0)
     
     # Add on Oct.15, 2018
     lats_idx = lats_idx.astype('int32')
@@ -85,6 +164,34 @@ def latslons_to_idxs(lats, lons, num):
     return lats_idx, lons_idx
 
 
+###
+def expand_configs(**QC_PARAMS):
+    """
+    Broadcast the quality-control parameters of a gridder to a list of configurations.
+
+    Each parameter is either one value (shared by all configurations) or a list with one value per configuration
+    (e.g., VZA_MAX=[18, 30, 40], MODE=['ct', 'ct', 'all']).
+
+    Args:
+        QC_PARAMS (dict): parameter name -> value or list of values
+
+    Returns:
+        configs (list): parameter name -> value, one dict per configuration
+        MULTI (bool)  : True if any parameter is given as a list
+    """
+    lengths = set(len(value) for value in QC_PARAMS.values() if isinstance(value, (list, tuple)))
+    if len(lengths) > 1:
+        raise ValueError("configuration lists should have the same length: {}".format(QC_PARAMS))
+
+    MULTI = len(lengths) == 1
+    NUM_CONFIGS = lengths.pop() if MULTI else 1
+    configs = [{} for iconfig in range(NUM_CONFIGS)]
+    for name, value in QC_PARAMS.items():
+        for iconfig, config in enumerate(configs):
+            config[name] = value[iconfig] if isinstance(value, (list, tuple)) else value
+    return configs, MULTI
+
+
 ###
 def ymd_to_doy(iyr, imon, iday):
     """convert year, month, day to day-of-year.
@@ -103,107 +210,136 @@ def ymd_to_doy(iyr, imon, iday):
     return doy
 
 
-def get_descending(h5f, instrument):
+def count_non_descending_lines(lats):
     """
-    Given a BF instance, return the starting and ending time of the descending node.
-    Note that both times are stick to the MODIS 5-min granules.
+    Number of scan lines whose latitudes are not all smaller than the ones of the previous line.
 
-    For CERES, return the julian time of the first/last descending MODIS granule in the bf file;
-    For MODIS, return the first/last descending MODIS granule in the bf file;
-    For MISR, return the first/last block of the descending MODIS granule in the bf file.
-    
     Args:
-        h5f (hdf5 instance): instance of a basic fusion file
-        instrument (str)   : instrument from 'CERES', 'MISR', and 'MODIS'
-    
+        lats (array): latitude of the granule (lines x columns, or lines x sampled columns)
+
     Returns:
-        out_array (array): return MODIS granules, CERES start/end julian times, 
-                                     or MISR start/end blocks depending on the instrument
+        cnt (int): number of non-descending lines
+    """
+    return np.count_nonzero(~np.all(np.diff(lats, axis=0) < 0, axis=1))
+
+
+def get_descending_granules(h5f):
     """
+    Return the descending MODIS granules in a BF instance (neutral and ascending granules are omitted).
 
+    Args:
+        h5f (hdf5 instance): instance of a basic fusion file
+
+    Returns:
+        descending_granules (list): names of the descending MODIS granules
+    """
     MODIS_granules = [item[0] for item in h5f['MODIS'].items()]
-    if len(MODIS_granules) == 0:
-        print(">> IOError( no available MODIS granule in orbit {} )".format(bf_file))
-        out_array = np.array([0, 0])
 
-    else:
-        descending_granules = []
-        for igranule in MODIS_granules:     
-            try:
-                lats = h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(igranule)][:]
-                lons = h5f['MODIS/{}/_1KM/Geolocation/Longitude'.format(igranule)][:]
-            except KeyError:
-                print(">> KeyError( cannot access lat/lon in {} )".format(igranule))
-                continue
-
-            # Process descending granules only (neutral granules are omitted)
-            # May be improved by using a better criteria (?)
-            cnt = 0
-            for i in range(1, len(lats)):
-                if all(lats[i]<lats[i-1]) == False:
-                    cnt += 1
-            if cnt >= 1000:
-                # print(">> CriteriaError( this is not a descending granule {} )".format(igranule))
-                continue
-            else:
-                descending_granules.append(igranule)
-
-        descending_julian_bound = np.array([granuletime_to_jd(descending_granules[0]), granuletime_to_jd(descending_granules[-1], offset_mins=5)])
-
-        if instrument.startswith('MODIS'):
-            out_array = descending_granules
-        elif instrument.startswith('CERES'):
-            out_array = descending_julian_bound
-        elif instrument.startswith('MISR'):
-            # get MISR camera
-            icam = instrument.split('.')[1]
-            # get MISR BlockCenterTime
-            try:
-                bct = h5f['MISR/AN/BlockCenterTime'][:]
-            except:
-                print(">> IOError( cannot access MISR data )")
-                out_array = np.array([0, 0])
-            else:
-                misr_block_julian = []
-                for ibct in bct: 
-                    yr, mon, day = str(ibct).split('-') # ibct: "b'2012-06-03T07:34:23.000532Z"
-                    yr = int(yr[2:])                    # 2012
-                    if yr == 0:
-                        misr_block_julian.append(0)
-                    else:
-                        hr, mn, sec_decimal = day[3:].split(':') # "07:34:23.000532Z'"
-                        sec = int(float(sec_decimal[:-2]))       # 23.000532
-                        millisec = int(1000*(float(sec_decimal[:-2]) - sec)) # .000532 * 1000
-
-                        dt = datetime.datetime(yr, int(mon), int(day[:2]), int(hr), int(mn), sec, millisec)
-                        misr_block_julian.append(julian.to_jd(dt, fmt='jd'))
-                
-                misr_block_julian = np.array(misr_block_julian)
-                misr_descending_blocks = np.where((misr_block_julian>=descending_julian_bound[0])&(misr_block_julian<=descending_julian_bound[1]))[0]
-
-                out_array = misr_descending_blocks
-    return out_array
+    descending_granules = []
+    for igranule in MODIS_granules:     
+        try:
+            lats = h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(igranule)][:, ::DESCENDING_COLUMN_STRIDE]
+        except KeyError:
+            print(">> KeyError( cannot access lat/lon in {} )".format(igranule))
+            continue
+
+        # Process descending granules only (neutral granules are omitted)
+        # May be improved by using a better criteria (?)
+        # (the strided count is checked again with all the columns near the threshold or the poles, 
+        # see DESCENDING_RECHECK_MARGIN, so the granules are the same as with the full-column rule)
+        cnt = count_non_descending_lines(lats)
+        valid_lats = lats[lats>-999]
+        if cnt < DESCENDING_MAX_LINES and (cnt >= DESCENDING_MAX_LINES - DESCENDING_RECHECK_MARGIN or \
+                valid_lats.size < lats.size or (valid_lats.size > 0 and np.max(np.abs(valid_lats)) >= DESCENDING_RECHECK_LATITUDE)):
+            cnt = count_non_descending_lines(h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(igranule)][:])
+
+        if cnt < DESCENDING_MAX_LINES:
+            descending_granules.append(igranule)
+    return descending_granules
+
+
+def get_misr_blocks(h5f, julian_bound):
+    """
+    Return the MISR blocks (starts from 0) whose BlockCenterTime falls within the given julian time bound.
 
+    Args:
+        h5f (hdf5 instance)  : instance of a basic fusion file
+        julian_bound (array) : julian time of the first/last descending MODIS granule
 
-def granuletime_to_jd(mod_granule_string, offset_mins=0):
+    Returns:
+        misr_descending_blocks (array): MISR blocks of the descending node (empty if MISR data is not accessible)
     """
-    Convert a MODIS granule string (e.g., 'granule_2012155_0700') to julian date (e.g., 2456081.7916666665)
+    # get MISR BlockCenterTime
+    try:
+        bct = h5f['MISR/AN/BlockCenterTime'][:]
+    except:
+        print(">> IOError( cannot access MISR data )")
+        return np.array([], dtype='int64')
+
+    misr_block_julian = isotime_to_jd(bct)
+    misr_descending_blocks = np.where(jd_window_mask(misr_block_julian, julian_bound))[0]
+    return misr_descending_blocks
+
+
+class OrbitContext(object):
+    """
+    Descending-node analysis of a BF orbit.
+
+    It is computed once per orbit and shared by main_bf_MODIS, main_bf_MISR and main_bf_CERES,
+    so that the MODIS geolocation used to find the descending node is only read once.
+    Note that both times are stick to the MODIS 5-min granules.
     
     Args:
-        mod_granule_string (str): MODIS granule string
-        offset_mins (int, optional): offset minutes
+        h5f (hdf5 instance): instance of a basic fusion file
+    
+    Attributes:
+        modis_granules (list): the descending MODIS granules in the bf file (empty if none)
+        julian_bound (array) : julian time of the first/last descending MODIS granule (None if no descending granule)
+        misr_blocks (array)  : MISR blocks (starts from 0) of the descending MODIS granules (empty if none)
+    """
 
+    def __init__(self, h5f):
+        self.modis_granules = get_descending_granules(h5f)
+
+        if len(self.modis_granules) == 0:
+            self.julian_bound = None
+            self.misr_blocks = np.array([], dtype='int64')
+        else:
+            self.julian_bound = np.array([granuletime_to_jd(self.modis_granules[0]), granuletime_to_jd(self.modis_granules[-1], offset_mins=5)])
+            self.misr_blocks = get_misr_blocks(h5f, self.julian_bound)
+
+
+def get_descending(h5f, instrument, orbit=None):
+    """
+    Given a BF instance, return the starting and ending time of the descending node.
+    Note that both times are stick to the MODIS 5-min granules.
+
+    For CERES, return the julian time of the first/last descending MODIS granule in the bf file;
+    For MODIS, return the first/last descending MODIS granule in the bf file;
+    For MISR, return the first/last block of the descending MODIS granule in the bf file.
+    
+    Args:
+        h5f (hdf5 instance)           : instance of a basic fusion file
+        instrument (str)              : instrument from 'CERES', 'MISR', and 'MODIS'
+        orbit (OrbitContext, optional): descending-node analysis of h5f, computed here if not given
+    
     Returns:
-        jd (int): julian date
+        out_array (array): return MODIS granules, CERES start/end julian times, 
+                                     or MISR start/end blocks depending on the instrument
     """
-    yr = int(mod_granule_string.split('_')[1][:4])
-    doy = int(mod_granule_string.split('_')[1][-3:])
-    hr = int(mod_granule_string.split('_')[2][:2])
-    mn = int(mod_granule_string.split('_')[2][-2:])
+    if orbit is None:
+        orbit = OrbitContext(h5f)
 
-    dt = datetime.datetime(yr, 1, 1, hr, mn) + datetime.timedelta(days=doy-1, minutes=offset_mins)
-    jd = julian.to_jd(dt, fmt='jd')    
-    return jd
+    if len(orbit.modis_granules) == 0:
+        print(">> IOError( no available MODIS granule in orbit )")
+        out_array = np.array([0, 0])
+    elif instrument.startswith('MODIS'):
+        out_array = orbit.modis_granules
+    elif instrument.startswith('CERES'):
+        out_array = orbit.julian_bound
+    elif instrument.startswith('MISR'):
+        out_array = orbit.misr_blocks
+    return out_array
 
 
 # if __name__ == '__main__':
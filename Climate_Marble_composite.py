@@ -0,0 +1,217 @@
+"""
+Climate Marble@BasicFusion
+
+Incremental daily and monthly composites, updated as each orbit product is finished.
+
+The carousel workers finish the orbits in arbitrary order, so each finished orbit is merged into running
+daily and monthly accumulators (one netCDF file per day/month in the store folder) instead of re-reading all
+orbit products of a month. Each accumulator file carries the ledger of the orbits it includes ('orbit' coordinate),
+so a re-delivered orbit is never counted twice.
+The first orbit of a day/month creates its accumulator file (a temporary file replacing the accumulator, os.replace),
+the next orbits are added in place into the existing variables, and only the chunks (lat/lon tiles) touched by the
+orbit are read and rewritten (instead of the whole float64 grids).
+An update takes an exclusive lock on the accumulator file and readers a shared lock, so a partial month can be queried
+at any moment. An update in progress is flagged in the file ('updating' attribute), so an accumulator left
+incomplete by a crash during an update is detected instead of being read (it can be rebuilt from the orbit products
+with Climate_Marble_reducer).
+Workers on several machines need a shared folder supporting POSIX locks (e.g., NFSv4/EFS).
+"""
+
+import os
+import fcntl
+import contextlib
+import netCDF4
+import numpy as np
+import xarray as xr
+from Climate_Marble_reducer import OrbitAccumulator, get_period_key, PERIODS
+from Climate_Marble_output_functions import orbit_encoding
+
+
+class CompositeStore(object):
+    """
+    Folder of running daily/monthly accumulators of orbit products.
+
+    Args:
+        store_folder (str)       : folder of the accumulator files (created if needed)
+        PERIODS (list, optional) : periods updated by each orbit ('daily' and/or 'monthly')
+        COMPLEVEL (int, optional): zlib compression level of the accumulator files
+    """
+
+    def __init__(self, store_folder, PERIODS=PERIODS, COMPLEVEL=1):
+        self.store_folder = store_folder
+        self.periods = list(PERIODS)
+        self.complevel = COMPLEVEL
+        if not os.path.isdir(store_folder):
+            os.makedirs(store_folder, exist_ok=True)
+
+    def get_composite_nc(self, period_key, PERIOD='monthly'):
+        """
+        Path of the accumulator file of a day ('YYYYMMDD') or month ('YYYYMM').
+        """
+        return os.path.join(self.store_folder, 'CLIMARBLE_COMPOSITE_{}_{}.nc'.format(PERIOD.upper(), period_key))
+
+    @contextlib.contextmanager
+    def _lock(self, composite_nc, operation=fcntl.LOCK_EX):
+        # exclusive (update) or shared (read) lock of an accumulator file
+        with open(composite_nc + '.lock', 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self, composite_nc):
+        # accumulator stored in a file (empty if there is no file yet)
+        accumulator = OrbitAccumulator()
+        if os.path.exists(composite_nc):
+            with xr.open_dataset(composite_nc, mask_and_scale=False) as ds:
+                if 'updating' in ds.attrs:
+                    raise IOError("{} is incomplete (update of {} interrupted)".format(composite_nc, ds.attrs['updating']))
+                accumulator.add_dataset(ds)
+                accumulator.orbit_ncs = [str(iorbit) for iorbit in ds['orbit'].values]
+        return accumulator
+
+    def _save(self, accumulator, composite_nc):
+        # write the accumulator to a temporary file, then replace the accumulator file
+        # (the ledger dimension is unlimited, so that the next orbits are appended in place)
+        ds = accumulator.to_dataset(MEANS=False)
+        ds = ds.assign_coords(orbit=np.array(accumulator.orbit_ncs, dtype=object))
+        tmp_nc = '{}.tmp{}'.format(composite_nc, os.getpid())
+        try:
+            ds.to_netcdf(tmp_nc, 'w', engine='netcdf4', encoding=orbit_encoding(ds, COMPLEVEL=self.complevel),
+                         unlimited_dims=['orbit'])
+            os.replace(tmp_nc, composite_nc)
+        finally:
+            if os.path.exists(tmp_nc):
+                os.remove(tmp_nc)
+
+    def _add_in_place(self, nc, orbit_ds):
+        """
+        Add an orbit product into the variables of an opened accumulator file, tile by tile of the chunks
+        (only the tiles touched by the orbit are read and written).
+
+        Returns False (nothing written) if the accumulator cannot be updated in place
+        (a variable or a coordinate missing in the file, or a ledger of fixed size).
+        """
+        if not nc.dimensions['orbit'].isunlimited():
+            return False
+        for name, var in orbit_ds.data_vars.items():
+            channel_shape = var.shape[1:] if var.dims[0].endswith('_cell') else var.shape[2:]
+            if name not in nc.variables or nc.variables[name].shape[2:] != channel_shape:
+                return False
+        for idim in ['latitude', 'longitude']:
+            if not np.array_equal(nc.variables[idim][:], orbit_ds[idim].values):
+                raise ValueError("{} coordinates differ from the accumulated ones".format(idim))
+
+        NUM_LATS = len(nc.dimensions['latitude'])
+        NUM_LONS = len(nc.dimensions['longitude'])
+        for name, var in orbit_ds.data_vars.items():
+            if var.dims[0].endswith('_cell'):
+                rows, cols = np.divmod(orbit_ds[var.dims[0]].values.astype('int64'), NUM_LONS)
+                values = var.values
+            else:
+                # cells without sample add nothing
+                rows, cols = np.nonzero((var.values.reshape(NUM_LATS, NUM_LONS, -1) != 0).any(axis=2))
+                values = var.values[rows, cols]
+
+            nc_var = nc.variables[name]
+            chunks = nc_var.chunking()
+            tile_lats, tile_lons = (NUM_LATS, NUM_LONS) if chunks == 'contiguous' else chunks[:2]
+            tiles, itiles = np.unique((rows // tile_lats) * NUM_LONS + cols // tile_lons, return_inverse=True)
+            for itile, tile in enumerate(tiles):
+                lat0 = tile // NUM_LONS * tile_lats
+                lon0 = tile % NUM_LONS * tile_lons
+                selected = itiles == itile
+                block = nc_var[lat0:lat0+tile_lats, lon0:lon0+tile_lons]
+                # cells are unique, so they can be added with fancy indexing
+                block[rows[selected] - lat0, cols[selected] - lon0] += values[selected]
+                nc_var[lat0:lat0+tile_lats, lon0:lon0+tile_lons] = block
+        return True
+
+    def add_orbit(self, orbit_name, orbit_ds):
+        """
+        Merge an orbit product into its daily and monthly accumulators (an orbit already in the ledger is skipped).
+
+        Args:
+            orbit_name (str)         : name of the orbit product (e.g., CLIMARBLE_O69365_20120603070000_F000_V001.nc)
+            orbit_ds (xarray Dataset): orbit product (dense or sparse, stored values read as is)
+
+        Returns:
+            added (dict): period -> True if the orbit was added, False if it was already included
+        """
+        orbit_name = os.path.basename(orbit_name)
+        added = {}
+        for PERIOD in self.periods:
+            composite_nc = self.get_composite_nc(get_period_key(orbit_name, PERIOD), PERIOD)
+            with self._lock(composite_nc):
+                if os.path.exists(composite_nc):
+                    with netCDF4.Dataset(composite_nc, 'a') as nc:
+                        nc.set_auto_maskandscale(False)
+                        if 'updating' in nc.ncattrs():
+                            raise IOError("{} is incomplete (update of {} interrupted)".format(composite_nc, nc.updating))
+                        ledger = nc.variables['orbit']
+                        if orbit_name in [str(iorbit) for iorbit in ledger[:]]:
+                            added[PERIOD] = False
+                            continue
+
+                        # flag the update until the orbit is added to the variables and to the ledger
+                        nc.updating = orbit_name
+                        nc.sync()
+                        if self._add_in_place(nc, orbit_ds):
+                            ledger[len(ledger)] = orbit_name
+                            nc.delncattr('updating')
+                            added[PERIOD] = True
+                            continue
+                        nc.delncattr('updating')
+
+                # first orbit of the period (or an accumulator that cannot be updated in place): write the accumulator
+                accumulator = self._load(composite_nc)
+                accumulator.add_dataset(orbit_ds)
+                accumulator.orbit_ncs.append(orbit_name)
+                self._save(accumulator, composite_nc)
+                added[PERIOD] = True
+        return added
+
+    def add_orbit_file(self, orbit_nc):
+        """
+        Merge an orbit product file into its daily and monthly accumulators (see add_orbit).
+        """
+        with xr.open_dataset(orbit_nc, mask_and_scale=False) as orbit_ds:
+            return self.add_orbit(orbit_nc, orbit_ds)
+
+    def get_orbits(self, period_key, PERIOD='monthly'):
+        """
+        Ledger of the orbit products included in a day ('YYYYMMDD') or month ('YYYYMM') (the grids are not read).
+        """
+        composite_nc = self.get_composite_nc(period_key, PERIOD)
+        with self._lock(composite_nc, fcntl.LOCK_SH):
+            if not os.path.exists(composite_nc):
+                return []
+            with netCDF4.Dataset(composite_nc, 'r') as nc:
+                return [str(iorbit) for iorbit in nc.variables['orbit'][:]]
+
+    def has_orbit(self, orbit_name):
+        """
+        True if an orbit product is included in all its daily and monthly accumulators.
+        """
+        orbit_name = os.path.basename(orbit_name)
+        return all(orbit_name in self.get_orbits(get_period_key(orbit_name, PERIOD), PERIOD) for PERIOD in self.periods)
+
+    def query(self, period_key, PERIOD='monthly'):
+        """
+        Current (possibly partial) composite of a day ('YYYYMMDD') or month ('YYYYMM').
+
+        Args:
+            period_key (str)      : day or month
+            PERIOD (str, optional): 'daily' or 'monthly'
+
+        Returns:
+            ds (xarray Dataset): sums, numbers of samples and means of the orbits included so far
+                                 (None if no orbit has been included)
+        """
+        composite_nc = self.get_composite_nc(period_key, PERIOD)
+        with self._lock(composite_nc, fcntl.LOCK_SH):
+            accumulator = self._load(composite_nc)
+        if len(accumulator.orbit_ncs) == 0:
+            return None
+        return accumulator.to_dataset()
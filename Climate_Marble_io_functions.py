@@ -0,0 +1,497 @@
+"""
+I/O helpers for reading basic fusion (BF) files on HSDS/S3.
+
+Reads from HSDS are high-latency HTTP requests, so the gridders overlap them with the (CPU-bound) gridding,
+and the HTTP sessions (with their connections) are pooled across the orbits processed by a worker.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+###
+class PrefetchPipeline(object):
+    """
+    Producer/consumer pipeline that reads granules ahead of their processing.
+
+    A background thread calls read_func(item) for the items in order, keeping at most `depth` items read ahead,
+    so that granule N+1 is downloaded while granule N is quality-controlled and gridded.
+    Iterating the pipeline yields (item, future) pairs in the order of the items;
+    future.result() returns the data read (or raises the exception of read_func).
+
+    Args:
+        read_func (function)  : function reading one item
+        items (list)          : items to read (e.g., granule names)
+        depth (int, optional) : maximum number of items read ahead (bounds the memory of prefetched data)
+
+    Attributes:
+        queue_depths (list): number of items already read and waiting when the consumer asks for the next one
+        stall_time (float) : total time (in seconds) the consumer waited for the reads
+    """
+
+    def __init__(self, read_func, items, depth=1):
+        self.read_func = read_func
+        self.items = items
+        self.depth = max(1, depth)
+        self.queue_depths = []
+        self.stall_time = 0.
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        pending = deque()
+        items = iter(self.items)
+        end = object()
+
+        def submit_next():
+            item = next(items, end)
+            if item is not end:
+                pending.append((item, executor.submit(self.read_func, item)))
+
+        try:
+            for i in range(self.depth):
+                submit_next()
+
+            while len(pending) > 0:
+                item, future = pending.popleft()
+                self.queue_depths.append(future.done() + sum(ifuture.done() for iitem, ifuture in pending))
+
+                # WAIT for the read of the current item (stall), then start reading the next one
+                t0 = time.time()
+                future.exception()
+                self.stall_time += time.time() - t0
+                submit_next()
+
+                yield item, future
+        finally:
+            for item, future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def __str__(self):
+        num_items = len(self.queue_depths)
+        mean_depth = sum(self.queue_depths) / num_items if num_items > 0 else 0.
+        return "{} items, depth {}, mean queue depth {:.2f}, stall time {:.2f} s".format(num_items, self.depth, mean_depth, self.stall_time)
+
+
+###
+def get_http_conn(h5f):
+    """
+    HTTP connection (h5pyd HttpConn) of an opened file (None for an h5py file).
+    """
+    file_id = h5f.id
+    http_conn = getattr(file_id, 'http_conn', None)
+    if http_conn is None:
+        # h5pyd >= 1.0 keeps the connection in the storage plugin of the file
+        plugin = getattr(getattr(file_id, 'db', None), 'plugin', None)
+        http_conn = getattr(plugin, 'http_conn', None)
+    return http_conn
+
+
+###
+def get_file_identity(h5f):
+    """
+    Identity of an opened file: HSDS endpoint and domain (h5pyd), or real path (local h5py file)
+    (e.g., two domains with the same file name in different folders or on different endpoints are different files).
+    """
+    filename = str(h5f.filename)
+    endpoint = getattr(get_http_conn(h5f), 'endpoint', None)
+    if endpoint:
+        return endpoint.rstrip('/') + '/' + filename.lstrip('/')
+    if os.path.exists(filename):
+        return os.path.realpath(filename)
+    return filename
+
+
+###
+class FilePool(object):
+    """
+    Opens the basic fusion files of a worker on HTTP sessions pooled per endpoint and credentials.
+
+    Back-to-back orbits open different BF files, so instead of one HTTP session per file (the h5pyd default),
+    the files opened with the same (endpoint, username, password) share one requests session, whose kept-alive
+    connections are reused across files and jobs (only the few requests opening a file use a session of its own,
+    closed once the file is open). The session is mounted with a bounded connection pool (MAX_CONNECTIONS,
+    blocking when all connections are in use), which caps the HTTP requests in flight of the process whatever
+    the number of readers (concurrent MODIS dataset requests, instrument gridders running at once, prefetching).
+    A file is closed when it is released (its session stays open), and close() (or leaving the pool context)
+    closes the sessions. h5py files (local or s3fs files, endpoint=None) are opened and closed without a session.
+
+    Args:
+        h5py_module (module)           : h5py or h5pyd
+        MAX_CONNECTIONS (int, optional): maximum number of HTTP connections of a session (requests in flight)
+        RETRIES (int, optional)        : number of retries of the failed HTTP requests (connection errors and 5xx)
+
+    Attributes:
+        num_opened (int)  : number of files opened
+        num_sessions (int): number of sessions created
+        num_shared (int)  : number of files opened on an existing session
+    """
+
+    def __init__(self, h5py_module, MAX_CONNECTIONS=8, RETRIES=3):
+        self.h5py = h5py_module
+        self.max_connections = max(1, MAX_CONNECTIONS)
+        self.retries = RETRIES
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.num_opened = 0
+        self.num_sessions = 0
+        self.num_shared = 0
+
+    def _new_session(self):
+        retry = Retry(total=self.retries, read=self.retries, connect=self.retries,
+                      backoff_factor=1, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=self.max_connections, pool_block=True)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _share_session(self, h5f, key):
+        # replace the session of the file by the shared session of its endpoint and credentials
+        # (h5pyd has no public hook for the session of a connection: the private HttpConn._s of the pinned
+        # h5pyd versions is swapped, and a connection without it keeps its own session)
+        http_conn = get_http_conn(h5f)
+        if http_conn is None or not hasattr(http_conn, '_s') or key[0].startswith('http+unix://'):
+            return None
+
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.sessions[key] = self._new_session()
+                self.num_sessions += 1
+            else:
+                self.num_shared += 1
+
+        own_session = http_conn._s
+        http_conn._s = session
+        if own_session is not None and own_session is not session:
+            own_session.close()
+        return http_conn
+
+    def _close_file(self, h5f):
+        try:
+            h5f.close()
+        except Exception as e:
+            print(">> IOError( cannot close {}: {} )".format(h5f, e))
+
+    @contextmanager
+    def open(self, bf_name, endpoint=None, username=None, password=None):
+        """
+        Open a basic fusion file (read only) for the duration of a with block.
+
+        Args:
+            bf_name (str)           : path (h5py) or domain (h5pyd) of the basic fusion file
+            endpoint (str, optional): HSDS endpoint (None for h5py)
+            username (str, optional): HSDS user name
+            password (str, optional): HSDS password
+
+        Yields:
+            h5f (hdf5 instance): instance of the basic fusion file
+        """
+        http_conn = None
+        if endpoint is None:
+            h5f = self.h5py.File(bf_name, 'r')
+        else:
+            h5f = self.h5py.File(bf_name, 'r', username=username, password=password, endpoint=endpoint)
+        with self.lock:
+            self.num_opened += 1
+
+        try:
+            if endpoint is not None:
+                http_conn = self._share_session(h5f, (endpoint, username, password))
+            yield h5f
+        finally:
+            # detach the shared session, so that closing the file does not close it
+            if http_conn is not None:
+                http_conn._s = None
+            self._close_file(h5f)
+
+    def close(self):
+        """
+        Close the sessions (and their connections).
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __str__(self):
+        return "{} files opened, {} sessions, {} files on a shared session".format(self.num_opened, self.num_sessions, self.num_shared)
+
+
+###
+def strip_dtype_metadata(data):
+    """
+    Array without the dtype metadata (e.g., the string encoding added by h5py), which .npy files do not store.
+    """
+    data = np.asarray(data)
+    if data.dtype.metadata:
+        data = data.view(np.dtype(data.dtype.str))
+    return data
+
+
+###
+class ReadCache(object):
+    """
+    Size-bounded LRU cache of basic fusion reads on the local disk.
+
+    Each read (file identity, dataset path and selection) is stored as a .npy file and loaded memory-mapped
+    (copy-on-write, so the gridders can modify the arrays in place without changing the cache).
+    The attributes of a dataset (.npz) and the member names of a group (.json) are cached as well.
+    The entries and their sizes are indexed in memory in the order of their last use (the index is built once
+    from the cache folder, ordered by the modification times, which are updated on each hit), so the least
+    recently used entries are removed from the index, without listing the folder, when the cache exceeds MAX_BYTES.
+    Entries are written to a temporary file and renamed, so several processes can share a cache folder
+    (the entries written by another process are indexed when they are hit).
+    The basic fusion files are never modified, so the entries do not expire.
+
+    Args:
+        cache_folder (str)        : folder of the cache (created if needed)
+        MAX_BYTES (int, optional) : maximum size of the cache (in bytes)
+
+    Attributes:
+        hits, misses (int)               : number of reads found/not found in the cache
+        hit_bytes, miss_bytes (int)      : bytes loaded from the cache / read from the file
+    """
+
+    def __init__(self, cache_folder, MAX_BYTES=20*1024**3):
+        self.cache_folder = cache_folder
+        self.max_bytes = MAX_BYTES
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+        os.makedirs(cache_folder, exist_ok=True)
+
+        # entry path -> size, from the least to the most recently used entry
+        self.index = OrderedDict()
+        for entry_path, mtime, size in sorted(self._entries(), key=lambda entry: entry[1]):
+            self.index[entry_path] = size
+        self.total_bytes = sum(self.index.values())
+
+    @staticmethod
+    def get_key(filename, path, selection=None):
+        """
+        Key of a read (file identity, dataset path and selection; slices and indexes are normalized to integers).
+        """
+        def normalize(sel):
+            if isinstance(sel, tuple):
+                return [normalize(isel) for isel in sel]
+            if isinstance(sel, slice):
+                return ['slice'] + [None if ival is None else int(ival) for ival in (sel.start, sel.stop, sel.step)]
+            if sel is Ellipsis:
+                return 'ellipsis'
+            if isinstance(sel, (list, np.ndarray)):
+                return np.asarray(sel).tolist()
+            if isinstance(sel, (int, np.integer)):
+                return int(sel)
+            return sel
+        return hashlib.sha1(json.dumps([filename, path, normalize(selection)]).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key, ext):
+        return os.path.join(self.cache_folder, key[:2], key + ext)
+
+    def _entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cache_folder):
+            for ifile in files:
+                if '.tmp' in ifile:
+                    continue
+                entry_path = os.path.join(root, ifile)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((entry_path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _index_entry(self, entry_path, size):
+        # add (or move) an entry at the most recently used end of the index (with self.lock)
+        self.total_bytes += size - self.index.pop(entry_path, 0)
+        self.index[entry_path] = size
+
+    def _hit(self, entry_path):
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        with self.lock:
+            size = self.index.get(entry_path)
+            if size is None:
+                size = os.path.getsize(entry_path)
+            self._index_entry(entry_path, size)
+            self.hits += 1
+            self.hit_bytes += size
+
+    def load(self, key, ext='.npy'):
+        """
+        Load an entry (None if it is not in the cache).
+        """
+        entry_path = self._entry_path(key, ext)
+        try:
+            if ext == '.npy':
+                data = np.load(entry_path, mmap_mode='c', allow_pickle=False)
+            elif ext == '.npz':
+                with np.load(entry_path, allow_pickle=False) as npz:
+                    data = {name: npz[name] for name in npz.files}
+            else:
+                with open(entry_path) as entry_file:
+                    data = json.load(entry_file)
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+                # e.g., evicted by another process
+                if entry_path in self.index and not os.path.exists(entry_path):
+                    self.total_bytes -= self.index.pop(entry_path)
+            return None
+        self._hit(entry_path)
+        return data
+
+    def store(self, key, data, ext='.npy'):
+        """
+        Store an entry (an array, a dict of arrays or a JSON-serializable list), then evict the LRU entries.
+        """
+        entry_path = self._entry_path(key, ext)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = '{}.tmp{}.{}'.format(entry_path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb' if ext != '.json' else 'w') as entry_file:
+                if ext == '.npy':
+                    np.save(entry_file, strip_dtype_metadata(data), allow_pickle=False)
+                elif ext == '.npz':
+                    np.savez(entry_file, **{name: strip_dtype_metadata(value) for name, value in data.items()})
+                else:
+                    json.dump(data, entry_file)
+            os.replace(tmp_path, entry_path)
+        except (TypeError, ValueError) as e:
+            # e.g., object attributes, read again from the file next time
+            print(">> CacheError( cannot cache {}: {} )".format(key, e))
+            return
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        size = os.path.getsize(entry_path)
+        with self.lock:
+            self.miss_bytes += size
+            self._index_entry(entry_path, size)
+            evict = self.total_bytes > self.max_bytes
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in MAX_BYTES.
+        """
+        evicted = []
+        with self.lock:
+            while self.total_bytes > self.max_bytes and len(self.index) > 0:
+                entry_path, size = self.index.popitem(last=False)
+                self.total_bytes -= size
+                evicted.append(entry_path)
+        for entry_path in evicted:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                # already removed (e.g., by another process)
+                pass
+
+    def __str__(self):
+        num_reads = self.hits + self.misses
+        hit_rate = self.hits / num_reads if num_reads > 0 else 0.
+        return "{} hits ({:.1f} MB), {} misses ({:.1f} MB), hit rate {:.2f}, {:.1f} MB cached".format(
+            self.hits, self.hit_bytes / 1024**2, self.misses, self.miss_bytes / 1024**2, hit_rate, self.total_bytes / 1024**2)
+
+
+class CachedFile(object):
+    """
+    Read-through cache under the h5f[...] accesses of a basic fusion file (h5py or h5pyd).
+
+    h5f[path] returns a lazy node: reading a selection (node[...]), its attributes (node.attrs)
+    or the member names of a group (node.items()) looks up the cache first and only accesses the file on a miss,
+    so a cached orbit is reprocessed without any request to HSDS/S3. Other attributes (e.g., fid) are the file's.
+
+    Args:
+        h5f (hdf5 instance)  : instance of a basic fusion file
+        cache (ReadCache)    : cache of the reads
+    """
+
+    def __init__(self, h5f, cache):
+        self.h5f = h5f
+        self.cache = cache
+        self.cache_filename = get_file_identity(h5f)
+
+    def __getitem__(self, path):
+        return CachedNode(self, path)
+
+    def __getattr__(self, name):
+        return getattr(self.h5f, name)
+
+
+class CachedNode(object):
+    """
+    Dataset or group of a CachedFile (the object of the file is only opened on a cache miss).
+    """
+
+    def __init__(self, cached_file, path):
+        self.cached_file = cached_file
+        self.path = path
+        self._node = None
+
+    @property
+    def node(self):
+        if self._node is None:
+            self._node = self.cached_file.h5f[self.path]
+        return self._node
+
+    def _key(self, selection=None):
+        return ReadCache.get_key(self.cached_file.cache_filename, self.path, selection)
+
+    def __getitem__(self, selection):
+        cache = self.cached_file.cache
+        key = self._key(selection)
+        data = cache.load(key)
+        if data is None:
+            data = self.node[selection]
+            cache.store(key, data)
+        return data
+
+    @property
+    def attrs(self):
+        cache = self.cached_file.cache
+        key = self._key('attrs')
+        attrs = cache.load(key, '.npz')
+        if attrs is None:
+            attrs = {name: np.asarray(value) for name, value in self.node.attrs.items()}
+            cache.store(key, attrs, '.npz')
+        return attrs
+
+    def items(self):
+        cache = self.cached_file.cache
+        key = self._key('items')
+        names = cache.load(key, '.json')
+        if names is None:
+            names = [name for name, member in self.node.items()]
+            cache.store(key, names, '.json')
+        return [(name, self.cached_file['{}/{}'.format(self.path, name)]) for name in names]
+
+    def __getattr__(self, name):
+        return getattr(self.node, name)
@@ -0,0 +1,197 @@
+"""
+Climate Marble@BasicFusion
+
+Pre-flight check of the orbits that are already done.
+
+Re-queued or duplicated carousel messages (e.g., when the queue of a month is replayed after an outage) should not
+grid an orbit again. A job is identified by the basic fusion (BF) file name and a hash of the processing parameters
+(resolutions, output format, QC configuration and PRODUCT_VERSION). The hash is stored in the S3 metadata of the
+uploaded orbit products, and a manifest records the finished jobs, so a finished job is found without opening the
+BF file:
+    1) the manifest has a record of the job and the recorded products still exist unchanged (head_object, same ETag)
+       -> skip (with TRUST_MANIFEST, the record alone is trusted, e.g., for a bucket only written by the workers);
+    2) otherwise all the products exist in the output bucket with the same parameter hash (head_object)
+       -> skip and add the record to the manifest;
+    3) otherwise the orbit is processed, and its record is added after the upload.
+The manifest is a local folder or an S3 prefix (s3://bucket/prefix) holding one small JSON record per job,
+so concurrent workers never rewrite a shared file.
+Without the s3:ListBucket permission on the output bucket, S3 answers 403 instead of 404 for a missing product,
+so a 403 is taken as a missing product (the orbit is processed) rather than failing every job.
+"""
+
+import os
+import json
+import time
+import hashlib
+from botocore.exceptions import ClientError
+
+
+# increase when the gridded results change, so the existing products are no longer considered as done
+PRODUCT_VERSION = 1
+
+# S3 user metadata of the orbit products
+PARAMS_METADATA = 'climarble-params'
+
+
+###
+def get_params_hash(params):
+    """
+    Short hash of the processing parameters of a job (including PRODUCT_VERSION).
+
+    Args:
+        params (dict): processing parameters (JSON serializable)
+
+    Returns:
+        params_hash (str): 16 hexadecimal digits
+    """
+    params = dict(params, PRODUCT_VERSION=PRODUCT_VERSION)
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+###
+def head_outputs(s3_client, bucket_name, keys, params_hash):
+    """
+    Check that the orbit products of a job exist in S3 and were produced with the same parameters.
+
+    Args:
+        s3_client (boto3 client): S3 client
+        bucket_name (str)       : output bucket
+        keys (list)             : S3 keys of the orbit products
+        params_hash (str)       : hash of the processing parameters
+
+    Returns:
+        outputs (dict): key -> ETag and size of the products (None if a product is missing, forbidden or stale)
+    """
+    outputs = {}
+    for key in keys:
+        try:
+            head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ['404', 'NoSuchKey', 'NotFound']:
+                return None
+            if code in ['403', 'Forbidden', 'AccessDenied']:
+                # a missing key without s3:ListBucket, or a key that cannot be read: not done
+                print(">> S3Error( cannot head s3://{}/{} (403), s3:GetObject and s3:ListBucket are needed )".format(bucket_name, key))
+                return None
+            raise
+        if head.get('Metadata', {}).get(PARAMS_METADATA) != params_hash:
+            return None
+        outputs[key] = {'etag': head['ETag'].strip('"'), 'size': head['ContentLength']}
+    return outputs
+
+
+class OrbitManifest(object):
+    """
+    Records of the finished jobs, keyed by BF file name and parameter hash.
+
+    Args:
+        location (str)                     : local folder or S3 prefix (s3://bucket/prefix)
+        s3_client (boto3 client, optional) : S3 client (for an S3 location)
+    """
+
+    def __init__(self, location, s3_client=None):
+        self.location = location
+        self.s3_client = s3_client
+        if location.startswith('s3://'):
+            self.bucket_name, _, self.prefix = location[len('s3://'):].partition('/')
+            self.prefix = self.prefix.strip('/')
+            if s3_client is None:
+                raise ValueError("an S3 client is needed for the manifest {}".format(location))
+        else:
+            self.bucket_name = None
+
+    def _record_name(self, bf_name, params_hash):
+        return '{}/{}.json'.format(params_hash, os.path.basename(bf_name))
+
+    def get(self, bf_name, params_hash):
+        """
+        Record of a finished job (None if the job is not in the manifest).
+        """
+        record_name = self._record_name(bf_name, params_hash)
+        if self.bucket_name is not None:
+            key = '/'.join(filter(None, [self.prefix, record_name]))
+            try:
+                body = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ['404', 'NoSuchKey', 'NotFound']:
+                    return None
+                raise
+            return json.loads(body.decode('utf-8'))
+
+        record_path = os.path.join(self.location, record_name)
+        if not os.path.exists(record_path):
+            return None
+        with open(record_path) as record_file:
+            return json.load(record_file)
+
+    def put(self, bf_name, params_hash, params, outputs):
+        """
+        Record a finished job.
+
+        Args:
+            bf_name (str)     : BF file of the job
+            params_hash (str) : hash of the processing parameters
+            params (dict)     : processing parameters
+            outputs (dict)    : S3 key -> ETag and size of the orbit products
+        """
+        record = {'bf_name': bf_name, 'params_hash': params_hash, 'params': params,
+                  'product_version': PRODUCT_VERSION, 'outputs': outputs,
+                  'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+        body = json.dumps(record, sort_keys=True)
+
+        record_name = self._record_name(bf_name, params_hash)
+        if self.bucket_name is not None:
+            key = '/'.join(filter(None, [self.prefix, record_name]))
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=body.encode('utf-8'))
+            return
+
+        # write a temporary file and replace the record, so readers never see a partial record
+        record_path = os.path.join(self.location, record_name)
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        tmp_path = '{}.tmp{}'.format(record_path, os.getpid())
+        with open(tmp_path, 'w') as record_file:
+            record_file.write(body)
+        os.replace(tmp_path, record_path)
+
+
+###
+def is_orbit_done(s3_client, bucket_name, keys, bf_name, params, manifest=None, TRUST_MANIFEST=False):
+    """
+    Pre-flight check of a job: True if its orbit products are already done with the same parameters.
+
+    Args:
+        s3_client (boto3 client)           : S3 client
+        bucket_name (str)                  : output bucket
+        keys (list)                        : S3 keys of the orbit products of the job
+        bf_name (str)                      : BF file of the job
+        params (dict)                      : processing parameters of the job
+        manifest (OrbitManifest, optional) : manifest of the finished jobs
+        TRUST_MANIFEST (bool, optional)    : skip a job in the manifest without checking its products in S3
+
+    Returns:
+        bool: True if the job can be skipped
+    """
+    params_hash = get_params_hash(params)
+    record = manifest.get(bf_name, params_hash) if manifest is not None else None
+    if record is not None:
+        if TRUST_MANIFEST:
+            print(">> Skip( {} is in the manifest )".format(bf_name))
+            return True
+
+        # the products recorded in the manifest still exist unchanged (e.g., not deleted or overwritten since)
+        recorded = record.get('outputs', {})
+        outputs = head_outputs(s3_client, bucket_name, sorted(recorded), params_hash) if recorded else None
+        if outputs is not None and all(outputs[key]['etag'] == recorded[key]['etag'] for key in outputs):
+            print(">> Skip( {} is in the manifest )".format(bf_name))
+            return True
+        print(">> Manifest( the products of {} in the manifest are missing or changed )".format(bf_name))
+
+    outputs = head_outputs(s3_client, bucket_name, keys, params_hash)
+    if outputs is None:
+        return False
+
+    print(">> Skip( products of {} exist in s3://{} )".format(bf_name, bucket_name))
+    if manifest is not None:
+        manifest.put(bf_name, params_hash, params, outputs)
+    return True
@@ -0,0 +1,300 @@
+"""
+Output of the gridded orbit products.
+
+Each instrument writes its gridded variables as dense global grids (latitude x longitude [x channel]),
+while a descending orbit only touches a narrow swath of these grids.
+The sparse format stores only the touched cells of an instrument along a '<instrument>_cell' dimension
+(flat cell index = latitude index * number of longitudes + longitude index) with compact dtypes;
+the latitude/longitude coordinates of the dense grid are kept so that the dense layout can be rebuilt on demand.
+
+All instruments of an orbit are gathered into one dataset and written once (write_orbit_product),
+with zlib/shuffle compression, float32 packing and chunks of lat/lon tiles.
+The product can also be serialized in memory (no local file), e.g., to be streamed to S3.
+"""
+
+import numpy as np
+import xarray as xr
+from xarray.backends import NetCDF4DataStore
+import netCDF4
+
+
+OUTPUT_FORMATS = ['dense', 'sparse']
+
+# number of cells per chunk of the sparse variables
+# (cells are sorted by flat index, so a chunk covers a latitude band of the swath)
+SPARSE_CHUNK_CELLS = 16384
+
+# initial size (in bytes) of the buffer of an in-memory netCDF file (it grows as needed)
+INMEMORY_BUFFER_SIZE = 2**20
+
+
+###
+def grid_coords(SPATIAL_RESOLUTION):
+    """
+    Latitude/longitude coordinates (cell centers) of the global grid.
+
+    Args:
+        SPATIAL_RESOLUTION (float): spatial resolution of the grid (in degree)
+
+    Returns:
+        coords_lats, coords_lons (array): latitudes (from north to south) and longitudes of the cell centers
+    """
+    NUM_LATS = int(180 / SPATIAL_RESOLUTION)
+    NUM_LONS = int(360 / SPATIAL_RESOLUTION)
+    coords_lats = np.linspace(90-SPATIAL_RESOLUTION/2, -90+SPATIAL_RESOLUTION/2, NUM_LATS)
+    coords_lons = np.linspace(-180+SPATIAL_RESOLUTION/2, 180-SPATIAL_RESOLUTION/2, NUM_LONS)
+    return coords_lats, coords_lons
+
+
+###
+def grid_dataset(data_vars, SPATIAL_RESOLUTION, channel_dim=None):
+    """
+    Build the dense dataset of an instrument from its gridded arrays.
+
+    Args:
+        data_vars (dict)            : variable name -> gridded array (latitude x longitude [x channel])
+        SPATIAL_RESOLUTION (float)  : spatial resolution of the grid (in degree)
+        channel_dim (str, optional) : name of the channel dimension (e.g., 'modis_channel'), None for 2-D grids
+
+    Returns:
+        ds (xarray Dataset): dense dataset
+    """
+    coords_lats, coords_lons = grid_coords(SPATIAL_RESOLUTION)
+
+    ds = xr.Dataset()
+    for name, data in data_vars.items():
+        coords = [('latitude', coords_lats), ('longitude', coords_lons)]
+        if channel_dim is not None:
+            coords.append((channel_dim, range(data.shape[2])))
+        ds[name] = xr.DataArray(data, coords=coords)
+    return ds
+
+
+###
+def compact_dtype(data):
+    """
+    Compact dtype of the stored values: float32 for sums, int16 (or int32 if it does not fit) for counts.
+    """
+    if data.dtype.kind == 'f':
+        return np.dtype('float32')
+    if data.size == 0 or (data.min() >= np.iinfo('int16').min and data.max() <= np.iinfo('int16').max):
+        return np.dtype('int16')
+    return np.dtype('int32')
+
+
+###
+def dense_to_sparse(ds, instrument):
+    """
+    Keep only the cells touched by an instrument (any variable non-zero in any channel).
+    The dtypes are kept (see pack_dataset for the compact dtypes).
+
+    Args:
+        ds (xarray Dataset) : dense dataset of the instrument (variables on latitude x longitude [x channel])
+        instrument (str)    : instrument name used for the cell dimension (e.g., 'modis' -> 'modis_cell')
+
+    Returns:
+        sparse_ds (xarray Dataset): variables on <instrument>_cell [x channel], with the dense latitude/longitude coordinates
+    """
+    cell_dim = '{}_cell'.format(instrument)
+    NUM_LATS = ds.sizes['latitude']
+    NUM_LONS = ds.sizes['longitude']
+
+    touched = np.zeros(NUM_LATS*NUM_LONS, dtype=bool)
+    for name, var in ds.data_vars.items():
+        touched |= (var.values.reshape(NUM_LATS*NUM_LONS, -1) != 0).any(axis=1)
+    cells = np.flatnonzero(touched).astype('int32')
+
+    sparse_ds = xr.Dataset(coords={'latitude': ds['latitude'], 'longitude': ds['longitude'], cell_dim: cells})
+    sparse_ds[cell_dim].attrs['description'] = 'flat cell index (latitude index * number of longitudes + longitude index)'
+    for name, var in ds.data_vars.items():
+        data = var.values.reshape((NUM_LATS*NUM_LONS,) + var.shape[2:])[cells]
+        extra_dims = var.dims[2:]
+        sparse_ds[name] = xr.DataArray(data, dims=(cell_dim,) + extra_dims,
+                                       coords={idim: ds[idim] for idim in extra_dims})
+    return sparse_ds
+
+
+###
+def sparse_to_dense(ds):
+    """
+    Expand the sparse variables of a dataset back to the dense global layout (untouched cells are 0).
+    Dense variables are returned as is.
+
+    Args:
+        ds (xarray Dataset): dataset with variables on <instrument>_cell [x channel]
+
+    Returns:
+        dense_ds (xarray Dataset): variables on latitude x longitude [x channel]
+    """
+    NUM_LATS = ds.sizes['latitude']
+    NUM_LONS = ds.sizes['longitude']
+
+    dense_ds = xr.Dataset(coords={'latitude': ds['latitude'], 'longitude': ds['longitude']})
+    for name, var in ds.data_vars.items():
+        if len(var.dims) == 0 or not var.dims[0].endswith('_cell'):
+            dense_ds[name] = var
+            continue
+
+        cells = ds[var.dims[0]].values
+        data = np.zeros((NUM_LATS*NUM_LONS,) + var.shape[1:], dtype=var.dtype)
+        data[cells] = var.values
+        extra_dims = var.dims[1:]
+        dense_ds[name] = xr.DataArray(data.reshape((NUM_LATS, NUM_LONS) + var.shape[1:]),
+                                      dims=('latitude', 'longitude') + extra_dims,
+                                      coords={idim: ds[idim] for idim in extra_dims})
+    return dense_ds
+
+
+###
+def pack_dataset(ds, FLOAT32=True):
+    """
+    Cast the variables of a dataset to compact dtypes (float32 sums, int16/int32 counts).
+
+    Args:
+        ds (xarray Dataset)     : dataset to pack
+        FLOAT32 (bool, optional): cast the float variables to float32 (the integer counts are always packed)
+
+    Returns:
+        ds (xarray Dataset): packed dataset
+    """
+    ds = ds.copy()
+    for name, var in ds.data_vars.items():
+        if var.dtype.kind in 'iu' or (FLOAT32 and var.dtype.kind == 'f'):
+            ds[name] = var.astype(compact_dtype(var.values))
+    return ds
+
+
+###
+def orbit_encoding(ds, COMPLEVEL=4, SHUFFLE=True, CHUNK_DEGREES=30):
+    """
+    NetCDF encoding of the variables of an orbit product.
+
+    Dense variables are chunked in lat/lon tiles of CHUNK_DEGREES x CHUNK_DEGREES (all channels in one chunk) and
+    use 0 as fill value, sparse variables are chunked along their cells and have no fill value.
+
+    Args:
+        ds (xarray Dataset)           : orbit dataset
+        COMPLEVEL (int, optional)     : zlib compression level (0 for no compression)
+        SHUFFLE (bool, optional)      : apply the HDF5 shuffle filter before the compression
+        CHUNK_DEGREES (float, optional): size of the lat/lon tiles (in degree)
+
+    Returns:
+        encoding (dict): variable name -> encoding
+    """
+    resolution = 180. / ds.sizes['latitude']
+    tile_cells = max(1, int(round(CHUNK_DEGREES / resolution)))
+
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        chunksizes = []
+        for idim, isize in zip(var.dims, var.shape):
+            if idim in ['latitude', 'longitude']:
+                chunksizes.append(min(isize, tile_cells))
+            elif idim.endswith('_cell'):
+                chunksizes.append(min(isize, SPARSE_CHUNK_CELLS))
+            else:
+                chunksizes.append(isize)
+
+        encoding[name] = {'zlib': COMPLEVEL > 0, 'complevel': COMPLEVEL, 'shuffle': SHUFFLE,
+                          'chunksizes': tuple(max(1, ichunk) for ichunk in chunksizes),
+                          '_FillValue': None if var.dims[0].endswith('_cell') else 0}
+    return encoding
+
+
+###
+def write_orbit_product(instrument_datasets, orbit_nc_out, OUTPUT_FORMAT='dense', COMPLEVEL=4, SHUFFLE=True, FLOAT32=True, CHUNK_DEGREES=30):
+    """
+    Gather the gridded datasets of all instruments of an orbit and write them to one netCDF file at once.
+
+    Args:
+        instrument_datasets (dict)     : instrument name (e.g., 'modis') -> dense dataset (None for an instrument without results)
+        orbit_nc_out (str)             : path of the orbit netCDF file (None to serialize it in memory)
+        OUTPUT_FORMAT (str, optional)  : 'dense' (global grids) or 'sparse' (touched cells only)
+        COMPLEVEL (int, optional)      : zlib compression level (0 for no compression)
+        SHUFFLE (bool, optional)       : apply the HDF5 shuffle filter before the compression
+        FLOAT32 (bool, optional)       : pack the float sums to float32
+        CHUNK_DEGREES (float, optional): size of the lat/lon tiles of the chunks of the dense variables (in degree)
+
+    Returns:
+        orbit_nc_out (str): path of the orbit netCDF file, or its content (memoryview) when orbit_nc_out is None
+                            (None if there is no dataset to write)
+    """
+    if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+        raise ValueError("OUTPUT_FORMAT should be one of {}".format(OUTPUT_FORMATS))
+
+    datasets = []
+    for instrument, ds in instrument_datasets.items():
+        if ds is None:
+            continue
+        if OUTPUT_FORMAT == 'sparse':
+            ds = dense_to_sparse(ds, instrument)
+        datasets.append(pack_dataset(ds, FLOAT32))
+
+    if len(datasets) == 0:
+        return None
+
+    orbit_ds = xr.merge(datasets)
+    encoding = orbit_encoding(orbit_ds, COMPLEVEL, SHUFFLE, CHUNK_DEGREES)
+    if orbit_nc_out is None:
+        return dataset_to_netcdf_memory(orbit_ds, encoding)
+
+    orbit_ds.to_netcdf(orbit_nc_out, 'w', engine='netcdf4', encoding=encoding)
+    return orbit_nc_out
+
+
+###
+def dataset_to_netcdf_memory(ds, encoding):
+    """
+    Serialize a dataset to an in-memory netCDF4 file (nothing is written on the local disk).
+
+    Args:
+        ds (xarray Dataset): dataset to serialize
+        encoding (dict)    : variable name -> encoding (as in to_netcdf)
+
+    Returns:
+        nc_memory (memoryview): content of the netCDF4 file
+    """
+    nc4_ds = netCDF4.Dataset('inmemory.nc', 'w', format='NETCDF4', memory=INMEMORY_BUFFER_SIZE)
+    try:
+        ds.dump_to_store(NetCDF4DataStore(nc4_ds), encoding=encoding)
+    except Exception:
+        nc4_ds.close()
+        raise
+    return nc4_ds.close()
+
+
+###
+def open_netcdf_memory(nc_memory, name='inmemory.nc'):
+    """
+    Open an in-memory netCDF4 file (e.g., from dataset_to_netcdf_memory) as a dataset.
+    Stored values are read as is (no fill value masking).
+
+    Args:
+        nc_memory (bytes or memoryview): content of the netCDF4 file
+        name (str, optional)           : name of the file (only used in messages)
+
+    Returns:
+        ds (xarray Dataset): dataset (loaded in memory)
+    """
+    nc4_ds = netCDF4.Dataset(name, 'r', memory=bytes(nc_memory))
+    with xr.open_dataset(NetCDF4DataStore(nc4_ds), mask_and_scale=False) as ds:
+        ds.load()
+    return ds
+
+
+###
+def open_orbit_dataset(orbit_nc):
+    """
+    Read an orbit netCDF file (dense or sparse) in the dense layout.
+
+    The stored values are read as is (untouched cells are 0, not masked), and sparse variables are expanded.
+
+    Args:
+        orbit_nc (str): path of the orbit netCDF file
+
+    Returns:
+        ds (xarray Dataset): dense dataset of all instruments in the file
+    """
+    with xr.open_dataset(orbit_nc, mask_and_scale=False) as ds:
+        ds.load()
+    return sparse_to_dense(ds)
@@ -0,0 +1,114 @@
+"""
+Multi-resolution grid pyramid.
+
+Sums and numbers of samples are additive, so the grids of a coarser resolution are derived exactly from a finer grid
+by summing blocks of cells. An orbit is gridded once at the base resolution (the largest resolution that divides
+all the requested ones, e.g., 0.5 for 0.5/1/2.5 and 0.25 for 0.5/0.75), then each level is block-summed from it.
+
+The grids are anchored at the north pole and at -180 (latslons_to_idxs and the MISR bin edges), so the cell edges of a
+level are also cell edges of the base grid and a sample on an edge falls in the same side at every level.
+Resolutions that do not divide 180/360 evenly keep the int(180/res) x int(360/res) cells of the gridders:
+the base grid is padded with zeros to whole blocks and the partial last row/column is dropped.
+"""
+
+from fractions import Fraction
+import numpy as np
+import xarray as xr
+from Climate_Marble_output_functions import grid_coords
+
+
+###
+def resolution_fraction(SPATIAL_RESOLUTION):
+    """
+    Exact fraction of a resolution given in degree (e.g., 0.1 -> 1/10).
+    """
+    return Fraction(str(SPATIAL_RESOLUTION)).limit_denominator(10**6)
+
+
+###
+def get_base_resolution(SPATIAL_RESOLUTIONS):
+    """
+    Largest resolution that divides all the resolutions of the pyramid.
+
+    Args:
+        SPATIAL_RESOLUTIONS (list): resolutions of the pyramid (in degree)
+
+    Returns:
+        BASE_RESOLUTION (float): resolution of the base grid (in degree)
+    """
+    fractions = [resolution_fraction(ires) for ires in SPATIAL_RESOLUTIONS]
+    denominator = 1
+    for ifraction in fractions:
+        denominator = denominator * ifraction.denominator // np.gcd(denominator, ifraction.denominator)
+
+    numerator = 0
+    for ifraction in fractions:
+        numerator = np.gcd(numerator, int(ifraction * denominator))
+    return float(Fraction(int(numerator), denominator))
+
+
+###
+def get_block_factor(BASE_RESOLUTION, SPATIAL_RESOLUTION):
+    """
+    Number of base cells (along latitude and longitude) in a cell of a pyramid level.
+    """
+    factor = resolution_fraction(SPATIAL_RESOLUTION) / resolution_fraction(BASE_RESOLUTION)
+    if factor.denominator != 1:
+        raise ValueError("{} is not a multiple of the base resolution {}".format(SPATIAL_RESOLUTION, BASE_RESOLUTION))
+    return int(factor)
+
+
+###
+def block_sum(grid, FACTOR, NUM_LATS, NUM_LONS):
+    """
+    Sum blocks of FACTOR x FACTOR cells of a grid (latitude x longitude [x channel]).
+
+    Args:
+        grid (array)  : base grid
+        FACTOR (int)  : number of base cells (along latitude and longitude) in a cell of the output grid
+        NUM_LATS (int): number of latitudes of the output grid
+        NUM_LONS (int): number of longitudes of the output grid
+
+    Returns:
+        summed (array): output grid (float64 sums or int64 numbers of samples)
+    """
+    if FACTOR == 1:
+        return grid[:NUM_LATS, :NUM_LONS]
+
+    num_lats_pad = -(-grid.shape[0] // FACTOR) * FACTOR
+    num_lons_pad = -(-grid.shape[1] // FACTOR) * FACTOR
+    padded = np.zeros((num_lats_pad, num_lons_pad) + grid.shape[2:], dtype=grid.dtype)
+    padded[:grid.shape[0], :grid.shape[1]] = grid
+
+    blocks = padded.reshape((num_lats_pad // FACTOR, FACTOR, num_lons_pad // FACTOR, FACTOR) + grid.shape[2:])
+    summed = blocks.sum(axis=(1, 3), dtype='int64' if grid.dtype.kind in 'iu' else 'float64')
+    return summed[:NUM_LATS, :NUM_LONS]
+
+
+###
+def coarsen_dataset(ds, BASE_RESOLUTION, SPATIAL_RESOLUTION):
+    """
+    Derive a pyramid level from the dense dataset of an instrument gridded at the base resolution.
+
+    Args:
+        ds (xarray Dataset)       : dense dataset (variables on latitude x longitude [x channel]) at BASE_RESOLUTION
+        BASE_RESOLUTION (float)   : resolution of ds (in degree)
+        SPATIAL_RESOLUTION (float): resolution of the level (in degree)
+
+    Returns:
+        level_ds (xarray Dataset): dense dataset at SPATIAL_RESOLUTION
+    """
+    FACTOR = get_block_factor(BASE_RESOLUTION, SPATIAL_RESOLUTION)
+    if FACTOR == 1:
+        return ds
+
+    NUM_LATS = int(180 / SPATIAL_RESOLUTION)
+    NUM_LONS = int(360 / SPATIAL_RESOLUTION)
+    coords_lats, coords_lons = grid_coords(SPATIAL_RESOLUTION)
+
+    level_ds = xr.Dataset()
+    for name, var in ds.data_vars.items():
+        extra_dims = var.dims[2:]
+        coords = [('latitude', coords_lats), ('longitude', coords_lons)] + [(idim, ds[idim].values) for idim in extra_dims]
+        level_ds[name] = xr.DataArray(block_sum(var.values, FACTOR, NUM_LATS, NUM_LONS), coords=coords)
+    return level_ds
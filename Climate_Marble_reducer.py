@@ -0,0 +1,282 @@
+"""
+Climate Marble@BasicFusion
+
+Reduce the orbit products (sum/num grids of MODIS, MISR and CERES) to daily and monthly means.
+
+The sums and numbers of samples are additive, so the orbit products of a period are streamed one by one
+into an accumulator (only one orbit product and the accumulated grids are in memory),
+the files are split among a pool of processes, and the partial accumulations are added at the end.
+The means are computed from the accumulated sums and numbers (e.g., the monthly mean is not a mean of daily means).
+Both the dense and the sparse orbit formats are read; sparse variables are added to their cells without being expanded.
+"""
+
+import os
+import re
+import datetime
+import numpy as np
+import xarray as xr
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from Climate_Marble_output_functions import pack_dataset, orbit_encoding
+
+
+# (mean, sum, num) variables of the orbit products
+MEAN_VARIABLES = [('MODIS spec rad mean', 'MODIS spec rad sum', 'MODIS spec rad num'),
+                  ('MODIS spec insol mean', 'MODIS spec insol sum', 'MODIS spec rad num'),
+                  ('MISR spec rad mean', 'MISR spec rad sum', 'MISR spec rad num'),
+                  ('CERES SW rad mean', 'CERES SW rad sum', 'CERES SW rad num'),
+                  ('CERES LW rad mean', 'CERES LW rad sum', 'CERES SW rad num')]
+
+PERIODS = ['daily', 'monthly']
+
+
+###
+def parse_orbit_name(orbit_nc):
+    """
+    Orbit number and start time of an orbit product (e.g., CLIMARBLE_O69365_20120603070000_F000_V001.nc).
+
+    Args:
+        orbit_nc (str): path of the orbit product
+
+    Returns:
+        iorbit (int)             : orbit number
+        start_time (datetime)    : start time of the orbit
+    """
+    match = re.search(r'_O(\d+)_(\d{14})_', os.path.basename(orbit_nc))
+    if match is None:
+        raise ValueError("cannot parse the orbit and time of {}".format(orbit_nc))
+    return int(match.group(1)), datetime.datetime.strptime(match.group(2), '%Y%m%d%H%M%S')
+
+
+###
+def get_period_key(orbit_nc, PERIOD='monthly'):
+    """
+    Day ('YYYYMMDD') or month ('YYYYMM') of the start time of an orbit product.
+
+    Args:
+        orbit_nc (str)         : path (or name) of the orbit product
+        PERIOD (str, optional) : 'daily' or 'monthly'
+
+    Returns:
+        period_key (str): day or month of the orbit
+    """
+    if PERIOD not in PERIODS:
+        raise ValueError("PERIOD should be one of {}".format(PERIODS))
+
+    iorbit, start_time = parse_orbit_name(orbit_nc)
+    return start_time.strftime('%Y%m%d' if PERIOD == 'daily' else '%Y%m')
+
+
+###
+def group_orbit_files(orbit_ncs, PERIOD='monthly'):
+    """
+    Group the orbit products by day ('YYYYMMDD') or month ('YYYYMM') of their start time.
+
+    Args:
+        orbit_ncs (list)       : paths of the orbit products
+        PERIOD (str, optional) : 'daily' or 'monthly'
+
+    Returns:
+        groups (dict): period key -> sorted paths of the orbit products
+    """
+    groups = {}
+    for orbit_nc in sorted(orbit_ncs):
+        groups.setdefault(get_period_key(orbit_nc, PERIOD), []).append(orbit_nc)
+    return groups
+
+
+###
+class OrbitAccumulator(object):
+    """
+    Additive accumulator of orbit products.
+
+    Sums are accumulated in float64 and numbers of samples in int64 on the dense grid (latitude x longitude [x channel]).
+
+    Attributes:
+        grids (dict)     : variable name -> accumulated dense array
+        dims (dict)      : variable name -> dimensions of the dense array
+        coords (dict)    : dimension -> coordinate values (latitude, longitude and channels)
+        orbit_ncs (list) : orbit products added to the accumulator
+    """
+
+    def __init__(self):
+        self.grids = {}
+        self.dims = {}
+        self.coords = {}
+        self.orbit_ncs = []
+
+    def _grid(self, name, dims, shape, kind):
+        # dense array of a variable (created at the first orbit having it)
+        if name not in self.grids:
+            self.grids[name] = np.zeros(shape, dtype='int64' if kind in 'iu' else 'float64')
+            self.dims[name] = dims
+        elif self.grids[name].shape != shape:
+            raise ValueError("{} has shape {} instead of {}".format(name, shape, self.grids[name].shape))
+        return self.grids[name]
+
+    def _check_coords(self, ds, dims):
+        for idim in dims:
+            if idim not in self.coords:
+                self.coords[idim] = ds[idim].values
+            elif not np.array_equal(self.coords[idim], ds[idim].values):
+                raise ValueError("{} coordinates differ from the accumulated ones".format(idim))
+
+    def add_dataset(self, ds):
+        """
+        Add an orbit dataset (dense or sparse variables, as written by write_orbit_product).
+        """
+        NUM_LATS = ds.sizes['latitude']
+        NUM_LONS = ds.sizes['longitude']
+        self._check_coords(ds, ['latitude', 'longitude'])
+
+        for name, var in ds.data_vars.items():
+            if var.dims[0].endswith('_cell'):
+                # sparse: cells are unique, so they can be added with fancy indexing
+                extra_dims = var.dims[1:]
+                self._check_coords(ds, extra_dims)
+                grid = self._grid(name, ('latitude', 'longitude') + extra_dims, (NUM_LATS, NUM_LONS) + var.shape[1:], var.dtype.kind)
+                cells = ds[var.dims[0]].values
+                grid.reshape((NUM_LATS*NUM_LONS,) + var.shape[1:])[cells] += var.values
+            else:
+                self._check_coords(ds, var.dims[2:])
+                grid = self._grid(name, var.dims, var.shape, var.dtype.kind)
+                grid += var.values
+
+    def add_file(self, orbit_nc):
+        """
+        Add an orbit product (netCDF file, dense or sparse). Stored values are read as is (0 for no sample).
+        """
+        with xr.open_dataset(orbit_nc, mask_and_scale=False) as ds:
+            self.add_dataset(ds)
+        self.orbit_ncs.append(orbit_nc)
+
+    def merge(self, other):
+        """
+        Add the accumulated grids of another accumulator (e.g., from another process).
+        """
+        for idim, values in other.coords.items():
+            if idim in self.coords and not np.array_equal(self.coords[idim], values):
+                raise ValueError("{} coordinates differ from the accumulated ones".format(idim))
+            self.coords[idim] = values
+
+        for name, grid in other.grids.items():
+            self._grid(name, other.dims[name], grid.shape, grid.dtype.kind)[...] += grid
+        self.orbit_ncs.extend(other.orbit_ncs)
+
+    def to_dataset(self, MEANS=True):
+        """
+        Accumulated sums, numbers of samples and means (NaN where there is no sample).
+
+        Args:
+            MEANS (bool, optional): add the means to the sums and numbers of samples
+
+        Returns:
+            ds (xarray Dataset): accumulated dataset on latitude x longitude [x channel]
+        """
+        ds = xr.Dataset()
+        for name in self.grids:
+            ds[name] = xr.DataArray(self.grids[name], dims=self.dims[name],
+                                    coords={idim: self.coords[idim] for idim in self.dims[name]})
+
+        for mean_name, sum_name, num_name in MEAN_VARIABLES:
+            if MEANS and sum_name in self.grids and num_name in self.grids:
+                num = self.grids[num_name]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean = np.where(num > 0, self.grids[sum_name] / num, np.nan)
+                ds[mean_name] = xr.DataArray(mean, dims=self.dims[sum_name], coords=ds[sum_name].coords)
+
+        ds.attrs['number_of_orbits'] = len(self.orbit_ncs)
+        return ds
+
+
+###
+def accumulate_orbit_files(orbit_ncs):
+    """
+    Accumulate orbit products one by one (worker of reduce_orbit_files).
+
+    Args:
+        orbit_ncs (list): paths of the orbit products
+
+    Returns:
+        accumulator (OrbitAccumulator): accumulated orbit products
+    """
+    accumulator = OrbitAccumulator()
+    for orbit_nc in orbit_ncs:
+        try:
+            accumulator.add_file(orbit_nc)
+        except (IOError, OSError, KeyError) as e:
+            print (">> IOError( cannot read {}: {} )".format(orbit_nc, e))
+    return accumulator
+
+
+###
+def reduce_orbit_files(orbit_ncs, NUM_WORKERS=4):
+    """
+    Accumulate orbit products with a pool of processes.
+
+    The files are split into NUM_WORKERS interleaved parts, each process accumulates its part
+    (so at most NUM_WORKERS accumulators are in memory) and the partial accumulations are merged.
+
+    Args:
+        orbit_ncs (list)           : paths of the orbit products
+        NUM_WORKERS (int, optional): number of processes (1 to accumulate in the current process)
+
+    Returns:
+        accumulator (OrbitAccumulator): accumulated orbit products
+    """
+    NUM_WORKERS = max(1, min(NUM_WORKERS, len(orbit_ncs)))
+    if NUM_WORKERS == 1:
+        return accumulate_orbit_files(orbit_ncs)
+
+    parts = [orbit_ncs[iworker::NUM_WORKERS] for iworker in range(NUM_WORKERS)]
+    accumulator = OrbitAccumulator()
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        for partial in executor.map(accumulate_orbit_files, parts):
+            accumulator.merge(partial)
+    return accumulator
+
+
+###
+def main_reduce(orbit_ncs, output_folder, PERIOD='monthly', NUM_WORKERS=4, COMPLEVEL=4):
+    """
+    Generate the daily or monthly Climate Marble files (sums, numbers of samples and means) from orbit products.
+
+    Args:
+        orbit_ncs (list)           : paths of the orbit products
+        output_folder (str)        : folder storing the daily/monthly results
+        PERIOD (str, optional)     : 'daily' or 'monthly'
+        NUM_WORKERS (int, optional): number of processes reading the orbit products
+        COMPLEVEL (int, optional)  : zlib compression level (0 for no compression)
+
+    Returns:
+        period_ncs (list): paths of the daily/monthly files (e.g., CLIMARBLE_MONTHLY_201206.nc)
+    """
+    period_ncs = []
+    for period_key, period_orbit_ncs in sorted(group_orbit_files(orbit_ncs, PERIOD).items()):
+        accumulator = reduce_orbit_files(period_orbit_ncs, NUM_WORKERS)
+        if len(accumulator.orbit_ncs) == 0:
+            print (">> IOError( no orbit product for {} )".format(period_key))
+            continue
+
+        period_ds = accumulator.to_dataset()
+        period_ds = pack_dataset(period_ds)
+        period_nc = os.path.join(output_folder, 'CLIMARBLE_{}_{}.nc'.format(PERIOD.upper(), period_key))
+        encoding = orbit_encoding(period_ds, COMPLEVEL=COMPLEVEL)
+        for mean_name, sum_name, num_name in MEAN_VARIABLES:
+            if mean_name in encoding:
+                encoding[mean_name]['_FillValue'] = np.nan
+        period_ds.to_netcdf(period_nc, 'w', engine='netcdf4', encoding=encoding)
+
+        print (">> {} {}: {} orbits -> {}".format(PERIOD, period_key, len(accumulator.orbit_ncs), period_nc))
+        period_ncs.append(period_nc)
+    return period_ncs
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Reduce orbit products to daily/monthly means")
+    parser.add_argument("orbit_ncs", nargs='+', help="Orbit products (CLIMARBLE_O*.nc)")
+    parser.add_argument("-o", dest='output_folder', default='', help="Output folder")
+    parser.add_argument("--period", dest='period', choices=PERIODS, default='monthly')
+    parser.add_argument("--workers", dest='workers', type=int, default=4, help="Number of processes")
+    args = parser.parse_args()
+    main_reduce(args.orbit_ncs, args.output_folder, PERIOD=args.period, NUM_WORKERS=args.workers)
@@ -0,0 +1,87 @@
+"""
+S3 helpers for the orbit products.
+
+The orbit products are serialized in memory and streamed to S3 with a multipart upload,
+so the workers do not need local disk space for the products.
+"""
+
+import io
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+
+MB = 1024 ** 2
+
+
+###
+def get_s3_client(endpoint_url=None):
+    """
+    S3 client, optionally on another endpoint (e.g., a local S3 stand-in such as moto_server or minio).
+
+    Args:
+        endpoint_url (str, optional): S3 endpoint URL (None for AWS)
+
+    Returns:
+        s3_client (boto3 client): S3 client
+    """
+    return boto3.client('s3', endpoint_url=endpoint_url)
+
+
+###
+class BufferReader(io.RawIOBase):
+    """
+    Read-only file object over an in-memory buffer (bytes or memoryview), without copying it as io.BytesIO does,
+    so an upload only holds the product and the parts being sent.
+
+    Args:
+        data (bytes or memoryview): content of the file
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data).cast('B')
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        num = max(0, min(len(buffer), len(self.view) - self.position))
+        buffer[:num] = self.view[self.position:self.position+num]
+        self.position += num
+        return num
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = len(self.view) + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+###
+def upload_bytes(s3_client, data, bucket_name, key, PART_SIZE_MB=8, MAX_CONCURRENCY=4, METADATA=None):
+    """
+    Upload an in-memory file to S3 with a multipart upload (a single PUT if it fits in one part).
+
+    Args:
+        s3_client (boto3 client)    : S3 client
+        data (bytes or memoryview)  : content of the file
+        bucket_name (str)           : S3 bucket
+        key (str)                   : S3 key of the file
+        PART_SIZE_MB (int, optional): size of the parts of the multipart upload (in MB, at least 5)
+        MAX_CONCURRENCY (int, optional): number of parts uploaded concurrently
+        METADATA (dict, optional)   : user metadata of the S3 object (e.g., the processing parameters)
+    """
+    PART_SIZE = max(5, PART_SIZE_MB) * MB
+    config = TransferConfig(multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE,
+                            max_concurrency=MAX_CONCURRENCY, use_threads=MAX_CONCURRENCY > 1)
+    extra_args = {'Metadata': METADATA} if METADATA else None
+    s3_client.upload_fileobj(BufferReader(data), bucket_name, key, Config=config, ExtraArgs=extra_args)
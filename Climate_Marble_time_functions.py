@@ -0,0 +1,112 @@
+"""
+Vectorized time conversion for the basic fusion (BF) product.
+
+MODIS granule names, MISR BlockCenterTime and CERES Time_of_observation are all compared in julian date.
+The functions here convert whole arrays at once (through numpy datetime64) instead of one element at a time,
+so that the three instruments share one consistent conversion.
+"""
+
+import numpy as np
+
+
+###
+def datetime64_to_jd(dt):
+    """
+    Convert datetime64 values to julian date.
+
+    The julian date is built from the calendar components in the same order as julian.to_jd(dt, fmt='jd'),
+    so both give the same floating point result.
+
+    Args:
+        dt (datetime64 array): times to convert
+
+    Returns:
+        jd (float64 array): julian date
+    """
+    dt = np.asarray(dt, dtype='datetime64[us]')
+    days = dt.astype('datetime64[D]')
+    jdn = (days - np.datetime64('1970-01-01', 'D')).astype('int64') + 2440588
+
+    usec = (dt - days).astype('int64')
+    hr = usec // 3600000000
+    mn = usec // 60000000 % 60
+    sec = usec // 1000000 % 60
+    usec = usec % 1000000
+
+    jd = jdn + (hr - 12) / 24 + mn / 1440 + sec / 86400 + usec / 86400000000
+    return jd
+
+
+###
+def isotime_to_jd(times):
+    """
+    Convert ISO times (e.g., MISR BlockCenterTime b'2012-06-03T07:34:23.000532Z') to julian date.
+
+    Fill times with a zero year (b'0000-00-00T00:00:00.000000Z') are masked and returned as 0.
+    Variable-length strings (object arrays of bytes or str, as read by h5py) are converted to fixed-width str first.
+
+    Args:
+        times (bytes or str array): ISO times
+
+    Returns:
+        jd (float64 array): julian date (0 for fill times)
+    """
+    times = np.asarray(times)
+    if times.dtype.kind == 'O':
+        times = np.array([itime.decode('ascii') if isinstance(itime, bytes) else str(itime) for itime in times.ravel()],
+                         dtype='U').reshape(times.shape)
+    elif times.dtype.kind == 'S':
+        times = times.astype('U')
+
+    valid = times.astype('U4') != '0000'
+
+    jd = np.zeros(times.shape)
+    jd[valid] = datetime64_to_jd(np.char.rstrip(times[valid], 'Z').astype('datetime64[us]'))
+    return jd
+
+
+###
+def granuletime_to_jd(mod_granule_string, offset_mins=0):
+    """
+    Convert MODIS granule strings (e.g., 'granule_2012155_0700') to julian date (e.g., 2456081.7916666665)
+
+    Args:
+        mod_granule_string (str or str array): MODIS granule string(s)
+        offset_mins (int, optional)         : offset minutes
+
+    Returns:
+        jd (float or float64 array): julian date
+    """
+    names = np.asarray(mod_granule_string, dtype='U')
+    scalar = names.ndim == 0
+    names = np.atleast_1d(names)
+
+    # right-justify so that the trailing 'YYYYDDD_HHMM' is aligned, then read its digits
+    names = np.char.rjust(names, names.dtype.itemsize // 4)
+    digits = names.view('uint32').reshape(len(names), -1)[:, -12:].astype('int64') - ord('0')
+    yr = digits[:, 0:4] @ [1000, 100, 10, 1]
+    doy = digits[:, 4:7] @ [100, 10, 1]
+    hr = digits[:, 8:10] @ [10, 1]
+    mn = digits[:, 10:12] @ [10, 1]
+
+    dt = (yr - 1970).astype('datetime64[Y]').astype('datetime64[m]') + \
+        ((doy - 1) * 1440 + hr * 60 + mn + offset_mins).astype('timedelta64[m]')
+    jd = datetime64_to_jd(dt)
+    if scalar:
+        jd = jd[0]
+    return jd
+
+
+###
+def jd_window_mask(jd, julian_bound):
+    """
+    Select the times within a julian time bound (both ends included).
+
+    Args:
+        jd (float array)     : julian date
+        julian_bound (array) : first/last julian date of the window
+
+    Returns:
+        mask (bool array): True for the times in the window
+    """
+    return (jd >= julian_bound[0]) & (jd <= julian_bound[1])
@@ -0,0 +1,60 @@
+"""
+Climate Marble@BasicFusion
+
+Run the gridders of the pre-series code (main_bf_MODIS, main_bf_MISR and main_bf_CERES of the baseline commit)
+on a BF file and write their orbit netCDF file, to be compared with the current gridders by run_benchmarks.py.
+
+The pre-series modules have the same names as the current ones, so this script runs in its own process with
+the folder of a checkout of the baseline commit first in sys.path, e.g.:
+
+    git worktree add /tmp/climarble-legacy eea145e
+    python benchmarks/legacy_gridders.py /tmp/climarble-legacy TERRA_BF_L1B_O69365_20120603070000_F000_V001.h5 /tmp/legacy-out
+
+Usage:
+    python benchmarks/legacy_gridders.py <legacy code folder> <BF file> <output folder>
+"""
+
+import os
+import sys
+import h5py
+
+
+class LegacyFile(h5py.File):
+    """
+    Local BF file opened with h5py, with the h5pyd fid attribute read by the pre-series gridders for the output name.
+    """
+
+    @property
+    def fid(self):
+        return self.id
+
+
+###
+def run_legacy_gridders(bf_file, output_folder, SPATIAL_RESOLUTION=0.5, VZA_MAX=18):
+    """
+    Grid an orbit with the pre-series gridders (MODIS writes the netCDF file, MISR and CERES append to it).
+
+    Args:
+        bf_file (str)                       : BF file path
+        output_folder (str)                 : folder of the orbit netCDF file
+        SPATIAL_RESOLUTION (float, optional): spatial resolution of the grid (in degree)
+        VZA_MAX (int, optional)             : maximum viewing zenith angle considered (in degree)
+
+    Returns:
+        orbit_nc_out (str): path of the orbit netCDF file
+    """
+    from Climate_Marble_basicfusion_MODIS import main_bf_MODIS
+    from Climate_Marble_basicfusion_MISR import main_bf_MISR
+    from Climate_Marble_basicfusion_CERES import main_bf_CERES
+
+    with LegacyFile(bf_file, 'r') as h5f:
+        orbit_nc_out = main_bf_MODIS(h5f, output_folder, SPATIAL_RESOLUTION, VZA_MAX)
+        main_bf_MISR(h5f, output_folder, SPATIAL_RESOLUTION, VZA_MAX)
+        main_bf_CERES(h5f, output_folder, SPATIAL_RESOLUTION, VZA_MAX)
+    return orbit_nc_out
+
+
+if __name__ == "__main__":
+    legacy_folder, bf_file, output_folder = sys.argv[1:4]
+    sys.path.insert(0, os.path.abspath(legacy_folder))
+    print(run_legacy_gridders(os.path.abspath(bf_file), output_folder))
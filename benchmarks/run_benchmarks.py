@@ -0,0 +1,410 @@
+"""
+Climate Marble@BasicFusion
+
+Benchmarks of the gridding stages on a synthetic basic fusion (BF) file (see synthetic_bf.py, no network needed).
+
+Each stage is timed (best of --repeat runs) and reported with its throughput (input samples per second) and its
+peak memory (numpy/python allocations traced by tracemalloc in a separate run). The results of each stage are
+reduced to a digest (sums and counts of the outputs) and compared with the baselines stored in baselines.json
+for the same size of the synthetic orbit: a different digest (or, with --max-slowdown, a throughput below the
+baseline) is reported as a regression and the script exits with a non-zero status.
+
+The digests of the MODIS, MISR and CERES stages are also compared with the legacy references, the digests of the
+pre-series gridders (see legacy_gridders.py) on the same synthetic orbit, within the tolerances of LEGACY_RTOL.
+The legacy references are computed with --legacy-code (a checkout of the baseline commit) and stored by
+--update-baseline, so that the gridders are checked for equivalence with the pre-series code, not only for drift.
+
+Stages:
+    descending       : OrbitContext (descending MODIS granules, julian bound and MISR blocks)
+    latslons_to_idxs : lat/lon indexes of a MODIS granule (0.5 and 2.5 degree grids)
+    sort             : legacy fortran kernel (full granule arrays with the indexes of the valid samples)
+    accumulate       : fortran kernel used by the gridders (compacted valid samples)
+    MODIS, MISR, CERES: main_bf_MODIS, main_bf_MISR and main_bf_CERES (descending node given)
+    orbit            : main_bf_orbit (3 gridders and the netCDF product in memory)
+
+Usage:
+    python benchmarks/run_benchmarks.py                       # compare with the baselines
+    python benchmarks/run_benchmarks.py --update-baseline     # store the results as the baselines
+    git worktree add /tmp/climarble-legacy eea145e
+    python benchmarks/run_benchmarks.py --update-baseline --legacy-code /tmp/climarble-legacy   # and the legacy references
+    python benchmarks/run_benchmarks.py --granules 2 --lines 1000 --stages MODIS accumulate --max-slowdown 1.5
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+import h5py
+import netCDF4
+from argparse import ArgumentParser
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_FOLDER))
+
+from synthetic_bf import make_synthetic_bf, add_size_arguments, get_size_params
+from Climate_Marble_common_functions import latslons_to_idxs, OrbitContext
+from Climate_Marble_basicfusion_MODIS import main_bf_MODIS, read_modis_granule
+from Climate_Marble_basicfusion_MISR import main_bf_MISR
+from Climate_Marble_basicfusion_CERES import main_bf_CERES
+from Climate_Marble_basicfusion_orbit import main_bf_orbit
+from sample2grid_sw import sort, accumulate
+
+
+BASELINE_FILE = os.path.join(BENCHMARK_FOLDER, 'baselines.json')
+SPATIAL_RESOLUTION = 0.5
+VZA_MAX = 18
+NUM_CHAN = 7
+# relative tolerance of the float sums (the integer counts should be the same)
+RTOL = 1e-5
+
+# stages compared with the pre-series gridders, and relative tolerances of their digests (exact when not listed):
+# the MODIS sums are accumulated in float32 by a different kernel, which rounds some cells by about 1 ulp
+# (up to 7e-7 of the cell), and the insolation is gridded as cos(SZA) and scaled by the channel coefficient
+# afterwards instead of per sample (up to 2e-6 of the cell); the MISR and CERES sums are the same.
+LEGACY_STAGES = ['MODIS', 'MISR', 'CERES']
+LEGACY_RTOL = {'MODIS spec rad sum sum': 1e-6, 'MODIS spec insol sum sum': 1e-5}
+
+
+###
+def array_digest(name, data):
+    """
+    Sum and number of non-zero values of an array (the sum of an integer array is an int, compared exactly).
+    """
+    data = np.asarray(data)
+    if np.issubdtype(data.dtype, np.integer):
+        data_sum = int(np.sum(data, dtype='int64'))
+    else:
+        data_sum = float(np.nansum(data, dtype='float64'))
+    return {name + ' sum': data_sum, name + ' nonzero': int(np.count_nonzero(data))}
+
+
+###
+def dataset_digest(ds):
+    """
+    Digest of the data variables of a gridded dataset (None if the gridder has no result).
+    """
+    digest = {}
+    if ds is None:
+        return digest
+    for name in sorted(ds.data_vars):
+        digest.update(array_digest(name, ds[name].values))
+    return digest
+
+
+###
+def netcdf_digest(orbit_nc_out):
+    """
+    Digest of the variables of an in-memory orbit product (see main_bf_orbit).
+    """
+    digest = {}
+    with netCDF4.Dataset('orbit.nc', mode='r', memory=bytes(orbit_nc_out)) as nc:
+        for group in [nc] + list(nc.groups.values()):
+            for name, variable in sorted(group.variables.items()):
+                if name not in group.dimensions:
+                    digest.update(array_digest('{}/{}'.format(group.path, name), np.ma.filled(variable[:], 0)))
+    return digest
+
+
+###
+def get_legacy_digests(legacy_folder, bf_file):
+    """
+    Run the pre-series gridders on a BF file (in a separate process, see legacy_gridders.py) and digest their results.
+
+    Args:
+        legacy_folder (str): folder of a checkout of the pre-series code
+        bf_file (str)      : BF file path
+
+    Returns:
+        legacy_digests (dict): stage name ('MODIS', 'MISR' or 'CERES') -> digest of the gridded variables
+    """
+    legacy_digests = {name: {} for name in LEGACY_STAGES}
+    with tempfile.TemporaryDirectory() as output_folder:
+        subprocess.run([sys.executable, os.path.join(BENCHMARK_FOLDER, 'legacy_gridders.py'), legacy_folder, bf_file, \
+            output_folder], stdout=subprocess.DEVNULL, check=True)
+        orbit_nc_out = os.path.join(output_folder, os.listdir(output_folder)[0])
+        with netCDF4.Dataset(orbit_nc_out, mode='r') as nc:
+            for name, variable in sorted(nc.variables.items()):
+                if name not in nc.dimensions:
+                    legacy_digests[name.split()[0]].update(array_digest(name, np.ma.filled(variable[:], 0)))
+    return legacy_digests
+
+
+###
+def get_kernel_inputs(h5f, igranule):
+    """
+    Inputs of the fortran kernels for a MODIS granule, prepared as in main_bf_MODIS (legacy layout for sort).
+    """
+    lats, lons, sza, vza, mdata, rad_scales, ref_scales = read_modis_granule(h5f, igranule)
+    NUM_POINTS = 1 / SPATIAL_RESOLUTION
+    NUM_LATS = int(180 / SPATIAL_RESOLUTION)
+    NUM_LONS = int(360 / SPATIAL_RESOLUTION)
+    lats_idx, lons_idx = latslons_to_idxs(lats, lons, NUM_POINTS)
+    cosine_sza = np.cos(np.deg2rad(sza))
+    valid_y, valid_x = np.where((sza>=0)&(sza<=89.0)&(vza>=0)&(vza<VZA_MAX)&(lats>-999)&(lons>-999)& \
+                                (lats_idx>=0)&(lats_idx<NUM_LATS)&(lons_idx>=0)&(lons_idx<NUM_LONS))
+    coeffs = (rad_scales / ref_scales)[:NUM_CHAN]
+    rads_max = (32767 * rad_scales[:NUM_CHAN]).astype('float32')
+
+    inputs = {'NUM_LATS': NUM_LATS, 'NUM_LONS': NUM_LONS, 'rads_max': rads_max, 'lats': lats, 'lons': lons}
+
+    # legacy layout: lines x 1354 (x channels) arrays and the indexes of the valid samples
+    inputs['sort'] = {'valid_x': valid_x.astype('int32'), 'valid_y': valid_y.astype('int32'),
+                      'lats': np.asfortranarray(lats, dtype='float32'), 'lons': np.asfortranarray(lons, dtype='float32'),
+                      'idx_lats': np.asfortranarray(lats_idx), 'idx_lons': np.asfortranarray(lons_idx),
+                      'rads': np.asfortranarray(np.moveaxis(mdata, 0, -1), dtype='float32'),
+                      'sols': np.asfortranarray(cosine_sza[:, :, None] * coeffs, dtype='float32')}
+
+    # compacted layout: valid samples x channels
+    inputs['accumulate'] = {'idx_lats': lats_idx[valid_y, valid_x], 'idx_lons': lons_idx[valid_y, valid_x],
+                            'rads': np.asfortranarray(mdata[:, valid_y, valid_x].T, dtype='float32'),
+                            'sols': cosine_sza[valid_y, valid_x].astype('float32'),
+                            'sol_scales': np.ones(NUM_CHAN, dtype='float32')}
+    return inputs
+
+
+###
+def get_stages(h5f):
+    """
+    Stages of the benchmark, with their inputs read from the BF file (outside of the timed runs).
+
+    Args:
+        h5f (hdf5 instance): instance of a synthetic BF file
+
+    Returns:
+        stages (dict): stage name -> (number of input samples, function returning the digest of the results)
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        orbit = OrbitContext(h5f)
+    if len(orbit.modis_granules) == 0:
+        raise ValueError("no descending MODIS granule in {}".format(h5f.filename))
+    inputs = get_kernel_inputs(h5f, orbit.modis_granules[0])
+    NUM_LATS, NUM_LONS, rads_max = inputs['NUM_LATS'], inputs['NUM_LONS'], inputs['rads_max']
+
+    def run_descending():
+        iorbit = OrbitContext(h5f)
+        return {'granules': len(iorbit.modis_granules), 'misr blocks': int(np.sum(iorbit.misr_blocks + 1)),
+                'julian bound sum': float(np.sum(iorbit.julian_bound))}
+
+    def run_latslons_to_idxs(IDX_RESOLUTION):
+        def run():
+            lats_idx, lons_idx = latslons_to_idxs(inputs['lats'], inputs['lons'], 1 / IDX_RESOLUTION)
+            return {'lats_idx sum': int(np.sum(lats_idx, dtype='int64')), 'lons_idx sum': int(np.sum(lons_idx, dtype='int64'))}
+        return run
+
+    def run_sort():
+        kernel = inputs['sort']
+        cumu_insol, cumu_rad = [np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='float32', order='F') for i in range(2)]
+        cumu_num = np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='int32', order='F')
+        sum_insol, sum_radiance, sum_num = sort(NUM_CHAN, NUM_LATS, NUM_LONS, len(kernel['valid_x']), \
+            kernel['valid_x'], kernel['valid_y'], kernel['lats'].shape[0], kernel['lats'], kernel['lons'], \
+            kernel['idx_lats'], kernel['idx_lons'], kernel['rads'], kernel['sols'], rads_max, cumu_insol, cumu_rad, cumu_num)
+        return dict(array_digest('radiance', sum_radiance), **array_digest('num', sum_num))
+
+    def run_accumulate():
+        kernel = inputs['accumulate']
+        sum_insol, sum_radiance = [np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='float32', order='F') for i in range(2)]
+        sum_num = np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='int32', order='F')
+        accumulate(NUM_CHAN, NUM_LATS, NUM_LONS, len(kernel['idx_lats']), kernel['idx_lats'], kernel['idx_lons'], \
+            kernel['rads'], kernel['sols'], rads_max, kernel['sol_scales'], sum_insol, sum_radiance, sum_num)
+        return dict(array_digest('radiance', sum_radiance), **array_digest('num', sum_num))
+
+    # number of input samples of each stage
+    modis_samples = sum(h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(igranule)].size for igranule in h5f['MODIS'])
+    descending_samples = sum(h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(igranule)].size for igranule in orbit.modis_granules)
+    misr_samples = len(orbit.misr_blocks) * int(np.prod(h5f['MISR/Geolocation/GeoLatitude'].shape[1:]))
+    ceres_samples = sum(h5f['CERES/{}/FM1/Time_and_Position/Time_of_observation'.format(igranule)].size for igranule in h5f['CERES'])
+    granule_samples = inputs['lats'].size
+    valid_samples = len(inputs['accumulate']['idx_lats'])
+
+    stages = {
+        'descending': (modis_samples, run_descending),
+        'latslons_to_idxs': (granule_samples, run_latslons_to_idxs(SPATIAL_RESOLUTION)),
+        'latslons_to_idxs_2.5deg': (granule_samples, run_latslons_to_idxs(2.5)),
+        'sort': (valid_samples, run_sort),
+        'accumulate': (valid_samples, run_accumulate),
+        'MODIS': (descending_samples, lambda: dataset_digest(main_bf_MODIS(h5f, SPATIAL_RESOLUTION, VZA_MAX, orbit=orbit))),
+        'MISR': (misr_samples, lambda: dataset_digest(main_bf_MISR(h5f, SPATIAL_RESOLUTION, VZA_MAX, orbit=orbit))),
+        'CERES': (ceres_samples, lambda: dataset_digest(main_bf_CERES(h5f, SPATIAL_RESOLUTION, VZA_MAX, orbit=orbit))),
+        'orbit': (descending_samples + misr_samples + ceres_samples,
+                  lambda: netcdf_digest(main_bf_orbit(h5f, None, SPATIAL_RESOLUTION, VZA_MAX, orbit=orbit))),
+    }
+    return stages
+
+
+###
+def run_stage(function, REPEAT=3):
+    """
+    Time a stage and measure its peak memory (the prints of the gridders are discarded).
+
+    Args:
+        function (callable)   : stage, returning the digest of its results
+        REPEAT (int, optional): number of timed runs
+
+    Returns:
+        digest (dict)     : digest of the results (of the first run)
+        best_time (float) : best time of the timed runs (in seconds)
+        peak_mb (float)   : peak of the traced allocations (in MB)
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # the allocations are traced in a separate (untimed) run, tracemalloc slows down python code
+        tracemalloc.start()
+        digest = function()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024.**2
+        tracemalloc.stop()
+
+        times = []
+        for irepeat in range(REPEAT):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return digest, min(times), peak_mb
+
+
+###
+def compare_digests(digest, reference, RTOLS=None, reference_name='the baseline'):
+    """
+    Compare a digest with a reference digest (integers exactly, floats within a relative tolerance).
+
+    Args:
+        digest (dict)                 : digest of the results
+        reference (dict)              : reference digest
+        RTOLS (dict, optional)        : relative tolerance of each float (exact when not listed), RTOL for all by default
+        reference_name (str, optional): name of the reference in the errors
+
+    Returns:
+        errors (list): descriptions of the differences (empty if none)
+    """
+    errors = []
+    for name in sorted(set(digest) | set(reference)):
+        if name not in digest or name not in reference:
+            errors.append("{} is {}".format(name, 'missing' if name not in digest else 'not in ' + reference_name))
+        elif isinstance(reference[name], int) and digest[name] != reference[name]:
+            errors.append("{} {} != {}".format(name, digest[name], reference[name]))
+        elif not np.isclose(digest[name], reference[name], rtol=RTOL if RTOLS is None else RTOLS.get(name, 0), atol=0):
+            errors.append("{} {!r} != {!r} ({})".format(name, digest[name], reference[name], reference_name))
+    return errors
+
+
+###
+def compare_stage(result, baseline, MAX_SLOWDOWN=None):
+    """
+    Compare the result of a stage with its baseline.
+
+    Args:
+        result (dict)                : samples, digest and samples_per_second of the stage
+        baseline (dict)              : same, stored in baselines.json
+        MAX_SLOWDOWN (float, optional): fail when the throughput is MAX_SLOWDOWN times lower than the baseline
+
+    Returns:
+        errors (list): descriptions of the regressions (empty if none)
+    """
+    errors = []
+    if result['samples'] != baseline['samples']:
+        errors.append("samples {} != {}".format(result['samples'], baseline['samples']))
+
+    errors += compare_digests(result['digest'], baseline['digest'])
+
+    if MAX_SLOWDOWN is not None and result['samples_per_second'] * MAX_SLOWDOWN < baseline['samples_per_second']:
+        errors.append("throughput {:.3g} samples/s < {:.3g} / {:g}".format(result['samples_per_second'], \
+            baseline['samples_per_second'], MAX_SLOWDOWN))
+    return errors
+
+
+###
+def get_baseline_key(size_params):
+    """
+    Key of the baselines of a synthetic orbit size (e.g., 'NUM_CERES_FOOTPRINTS=6000,...,SEED=0').
+    """
+    return ','.join('{}={}'.format(name, size_params[name]) for name in sorted(size_params))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Benchmark the gridders on a synthetic basic fusion file")
+    add_size_arguments(parser)
+    parser.add_argument("--folder", dest='folder', default=None, help="Folder of the synthetic BF file (a temporary folder by default)")
+    parser.add_argument("--stages", dest='stages', nargs='+', default=None, help="Stages to run (all by default)")
+    parser.add_argument("--repeat", dest='repeat', type=int, default=3, help="Number of timed runs of each stage")
+    parser.add_argument("--max-slowdown", dest='max_slowdown', type=float, default=None,
+                        help="Fail when a throughput is this factor lower than the baseline (only the results are checked by default)")
+    parser.add_argument("--baseline", dest='baseline', default=BASELINE_FILE, help="JSON file of the baselines")
+    parser.add_argument("--update-baseline", dest='update_baseline', action='store_true',
+                        help="Store the results as the baselines of this size")
+    parser.add_argument("--legacy-code", dest='legacy_code', default=None,
+                        help="Folder of a checkout of the pre-series code (baseline commit), to compute the legacy references of the gridders")
+    args = parser.parse_args()
+
+    size_params = get_size_params(args)
+    baseline_key = get_baseline_key(size_params)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    size_baselines = baselines.get(baseline_key, {})
+    legacy_digests = size_baselines.get('legacy', {})
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        folder = args.folder if args.folder is not None else tmp_folder
+        os.makedirs(folder, exist_ok=True)
+        start = time.perf_counter()
+        bf_file = make_synthetic_bf(folder, **size_params)
+        print(">> Synthetic( {} in {:.1f} s )".format(bf_file, time.perf_counter() - start))
+
+        if args.legacy_code is not None:
+            start = time.perf_counter()
+            legacy_digests = get_legacy_digests(args.legacy_code, bf_file)
+            print(">> Legacy( gridders of {} in {:.1f} s )".format(args.legacy_code, time.perf_counter() - start))
+
+        with h5py.File(bf_file, 'r') as h5f:
+            stages = get_stages(h5f)
+            stage_names = args.stages if args.stages is not None else list(stages)
+            unknown_stages = [name for name in stage_names if name not in stages]
+            if len(unknown_stages) > 0:
+                parser.error("unknown stages {} (from {})".format(unknown_stages, list(stages)))
+
+            print("{:<24}{:>12}{:>12}{:>14}{:>12}  {}".format('stage', 'samples', 'best (s)', 'samples/s', 'peak (MB)', 'check'))
+            results, regressions = {}, {}
+            for name in stage_names:
+                samples, function = stages[name]
+                digest, best_time, peak_mb = run_stage(function, args.repeat)
+                results[name] = {'samples': samples, 'digest': digest, 'best_time': round(best_time, 4),
+                                 'samples_per_second': round(samples / best_time), 'peak_mb': round(peak_mb, 1)}
+
+                # the baselines are replaced by --update-baseline, the legacy references are always checked
+                errors = []
+                if args.update_baseline:
+                    check = 'stored'
+                elif name in size_baselines:
+                    errors += compare_stage(results[name], size_baselines[name], args.max_slowdown)
+                    check = 'ok'
+                else:
+                    check = 'no baseline'
+                if name in legacy_digests:
+                    errors += compare_digests(digest, legacy_digests[name], LEGACY_RTOL, 'the legacy reference')
+                    check += ', legacy ok'
+                if len(errors) > 0:
+                    check = 'REGRESSION'
+                    regressions[name] = errors
+                print("{:<24}{:>12}{:>12.4f}{:>14.4g}{:>12.1f}  {}".format(name, samples, best_time, \
+                    samples / best_time, peak_mb, check))
+
+    if len(regressions) > 0:
+        for name, errors in regressions.items():
+            for error in errors:
+                print(">> RegressionError( {}: {} )".format(name, error))
+        sys.exit(1)
+
+    if args.update_baseline:
+        baselines[baseline_key] = dict(size_baselines, **results)
+        if len(legacy_digests) > 0:
+            baselines[baseline_key]['legacy'] = legacy_digests
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print(">> Baseline( {} stages of {} written to {} )".format(len(results), baseline_key, args.baseline))
+    elif len(size_baselines) == 0:
+        print(">> BaselineError( no baseline for {} in {}, run with --update-baseline )".format(baseline_key, args.baseline))
@@ -0,0 +1,212 @@
+"""
+Climate Marble@BasicFusion
+
+Synthetic basic fusion (BF) files for the benchmarks (no network needed).
+
+The files follow the layout read by the gridders:
+    MODIS/granule_YYYYDDD_HHMM/_1KM/Geolocation/{Latitude, Longitude}
+    MODIS/granule_YYYYDDD_HHMM/{SolarZenith, SensorZenith}
+    MODIS/granule_YYYYDDD_HHMM/_1KM/Data_Fields/{EV_250_Aggr1km_RefSB, EV_500_Aggr1km_RefSB} (radiance/reflectance scales)
+    MISR/{CAMERA}/BlockCenterTime, MISR/{CAMERA}/Data_Fields/{Blue, Green, Red, NIR}_Radiance,
+    MISR/{CAMERA}/Sensor_Geometry/{Camera}Zenith, MISR/Solar_Geometry/SolarZenith, MISR/Geolocation/{GeoLatitude, GeoLongitude}
+    CERES/{granule}/FM1/{Time_and_Position, Radiances, Viewing_Angles}/...
+The orbit is a descending track (about 18 degrees of latitude per 5-min MODIS granule) preceded by one ascending granule,
+with MISR blocks and CERES footprints timed along the same track, fill values (-999 lat/lon, -992 MODIS and negative
+MISR radiances, a fill BlockCenterTime) and the MODIS/MISR/CERES QC cases (sza/vza ranges, CERES scan modes).
+The content is drawn from a seeded random generator, so a file is reproducible from its parameters.
+
+Usage:
+    python benchmarks/synthetic_bf.py output_folder --granules 4 --lines 2030 --misr-blocks 24 --ceres-footprints 6000
+"""
+
+import os
+import datetime
+import numpy as np
+import h5py
+from argparse import ArgumentParser
+
+
+MODIS_COLUMNS = 1354
+MODIS_FIELDS = [('EV_250_Aggr1km_RefSB', 2), ('EV_500_Aggr1km_RefSB', 5)]
+MISR_BANDS = ['Blue', 'Green', 'Red', 'NIR']
+MISR_GEOMETRY_SHAPE = (8, 32)
+MISR_BLOCK_SHAPE = (128, 512)
+MISR_BLOCK_SECONDS = 33
+GRANULE_MINUTES = 5
+LATITUDE_PER_GRANULE = 18.
+
+
+###
+def julian_date(dt):
+    """
+    Julian date of a datetime (e.g., CERES Time_of_observation).
+    """
+    return (dt - datetime.datetime(1970, 1, 1)).total_seconds() / 86400. + 2440587.5
+
+
+###
+def get_bf_file_name(ORBIT=69365, START_TIME=datetime.datetime(2012, 6, 3, 7, 0)):
+    """
+    Name of a BF file (e.g., TERRA_BF_L1B_O69365_20120603070000_F000_V001.h5).
+    """
+    return 'TERRA_BF_L1B_O{}_{}_F000_V001.h5'.format(ORBIT, START_TIME.strftime('%Y%m%d%H%M%S'))
+
+
+###
+def track_latitude(minutes):
+    """
+    Latitude of the descending track (80N at the end of the ascending granule) after some minutes.
+    """
+    return 80. - LATITUDE_PER_GRANULE * (minutes - GRANULE_MINUTES) / GRANULE_MINUTES
+
+
+###
+def write_modis(h5f, rng, START_TIME, NUM_GRANULES, NUM_LINES):
+    for igranule in range(NUM_GRANULES):
+        granule_time = START_TIME + datetime.timedelta(minutes=GRANULE_MINUTES * igranule)
+        granule = 'granule_{}{:03d}_{:02d}{:02d}'.format(granule_time.year, granule_time.timetuple().tm_yday,
+                                                         granule_time.hour, granule_time.minute)
+        group = h5f.create_group('MODIS/' + granule)
+
+        # the first granule is ascending (it is omitted by the descending-node check)
+        line_lats = track_latitude(GRANULE_MINUTES * (igranule + np.linspace(0, 1, NUM_LINES)))
+        if igranule == 0:
+            line_lats = line_lats[::-1]
+        line_lats = np.clip(line_lats, -89.9, 89.9)
+        lats = line_lats[:, None] + np.linspace(-0.05, 0.05, MODIS_COLUMNS)[None, :] + rng.normal(0, 0.001, (NUM_LINES, MODIS_COLUMNS))
+        lons = np.linspace(-10, 10, MODIS_COLUMNS)[None, :] - 1.25 * igranule + np.zeros((NUM_LINES, 1))
+        lats = lats.astype('float32')
+        lons = ((lons + 180) % 360 - 180).astype('float32')
+        lats[5, 7] = -999
+        lons[9, 11] = -999
+
+        group['_1KM/Geolocation/Latitude'] = lats
+        group['_1KM/Geolocation/Longitude'] = lons
+        group['SolarZenith'] = rng.uniform(0, 95, (NUM_LINES, MODIS_COLUMNS)).astype('float32')
+        group['SensorZenith'] = rng.uniform(0, 65, (NUM_LINES, MODIS_COLUMNS)).astype('float32')
+
+        for field, num_bands in MODIS_FIELDS:
+            rads = rng.uniform(-10, 700, (num_bands, NUM_LINES, MODIS_COLUMNS)).astype('float32')
+            rads[rads < 0] = -992
+            dset = group.create_dataset('_1KM/Data_Fields/' + field, data=rads)
+            dset.attrs['radiance_scales'] = rng.uniform(0.01, 0.03, num_bands).astype('float32')
+            dset.attrs['reflectance_scales'] = rng.uniform(0.00005, 0.0001, num_bands).astype('float32')
+
+
+###
+def write_misr(h5f, rng, START_TIME, NUM_BLOCKS, CAMERAS, FULL_RES_BANDS):
+    block_times = []
+    for iblock in range(NUM_BLOCKS):
+        if iblock == 3:
+            block_times.append(b'0000-00-00T00:00:00.000000Z')
+        else:
+            block_time = START_TIME + datetime.timedelta(seconds=MISR_BLOCK_SECONDS * iblock + 0.000532)
+            block_times.append(block_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ').encode())
+
+    # block center latitudes follow the track
+    block_minutes = MISR_BLOCK_SECONDS * np.arange(NUM_BLOCKS) / 60.
+    lats = np.empty((NUM_BLOCKS,) + MISR_BLOCK_SHAPE, dtype='float32')
+    lons = np.empty((NUM_BLOCKS,) + MISR_BLOCK_SHAPE, dtype='float32')
+    for iblock in range(NUM_BLOCKS):
+        center = np.clip(track_latitude(block_minutes[iblock]), -88, 88)
+        lats[iblock] = np.linspace(center + 1.2, center - 1.2, MISR_BLOCK_SHAPE[0])[:, None] + np.zeros((1, MISR_BLOCK_SHAPE[1]))
+        lons[iblock] = np.linspace(-3, 3, MISR_BLOCK_SHAPE[1])[None, :] - 0.25 * block_minutes[iblock]
+    lats[:, 0, 0] = -9999
+    h5f['MISR/Geolocation/GeoLatitude'] = lats
+    h5f['MISR/Geolocation/GeoLongitude'] = lons
+
+    szas = rng.uniform(20, 95, (NUM_BLOCKS,) + MISR_GEOMETRY_SHAPE)
+    szas[min(5, NUM_BLOCKS-1), 2, 2] = -111
+    h5f['MISR/Solar_Geometry/SolarZenith'] = szas
+
+    for camera in CAMERAS:
+        h5f['MISR/{}/BlockCenterTime'.format(camera)] = np.array(block_times, dtype='S28')
+        for band in MISR_BANDS:
+            block_shape = (512, 2048) if band in FULL_RES_BANDS else MISR_BLOCK_SHAPE
+            rads = rng.uniform(-20, 400, (NUM_BLOCKS,) + block_shape).astype('float32')
+            rads[rads < 0] = -555
+            h5f['MISR/{}/Data_Fields/{}_Radiance'.format(camera, band)] = rads
+        vza_name = ''.join(c.lower() if i == 1 else c for i, c in enumerate(camera))
+        h5f['MISR/{}/Sensor_Geometry/{}Zenith'.format(camera, vza_name)] = rng.uniform(0, 30, (NUM_BLOCKS,) + MISR_GEOMETRY_SHAPE)
+
+
+###
+def write_ceres(h5f, rng, START_TIME, NUM_GRANULES, NUM_CERES_GRANULES, NUM_FOOTPRINTS):
+    orbit_minutes = GRANULE_MINUTES * NUM_GRANULES
+    for igranule in range(NUM_CERES_GRANULES):
+        group = h5f.create_group('CERES/CER_SSF_Terra-FM1-MODIS_{:02d}/FM1'.format(igranule))
+
+        # each CERES granule covers a part of the orbit (and a few minutes before/after it)
+        start = orbit_minutes * igranule / NUM_CERES_GRANULES - 2
+        minutes = np.sort(rng.uniform(start, start + orbit_minutes / NUM_CERES_GRANULES + 4, NUM_FOOTPRINTS))
+        times = julian_date(START_TIME) + minutes / 1440.
+
+        group['Time_and_Position/Time_of_observation'] = times
+        group['Time_and_Position/Latitude'] = np.clip(track_latitude(minutes) + rng.normal(0, 5, NUM_FOOTPRINTS), -89.9, 89.9).astype('float32')
+        group['Time_and_Position/Longitude'] = rng.uniform(-40, 40, NUM_FOOTPRINTS).astype('float32')
+        group['Radiances/SW_Radiance'] = rng.uniform(-5, 400, NUM_FOOTPRINTS).astype('float32')
+        group['Radiances/LW_Radiance'] = rng.uniform(-5, 1200, NUM_FOOTPRINTS).astype('float32')
+        group['Radiances/Radiance_Mode_Flags'] = rng.integers(0, 3, NUM_FOOTPRINTS).astype('int32')
+        group['Viewing_Angles/Solar_Zenith'] = rng.uniform(0, 95, NUM_FOOTPRINTS).astype('float32')
+        group['Viewing_Angles/Viewing_Zenith'] = rng.uniform(0, 65, NUM_FOOTPRINTS).astype('float32')
+
+
+###
+def make_synthetic_bf(output_folder, NUM_GRANULES=4, NUM_LINES=2030, NUM_MISR_BLOCKS=24, NUM_CERES_GRANULES=2,
+                      NUM_CERES_FOOTPRINTS=6000, CAMERAS=['AN'], FULL_RES_BANDS=['Red'], ORBIT=69365,
+                      START_TIME=datetime.datetime(2012, 6, 3, 7, 0), SEED=0):
+    """
+    Write a synthetic BF file.
+
+    Args:
+        output_folder (str)                 : folder of the BF file
+        NUM_GRANULES (int, optional)        : number of 5-min MODIS granules (the first one is ascending)
+        NUM_LINES (int, optional)           : number of lines of a MODIS granule (2030 or 2040 in real granules)
+        NUM_MISR_BLOCKS (int, optional)     : number of MISR blocks
+        NUM_CERES_GRANULES (int, optional)  : number of CERES granules
+        NUM_CERES_FOOTPRINTS (int, optional): number of footprints of a CERES granule
+        CAMERAS (list, optional)            : MISR cameras
+        FULL_RES_BANDS (list, optional)     : MISR bands at 275 m (512 x 2048 blocks), the others at 1.1 km
+        ORBIT (int, optional)               : orbit number (in the file name)
+        START_TIME (datetime, optional)     : start time of the orbit (in the file name)
+        SEED (int, optional)                : seed of the random content
+
+    Returns:
+        bf_file (str): path of the BF file
+    """
+    rng = np.random.default_rng(SEED)
+    bf_file = os.path.join(output_folder, get_bf_file_name(ORBIT, START_TIME))
+    with h5py.File(bf_file, 'w') as h5f:
+        write_modis(h5f, rng, START_TIME, NUM_GRANULES, NUM_LINES)
+        write_misr(h5f, rng, START_TIME, NUM_MISR_BLOCKS, CAMERAS, FULL_RES_BANDS)
+        write_ceres(h5f, rng, START_TIME, NUM_GRANULES, NUM_CERES_GRANULES, NUM_CERES_FOOTPRINTS)
+    return bf_file
+
+
+def add_size_arguments(parser):
+    """
+    Command line arguments of the size of the synthetic orbit (shared with run_benchmarks.py).
+    """
+    parser.add_argument("--granules", dest='granules', type=int, default=4, help="Number of MODIS granules")
+    parser.add_argument("--lines", dest='lines', type=int, default=2030, help="Number of lines of a MODIS granule")
+    parser.add_argument("--misr-blocks", dest='misr_blocks', type=int, default=24, help="Number of MISR blocks")
+    parser.add_argument("--ceres-granules", dest='ceres_granules', type=int, default=2, help="Number of CERES granules")
+    parser.add_argument("--ceres-footprints", dest='ceres_footprints', type=int, default=6000,
+                        help="Number of footprints of a CERES granule")
+    parser.add_argument("--seed", dest='seed', type=int, default=0, help="Seed of the random content")
+
+
+def get_size_params(args):
+    """
+    Keyword arguments of make_synthetic_bf from the command line arguments.
+    """
+    return {'NUM_GRANULES': args.granules, 'NUM_LINES': args.lines, 'NUM_MISR_BLOCKS': args.misr_blocks,
+            'NUM_CERES_GRANULES': args.ceres_granules, 'NUM_CERES_FOOTPRINTS': args.ceres_footprints, 'SEED': args.seed}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Write a synthetic basic fusion file")
+    parser.add_argument("output_folder", help="Folder of the BF file")
+    add_size_arguments(parser)
+    args = parser.parse_args()
+    print(make_synthetic_bf(args.output_folder, **get_size_params(args)))
@@ -0,0 +1,73 @@
+"""
+Climate Marble@BasicFusion
+
+The tests import the Climate_Marble_* modules (and benchmarks/synthetic_bf.py) from the repository,
+and grid a small synthetic BF orbit shared by the tests (synthetic_bf fixture).
+The reducer and the composites are tested on random orbit products (orbit_products fixture).
+"""
+
+import os
+import sys
+import h5py
+import numpy as np
+import pytest
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_FOLDER)
+sys.path.insert(0, os.path.join(REPO_FOLDER, 'benchmarks'))
+
+from synthetic_bf import make_synthetic_bf
+from Climate_Marble_output_functions import grid_dataset, write_orbit_product
+
+# orbits of two days of June 2012 and one of July 2012
+ORBIT_NAMES = ['CLIMARBLE_O69365_20120603070000_F000_V001.nc', 'CLIMARBLE_O69366_20120603084000_F000_V001.nc',
+               'CLIMARBLE_O69380_20120604073000_F000_V001.nc', 'CLIMARBLE_O69810_20120701071000_F000_V001.nc']
+
+
+@pytest.fixture(scope='session')
+def synthetic_bf(tmp_path_factory):
+    """
+    Small synthetic BF orbit (an ascending and two descending MODIS granules), opened with h5py.
+    """
+    bf_file = make_synthetic_bf(str(tmp_path_factory.mktemp('bf')), NUM_GRANULES=3, NUM_LINES=1200, \
+                                NUM_MISR_BLOCKS=24, NUM_CERES_FOOTPRINTS=3000)
+    with h5py.File(bf_file, 'r') as h5f:
+        yield h5f
+
+
+def random_orbit_datasets(rng, SPATIAL_RESOLUTION=5.):
+    """
+    MODIS and CERES datasets of an orbit touching random cells, with integer sums (exact in float32 and in any order).
+    """
+    NUM_LATS = int(180 / SPATIAL_RESOLUTION)
+    NUM_LONS = int(360 / SPATIAL_RESOLUTION)
+    touched = rng.uniform(size=(NUM_LATS, NUM_LONS)) < 0.2
+
+    rad_num = np.where(touched[:, :, None], rng.integers(1, 50, (NUM_LATS, NUM_LONS, 7)), 0).astype('int32')
+    rad_sum = np.where(rad_num > 0, rng.integers(1, 1000, rad_num.shape), 0).astype('float64')
+    insol_sum = np.where(rad_num > 0, rng.integers(1, 1000, rad_num.shape), 0).astype('float64')
+    sw_num = np.where(touched, rng.integers(1, 50, touched.shape), 0).astype('int32')
+    sw_sum = np.where(touched, rng.integers(1, 1000, touched.shape), 0).astype('float64')
+    lw_sum = np.where(touched, rng.integers(1, 1000, touched.shape), 0).astype('float64')
+    return {'modis': grid_dataset({'MODIS spec rad sum': rad_sum, 'MODIS spec rad num': rad_num,
+                                   'MODIS spec insol sum': insol_sum}, SPATIAL_RESOLUTION, 'modis_channel'),
+            'ceres': grid_dataset({'CERES SW rad sum': sw_sum, 'CERES LW rad sum': lw_sum, 'CERES SW rad num': sw_num},
+                                  SPATIAL_RESOLUTION)}
+
+
+@pytest.fixture(scope='session')
+def orbit_products(tmp_path_factory):
+    """
+    Random orbit products of ORBIT_NAMES, written alternately in the dense and the sparse format.
+    Returns the paths of the products and their instrument datasets.
+    """
+    orbit_folder = str(tmp_path_factory.mktemp('orbits'))
+    rng = np.random.default_rng(0)
+    orbit_ncs = []
+    orbit_datasets = []
+    for iorbit, orbit_name in enumerate(ORBIT_NAMES):
+        instrument_datasets = random_orbit_datasets(rng)
+        orbit_ncs.append(write_orbit_product(instrument_datasets, os.path.join(orbit_folder, orbit_name),
+                                             OUTPUT_FORMAT=['dense', 'sparse'][iorbit % 2]))
+        orbit_datasets.append(instrument_datasets)
+    return orbit_ncs, orbit_datasets
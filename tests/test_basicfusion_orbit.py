@@ -0,0 +1,55 @@
+"""
+The QC configurations gridded from a single read of the orbit (grid_orbit_configs, list parameters of the gridders)
+give the datasets of one gridder call per configuration.
+"""
+
+import pytest
+import xarray as xr
+from Climate_Marble_common_functions import OrbitContext, expand_configs
+from Climate_Marble_basicfusion_orbit import grid_orbit_configs
+from Climate_Marble_basicfusion_MODIS import main_bf_MODIS
+from Climate_Marble_basicfusion_MISR import main_bf_MISR
+from Climate_Marble_basicfusion_CERES import main_bf_CERES
+
+# VZA thresholds of a sensitivity study, with both CERES modes (the synthetic orbit has the VIS category and the AN camera)
+CONFIGS = [{'VZA_MAX': 18, 'CATEGORY': 'VIS', 'CAMERA': 'AN', 'MODE': 'ct'},
+           {'VZA_MAX': 30, 'CATEGORY': 'VIS', 'CAMERA': 'AN', 'MODE': 'ct'},
+           {'VZA_MAX': 18, 'CATEGORY': 'VIS', 'CAMERA': 'AN', 'MODE': 'all'},
+           {'VZA_MAX': 40, 'CATEGORY': 'VIS', 'CAMERA': 'AN', 'MODE': 'all'}]
+
+
+@pytest.fixture(scope='module')
+def orbit(synthetic_bf):
+    return OrbitContext(synthetic_bf)
+
+
+def single_config_datasets(h5f, config, orbit):
+    # one call of each gridder with the parameters of the configuration
+    return {'modis': main_bf_MODIS(h5f, VZA_MAX=config['VZA_MAX'], CATEGORY=config['CATEGORY'], orbit=orbit),
+            'misr': main_bf_MISR(h5f, VZA_MAX=config['VZA_MAX'], CAMERA=config['CAMERA'], orbit=orbit),
+            'ceres': main_bf_CERES(h5f, VZA_MAX=config['VZA_MAX'], MODE=config['MODE'], orbit=orbit)}
+
+
+@pytest.mark.parametrize('PARALLELISM', [1, 3])
+def test_grid_orbit_configs_matches_single_config(synthetic_bf, orbit, PARALLELISM):
+    config_datasets = grid_orbit_configs(synthetic_bf, CONFIGS, orbit=orbit, PARALLELISM=PARALLELISM)
+    assert len(config_datasets) == len(CONFIGS)
+
+    for config, instrument_datasets in zip(CONFIGS, config_datasets):
+        expected = single_config_datasets(synthetic_bf, config, orbit)
+        assert sorted(instrument_datasets) == sorted(expected)
+        for instrument, ds in expected.items():
+            xr.testing.assert_identical(instrument_datasets[instrument], ds)
+
+
+@pytest.mark.parametrize('main_bf, SELECT_KEYS', [(main_bf_MODIS, ['VZA_MAX']), (main_bf_MISR, ['VZA_MAX']),
+                                                  (main_bf_CERES, ['VZA_MAX', 'MODE'])])
+def test_list_parameters_match_single_config(synthetic_bf, orbit, main_bf, SELECT_KEYS):
+    select_params = {ikey: [config[ikey] for config in CONFIGS] for ikey in SELECT_KEYS}
+    configs, MULTI = expand_configs(**select_params)
+    assert MULTI and len(configs) == len(CONFIGS)
+
+    datasets = main_bf(synthetic_bf, orbit=orbit, **select_params)
+    assert len(datasets) == len(CONFIGS)
+    for config, ds in zip(configs, datasets):
+        xr.testing.assert_identical(ds, main_bf(synthetic_bf, orbit=orbit, **config))
@@ -0,0 +1,94 @@
+"""
+The np.bincount CERES gridding gives the results of the original per-footprint loop,
+and footprints outside of the grid are dropped instead of wrapped around (lon = -180 is binned into the last column).
+"""
+
+import h5py
+import numpy as np
+import pytest
+from Climate_Marble_common_functions import OrbitContext, latslons_to_idxs
+from Climate_Marble_basicfusion_CERES import main_bf_CERES
+
+
+def legacy_main_bf_CERES(h5f, t0, t1, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, MODE='ct'):
+    # per-footprint loop of the original main_bf_CERES (the gridded sums and numbers are returned instead of written)
+    NUM_POINTS = 1 / SPATIAL_RESOLUTION
+    NUM_LATS = int(180 / SPATIAL_RESOLUTION)
+    NUM_LONS = int(360 / SPATIAL_RESOLUTION)
+    orbit_sw_sum  = np.zeros((NUM_LATS, NUM_LONS))
+    orbit_sw_num  = np.zeros((NUM_LATS, NUM_LONS), dtype='int16')
+    orbit_lw_sum  = np.zeros((NUM_LATS, NUM_LONS))
+
+    for igranule in h5f['CERES']:
+        ssf_time = h5f['CERES/{}/FM1/Time_and_Position/Time_of_observation'.format(igranule)][:]
+        idx_0 = np.where((ssf_time>=t0)&(ssf_time<=t1))[0]
+        if len(idx_0) == 0:
+            continue
+        ssf_sw   = h5f['CERES/{}/FM1/Radiances/SW_Radiance'.format(igranule)][:]
+        ssf_mode = h5f['CERES/{}/FM1/Radiances/Radiance_Mode_Flags'.format(igranule)][:]
+        ssf_lw   = h5f['CERES/{}/FM1/Radiances/LW_Radiance'.format(igranule)][:]
+        ssf_sza  = h5f['CERES/{}/FM1/Viewing_Angles/Solar_Zenith'.format(igranule)][:]
+        ssf_vza  = h5f['CERES/{}/FM1/Viewing_Angles/Viewing_Zenith'.format(igranule)][:]
+
+        if MODE == 'ct':
+            idx_1 = np.where((ssf_sw>0)&(ssf_sw<1000)&(ssf_vza<VZA_MAX)&(ssf_sza<=89.0)&(ssf_mode==0))[0]
+        else:
+            idx_1 = np.where((ssf_sw>0)&(ssf_sw<1000)&(ssf_vza<VZA_MAX)&(ssf_sza<=89.0)&(ssf_lw<1000)&(ssf_lw>0))[0]
+
+        idx = np.intersect1d(idx_0, idx_1)
+        lats = h5f['CERES/{}/FM1/Time_and_Position/Latitude'.format(igranule)][:][idx]
+        lons = h5f['CERES/{}/FM1/Time_and_Position/Longitude'.format(igranule)][:][idx]
+        sw = ssf_sw[idx]
+        lw = ssf_lw[idx]
+
+        lats_idx, lons_idx = latslons_to_idxs(lats, lons, NUM_POINTS)
+        for i, j, isw, ilw in zip(lats_idx, lons_idx, sw, lw):
+            orbit_sw_sum[i, j] += isw
+            orbit_lw_sum[i, j] += ilw
+            orbit_sw_num[i, j] += 1
+    return orbit_sw_sum, orbit_lw_sum, orbit_sw_num
+
+
+@pytest.mark.parametrize('MODE', ['ct', 'all'])
+def test_main_bf_CERES_matches_legacy(synthetic_bf, MODE):
+    orbit = OrbitContext(synthetic_bf)
+    ds = main_bf_CERES(synthetic_bf, MODE=MODE, orbit=orbit)
+    expected_sw_sum, expected_lw_sum, expected_sw_num = legacy_main_bf_CERES(synthetic_bf, *orbit.julian_bound, MODE=MODE)
+
+    assert expected_sw_num.sum() > 0
+    np.testing.assert_array_equal(ds['CERES SW rad num'].values, expected_sw_num)
+    np.testing.assert_array_equal(ds['CERES SW rad sum'].values, expected_sw_sum)
+    np.testing.assert_array_equal(ds['CERES LW rad sum'].values, expected_lw_sum)
+
+
+def test_main_bf_CERES_drops_footprints_outside_of_the_grid(synthetic_bf):
+    orbit = OrbitContext(synthetic_bf)
+    t0 = orbit.julian_bound[0]
+    # footprints on the poles and on the dateline, with fill lat/lon, and one valid footprint in the grid
+    lats = np.array([90, -90, 0, -999, 10, 10.2], dtype='float32')
+    lons = np.array([0, 0, -180, 0, -999, 20.1], dtype='float32')
+    num = len(lats)
+
+    with h5py.File('ceres_edges.h5', 'w', driver='core', backing_store=False) as h5f:
+        group = h5f.create_group('CERES/CER_SSF_Terra-FM1-MODIS_00/FM1')
+        group['Time_and_Position/Time_of_observation'] = np.full(num, t0 + 0.001)
+        group['Time_and_Position/Latitude'] = lats
+        group['Time_and_Position/Longitude'] = lons
+        group['Radiances/SW_Radiance'] = np.full(num, 100, dtype='float32')
+        group['Radiances/LW_Radiance'] = np.full(num, 200, dtype='float32')
+        group['Radiances/Radiance_Mode_Flags'] = np.zeros(num, dtype='int32')
+        group['Viewing_Angles/Solar_Zenith'] = np.full(num, 30, dtype='float32')
+        group['Viewing_Angles/Viewing_Zenith'] = np.full(num, 5, dtype='float32')
+        ds = main_bf_CERES(h5f, orbit=orbit)
+
+    # the indexes of 90N and 180W are -1 and the one of 90S is 360
+    # (the original loop added the first two to the last row/column and failed on the last one),
+    # the footprint on 180W is kept in the last column (the same meridian as 180E)
+    lats_idx, lons_idx = latslons_to_idxs(lats, lons, 2)
+    assert list(lats_idx[:2]) == [-1, 360] and lons_idx[2] == -1
+
+    sw_num = ds['CERES SW rad num'].values
+    assert sw_num.sum() == 2
+    assert sw_num[lats_idx[-1], lons_idx[-1]] == 1
+    assert sw_num[lats_idx[2], -1] == 1
+    assert ds['CERES LW rad sum'].values.sum() == 400
@@ -0,0 +1,96 @@
+"""
+The running composites include each orbit once (ledger), hold the sums of the orbits added so far
+and are updated in place.
+"""
+
+import os
+import netCDF4
+import numpy as np
+import pytest
+from Climate_Marble_composite import CompositeStore
+from Climate_Marble_output_functions import write_orbit_product
+
+
+def check_composite(ds, orbit_datasets):
+    # sums and numbers of the composite are the sums of the orbit datasets
+    assert ds.attrs['number_of_orbits'] == len(orbit_datasets)
+    for name in ds.data_vars:
+        if name.endswith('mean'):
+            continue
+        expected = sum(instrument_datasets[instrument][name].values for instrument_datasets in orbit_datasets
+                       for instrument in instrument_datasets if name in instrument_datasets[instrument])
+        np.testing.assert_array_equal(ds[name].values, expected)
+
+
+def test_add_orbit_twice(orbit_products, tmp_path):
+    orbit_ncs, orbit_datasets = orbit_products
+    store = CompositeStore(str(tmp_path))
+
+    assert not store.has_orbit(orbit_ncs[0])
+    assert store.add_orbit_file(orbit_ncs[0]) == {'daily': True, 'monthly': True}
+    assert store.has_orbit(orbit_ncs[0]) and not store.has_orbit(orbit_ncs[1])
+    # re-delivered orbit, from the file or from the in-memory product
+    assert store.add_orbit_file(orbit_ncs[0]) == {'daily': False, 'monthly': False}
+    assert CompositeStore(str(tmp_path)).add_orbit(os.path.basename(orbit_ncs[0]), orbit_datasets[0]['modis']) == \
+           {'daily': False, 'monthly': False}
+
+    assert store.get_orbits('201206') == [os.path.basename(orbit_ncs[0])]
+    check_composite(store.query('201206'), orbit_datasets[:1])
+    check_composite(store.query('20120603', 'daily'), orbit_datasets[:1])
+
+
+def test_query_partial_month(orbit_products, tmp_path):
+    orbit_ncs, orbit_datasets = orbit_products
+    store = CompositeStore(str(tmp_path))
+    assert store.query('201206') is None
+
+    # orbits finished in arbitrary order
+    for iorbit in [2, 0]:
+        store.add_orbit_file(orbit_ncs[iorbit])
+    check_composite(store.query('201206'), [orbit_datasets[2], orbit_datasets[0]])
+    check_composite(store.query('20120603', 'daily'), orbit_datasets[:1])
+    check_composite(store.query('20120604', 'daily'), orbit_datasets[2:3])
+    assert store.query('201207') is None
+
+    for iorbit in [3, 1]:
+        store.add_orbit_file(orbit_ncs[iorbit])
+    check_composite(store.query('201206'), orbit_datasets[:3])
+    check_composite(store.query('20120603', 'daily'), orbit_datasets[:2])
+    check_composite(store.query('201207'), orbit_datasets[3:])
+    assert sorted(store.get_orbits('201206')) == sorted(os.path.basename(orbit_nc) for orbit_nc in orbit_ncs[:3])
+
+
+def test_add_orbit_in_place(orbit_products, tmp_path):
+    orbit_ncs, orbit_datasets = orbit_products
+    store = CompositeStore(str(tmp_path), PERIODS=['monthly'])
+    composite_nc = store.get_composite_nc('201206')
+
+    # the first orbit creates the accumulator, the next ones are added into its variables
+    store.add_orbit_file(orbit_ncs[0])
+    inode = os.stat(composite_nc).st_ino
+    store.add_orbit_file(orbit_ncs[1])
+    assert os.stat(composite_nc).st_ino == inode
+    check_composite(store.query('201206'), orbit_datasets[:2])
+
+    # a variable missing in the accumulator: the accumulator is rewritten
+    products_folder = str(tmp_path / 'products')
+    os.makedirs(products_folder)
+    orbit_nc = write_orbit_product({'modis': orbit_datasets[2]['modis']}, os.path.join(products_folder, os.path.basename(orbit_ncs[2])))
+    store = CompositeStore(str(tmp_path / 'modis'), PERIODS=['monthly'])
+    store.add_orbit_file(orbit_nc)
+    store.add_orbit_file(orbit_ncs[0])
+    store.add_orbit_file(orbit_ncs[1])
+    check_composite(store.query('201206'), [{'modis': orbit_datasets[2]['modis']}] + orbit_datasets[:2])
+
+
+def test_interrupted_update(orbit_products, tmp_path):
+    orbit_ncs, orbit_datasets = orbit_products
+    store = CompositeStore(str(tmp_path), PERIODS=['monthly'])
+    store.add_orbit_file(orbit_ncs[0])
+    with netCDF4.Dataset(store.get_composite_nc('201206'), 'a') as nc:
+        nc.updating = os.path.basename(orbit_ncs[1])
+
+    with pytest.raises(IOError):
+        store.query('201206')
+    with pytest.raises(IOError):
+        store.add_orbit_file(orbit_ncs[2])
@@ -0,0 +1,91 @@
+"""
+The descending MODIS granules found from the strided latitude are the ones of the full-column rule
+(the per-line loop of the original get_descending), including granules crossing the turn of the orbit.
+"""
+
+import h5py
+import numpy as np
+import pytest
+from Climate_Marble_common_functions import get_descending_granules, count_non_descending_lines
+
+
+MODIS_COLUMNS = 1354
+TERRA_INCLINATION = 98.2
+
+
+def swath_latitude(start_degrees, NUM_LINES=2030, SWATH_KM=2330., GRANULE_DEGREES=18., NOISE=0.001, rng=None):
+    """
+    Latitude of a 5-min MODIS granule on a circular orbit, starting start_degrees along the orbit from the
+    ascending node (90 degrees is the northern turn), with a geolocation noise (in degree).
+    """
+    along = np.deg2rad(start_degrees + GRANULE_DEGREES * np.arange(NUM_LINES) / NUM_LINES)[:, None]
+    cross = np.deg2rad(np.linspace(-SWATH_KM / 2, SWATH_KM / 2, MODIS_COLUMNS) / 111.2)[None, :]
+    inclination = np.deg2rad(TERRA_INCLINATION)
+    z = np.cos(cross) * np.sin(along) * np.sin(inclination) + np.sin(cross) * np.cos(inclination)
+    lats = np.rad2deg(np.arcsin(z))
+    if rng is not None:
+        lats = lats + rng.normal(0, NOISE, lats.shape)
+    return lats.astype('float32')
+
+
+def legacy_is_descending(lats):
+    # per-line rule of the original get_descending (all columns)
+    cnt = 0
+    for i in range(1, len(lats)):
+        if all(lats[i] < lats[i-1]) == False:
+            cnt += 1
+    return cnt < 1000
+
+
+@pytest.mark.parametrize('NOISE', [0.0005, 0.001, 0.005])
+def test_descending_granules_match_full_column_rule(NOISE):
+    rng = np.random.default_rng(0)
+    # granules along the whole orbit, denser around the turns (polar crossings)
+    starts = np.concatenate([np.arange(-100, 280, 20.), np.arange(72, 100, 1.5), np.arange(252, 280, 1.5)])
+    with h5py.File('descending.h5', 'w', driver='core', backing_store=False) as h5f:
+        expected = []
+        for istart, start in enumerate(starts):
+            lats = swath_latitude(start, rng=rng)
+            granule = 'granule_2012155_{:04d}'.format(istart)
+            h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(granule)] = lats
+            if legacy_is_descending(lats):
+                expected.append(granule)
+
+        descending_granules = get_descending_granules(h5f)
+    assert sorted(descending_granules) == sorted(expected)
+    # both ascending and descending granules are tested
+    assert 0 < len(expected) < len(starts)
+
+
+def test_strided_count_is_a_lower_bound():
+    rng = np.random.default_rng(1)
+    for start in np.arange(80, 100, 2.):
+        lats = swath_latitude(start, rng=rng)
+        assert count_non_descending_lines(lats[:, ::451]) <= count_non_descending_lines(lats)
+
+
+
+def test_fill_values_of_the_columns_left_out():
+    # mid-latitude descending granules (no recheck at the poles) with flat lines (not descending in any column)
+    # and 620 lines with fill latitudes in columns left out of the strided read (each adds a non-descending line):
+    # near the threshold the full re-read rejects the granule, far from it a fill value seen in a strided column does
+    lats = swath_latitude(130.)
+    fill_lines = np.arange(700, 1940, 2)
+    cases = {'granule_2012155_0000': (0, False), 'granule_2012155_0005': (300, False),
+             'granule_2012155_0010': (600, False), 'granule_2012155_0015': (400, True)}
+    with h5py.File('descending_fill.h5', 'w', driver='core', backing_store=False) as h5f:
+        expected = []
+        for granule, (num_flat, strided_fill) in cases.items():
+            granule_lats = lats.copy()
+            granule_lats[1:num_flat+1] = granule_lats[0]
+            granule_lats[np.ix_(fill_lines, [10, 500, 1000])] = -999
+            if strided_fill:
+                granule_lats[1960:1980:2, 451] = -999
+            h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(granule)] = granule_lats
+            if legacy_is_descending(granule_lats):
+                expected.append(granule)
+            assert count_non_descending_lines(granule_lats[:, ::451]) == num_flat + 10 * strided_fill
+
+        descending_granules = get_descending_granules(h5f)
+    assert sorted(descending_granules) == sorted(expected)
+    assert sorted(expected) == ['granule_2012155_0000', 'granule_2012155_0005']
@@ -0,0 +1,305 @@
+"""
+The prefetch pipeline yields the items in order with the results (or exceptions) of their reads,
+and stops reading ahead when it is closed.
+The read cache returns the reads of the file they were read from, evicts the least recently used entries,
+and is shared by several processes.
+The file pool opens the HSDS files on one bounded session per endpoint and credentials (fake h5pyd connections).
+"""
+
+import os
+import contextlib
+import multiprocessing
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+import pytest
+import requests
+from Climate_Marble_io_functions import PrefetchPipeline, ReadCache, CachedFile, FilePool
+
+
+def delayed_read(delays, calls):
+    def read_func(item):
+        calls.append(item)
+        time.sleep(delays[item])
+        if item == 'error':
+            raise ValueError(item)
+        return item * 10
+    return read_func
+
+
+@pytest.mark.parametrize('depth', [1, 2, 5])
+def test_prefetch_pipeline_order(depth):
+    # later items are read faster
+    items = list(range(6))
+    delays = {item: 0.02 * (len(items) - item) for item in items}
+    calls = []
+    pipeline = PrefetchPipeline(delayed_read(delays, calls), items, depth)
+
+    assert [(item, future.result()) for item, future in pipeline] == [(item, item * 10) for item in items]
+    assert calls == items
+    assert len(pipeline.queue_depths) == len(items)
+
+
+def test_prefetch_pipeline_read_error():
+    items = [1, 'error', 3]
+    pipeline = PrefetchPipeline(delayed_read({1: 0, 'error': 0, 3: 0}, []), items, 2)
+
+    results = []
+    for item, future in pipeline:
+        try:
+            results.append(future.result())
+        except ValueError as error:
+            results.append(str(error))
+    # the error of an item is raised by its future, the next items are read
+    assert results == [10, 'error', 30]
+
+
+def test_prefetch_pipeline_close():
+    items = list(range(6))
+    calls = []
+    pipeline = PrefetchPipeline(delayed_read({item: 0 if item == 0 else 0.2 for item in items}, calls), items, 2)
+
+    with pytest.raises(RuntimeError):
+        with contextlib.closing(iter(pipeline)) as granules:
+            for item, future in granules:
+                future.result()
+                raise RuntimeError('gridding error')
+    # the read in progress is completed and the queued ones are cancelled
+    time.sleep(0.3)
+    assert calls == [0, 1]
+
+
+def test_prefetch_pipeline_stats():
+    items = list(range(6))
+    delays = {item: 0.05 for item in items}
+
+    # slow reads: the consumer waits for each item
+    pipeline = PrefetchPipeline(delayed_read(delays, []), items, 2)
+    for item, future in pipeline:
+        pass
+    assert pipeline.stall_time > 0.2
+    assert max(pipeline.queue_depths) <= 1
+
+    # slow consumer: the items are read ahead up to the depth
+    pipeline = PrefetchPipeline(delayed_read({item: 0 for item in items}, []), items, 2)
+    for item, future in pipeline:
+        time.sleep(0.05)
+    assert pipeline.stall_time < 0.05
+    assert pipeline.queue_depths[1:] == [2] * (len(items) - 2) + [1]
+    assert str(pipeline).startswith('6 items, depth 2')
+
+
+class CountingFile(object):
+    # h5py file counting the accesses to its objects
+    def __init__(self, h5f):
+        self.h5f = h5f
+        self.num_reads = 0
+
+    def __getitem__(self, path):
+        self.num_reads += 1
+        return self.h5f[path]
+
+    def __getattr__(self, name):
+        return getattr(self.h5f, name)
+
+
+def make_bf_file(bf_file, value):
+    with h5py.File(bf_file, 'w') as h5f:
+        h5f['MODIS/granule_2012155_0700/SolarZenith'] = np.full((20, 10), value, dtype='float32')
+        h5f['MODIS/granule_2012155_0700/SolarZenith'].attrs['scale_factor'] = np.float32(0.01)
+        h5f['MODIS/granule_2012155_0705/SolarZenith'] = np.zeros((20, 10), dtype='float32')
+    return bf_file
+
+
+def test_cached_file_hits_and_misses(tmp_path):
+    bf_file = make_bf_file(str(tmp_path / 'TERRA_BF_L1B_O69365_20120603070000_F000_V001.h5'), 1.)
+    cache = ReadCache(str(tmp_path / 'cache'))
+
+    for ipass in range(2):
+        with h5py.File(bf_file, 'r') as h5f:
+            counting_file = CountingFile(h5f)
+            cached_file = CachedFile(counting_file, cache)
+            np.testing.assert_array_equal(cached_file['MODIS/granule_2012155_0700/SolarZenith'][2:5, ::2], 1.)
+            assert cached_file['MODIS/granule_2012155_0700/SolarZenith'].attrs['scale_factor'] == np.float32(0.01)
+            assert [name for name, node in cached_file['MODIS'].items()] == ['granule_2012155_0700', 'granule_2012155_0705']
+            # the second pass is read from the cache only
+            assert counting_file.num_reads == (3 if ipass == 0 else 0)
+    assert (cache.misses, cache.hits) == (3, 3)
+
+    # other selections are other entries
+    with h5py.File(bf_file, 'r') as h5f:
+        cached_file = CachedFile(h5f, cache)
+        assert cached_file['MODIS/granule_2012155_0700/SolarZenith'][2:6, ::2].shape == (4, 5)
+        assert cached_file['MODIS/granule_2012155_0700/SolarZenith'][:].shape == (20, 10)
+    assert (cache.misses, cache.hits) == (5, 3)
+
+
+def test_cached_files_with_the_same_name(tmp_path):
+    # files with the same name in different folders are different files
+    bf_name = 'TERRA_BF_L1B_O69365_20120603070000_F000_V001.h5'
+    cache = ReadCache(str(tmp_path / 'cache'))
+    for value in [1., 2.]:
+        os.makedirs(str(tmp_path / str(value)))
+        bf_file = make_bf_file(str(tmp_path / str(value) / bf_name), value)
+        with h5py.File(bf_file, 'r') as h5f:
+            np.testing.assert_array_equal(CachedFile(h5f, cache)['MODIS/granule_2012155_0700/SolarZenith'][:], value)
+    assert cache.hits == 0
+
+
+def test_read_cache_lru_eviction(tmp_path):
+    data = np.zeros(1000)
+    cache = ReadCache(str(tmp_path))
+    cache.store('a0', data)
+    entry_size = cache.total_bytes
+    cache = ReadCache(str(tmp_path), MAX_BYTES=3*entry_size)
+
+    for key in ['a1', 'a2']:
+        cache.store(key, data)
+    # a0 is used, a1 is the least recently used entry
+    assert cache.load('a0') is not None
+    cache.store('a3', data)
+    assert cache.total_bytes == 3*entry_size
+    assert cache.load('a1') is None
+    assert not os.path.exists(cache._entry_path('a1', '.npy'))
+    for key in ['a0', 'a2', 'a3']:
+        assert cache.load(key) is not None
+
+    # the index is rebuilt in the order of the last uses
+    time.sleep(0.01)
+    cache.load('a2')
+    cache = ReadCache(str(tmp_path), MAX_BYTES=2*entry_size)
+    cache.store('a4', data)
+    assert [cache.load(key) is not None for key in ['a0', 'a2', 'a3', 'a4']] == [False, True, False, True]
+
+
+def test_read_cache_write_is_atomic(tmp_path, monkeypatch):
+    cache = ReadCache(str(tmp_path))
+
+    def failing_save(entry_file, data, allow_pickle=False):
+        entry_file.write(b'partial entry')
+        raise ValueError('write error')
+    monkeypatch.setattr(np, 'save', failing_save)
+    cache.store('a0', np.zeros(1000))
+    monkeypatch.undo()
+
+    # no partial entry nor temporary file
+    assert cache.load('a0') is None
+    assert [ifile for root, dirs, files in os.walk(str(tmp_path)) for ifile in files] == []
+    assert cache.total_bytes == 0
+
+
+def store_entries(cache_folder, keys):
+    cache = ReadCache(cache_folder)
+    for key in keys:
+        cache.store(key, np.full(1000, int(key[1:])))
+
+
+def test_read_cache_shared_by_processes(tmp_path):
+    cache_folder = str(tmp_path)
+    cache = ReadCache(cache_folder)
+    keys = ['a{}'.format(i) for i in range(20)]
+
+    # processes writing the same entries at once
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=store_entries, args=(cache_folder, keys)) for iprocess in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    # the entries written by the other processes are hit (and indexed) by the existing cache and by a new one
+    for key in keys:
+        np.testing.assert_array_equal(cache.load(key), int(key[1:]))
+    assert cache.hits == len(keys) and cache.total_bytes == ReadCache(cache_folder).total_bytes
+    assert not any('.tmp' in ifile for root, dirs, files in os.walk(cache_folder) for ifile in files)
+
+
+class FakeHttpConn(object):
+    # HttpConn of h5pyd: its own session (_s), closed with the file
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self._s = requests.Session()
+
+    def close(self):
+        if self._s:
+            self._s.close()
+            self._s = None
+
+
+class FakeFile(object):
+    # h5pyd.File, with the connection in the file id (h5pyd 0.x)
+    def __init__(self, domain, mode, username=None, password=None, endpoint=None):
+        self.filename = domain
+        self.id = types.SimpleNamespace(http_conn=FakeHttpConn(endpoint))
+
+    def close(self):
+        self.id.http_conn.close()
+
+
+@pytest.fixture
+def closed_sessions(monkeypatch):
+    closed = []
+    session_close = requests.Session.close
+    def close(session):
+        closed.append(session)
+        session_close(session)
+    monkeypatch.setattr(requests.Session, 'close', close)
+    return closed
+
+
+def test_file_pool_one_session_per_endpoint(closed_sessions):
+    fake_h5pyd = types.SimpleNamespace(File=FakeFile)
+    endpoints = [('http://hsds-a', 'user', 'pass'), ('http://hsds-b', 'user', 'pass'), ('http://hsds-a', 'other', 'pass')]
+    jobs = [(iorbit, endpoints[iorbit % 3]) for iorbit in range(12)]
+
+    with FilePool(fake_h5pyd, MAX_CONNECTIONS=4, RETRIES=2) as pool:
+        def open_file(job):
+            iorbit, (endpoint, username, password) = job
+            with pool.open('/home/user/orbit{}.h5'.format(iorbit), endpoint, username, password) as h5f:
+                http_conn = h5f.id.http_conn
+                session = http_conn._s
+                time.sleep(0.01)
+            # the shared session is detached before the file is closed
+            assert http_conn._s is None and session not in closed_sessions
+            return session
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            sessions = list(executor.map(open_file, jobs))
+
+        # one session per endpoint and credentials, the sessions of the files are closed
+        assert len(set(sessions)) == 3
+        for (iorbit, endpoint), session in zip(jobs, sessions):
+            assert session is pool.sessions[endpoint]
+        assert (pool.num_opened, pool.num_sessions, pool.num_shared) == (12, 3, 9)
+        assert len(closed_sessions) == 12 and not set(sessions) & set(closed_sessions)
+
+        # bounded connection pool, blocking when all connections are in use
+        for session in pool.sessions.values():
+            for prefix in ['http://', 'https://']:
+                adapter = session.get_adapter(prefix + 'hsds')
+                assert adapter._pool_maxsize == 4 and adapter._pool_block
+                assert adapter.max_retries.total == 2
+                assert adapter.poolmanager.connection_pool_kw['maxsize'] == 4
+                assert adapter.poolmanager.connection_pool_kw['block']
+    assert pool.sessions == {}
+    assert set(sessions) <= set(closed_sessions)
+
+
+def test_file_pool_keeps_the_own_sessions(closed_sessions):
+    class LocalFile(FakeFile):
+        def __init__(self, domain, mode, endpoint=None, **kwargs):
+            # a connection without the private session attribute
+            self.filename = domain
+            self.id = types.SimpleNamespace(http_conn=types.SimpleNamespace(endpoint=endpoint, close=lambda: None))
+
+    for h5py_module, endpoint in [(types.SimpleNamespace(File=FakeFile), 'http+unix://%2Ftmp%2Fhs%2Fsn_1.sock'),
+                                  (types.SimpleNamespace(File=LocalFile), 'http://hsds')]:
+        with FilePool(h5py_module) as pool:
+            with pool.open('/home/user/orbit.h5', endpoint) as h5f:
+                session = getattr(h5f.id.http_conn, '_s', None)
+            assert pool.num_sessions == 0 and pool.sessions == {}
+            if session is not None:
+                assert session in closed_sessions
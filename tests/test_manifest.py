@@ -0,0 +1,94 @@
+"""
+The pre-flight check skips a job only when its products exist in S3 (a moto mock) with the same parameters,
+and keeps the manifest of the finished jobs in sync with the products.
+"""
+
+import pytest
+from botocore.exceptions import ClientError
+from Climate_Marble_manifest import OrbitManifest, is_orbit_done, head_outputs, get_params_hash, PARAMS_METADATA
+from Climate_Marble_s3_functions import get_s3_client
+
+moto = pytest.importorskip('moto')
+Stubber = pytest.importorskip('botocore.stub').Stubber
+
+BUCKET = 'climatemarble'
+BF_NAME = '/hdfgroup/terra/TERRA_BF_L1B_O69365_20120603070000_F000_V001.h5'
+KEYS = ['climarble/2012.06/CLIMARBLE_O69365_20120603070000_F000_V001_0.5deg.nc',
+        'climarble/2012.06/CLIMARBLE_O69365_20120603070000_F000_V001_1deg.nc']
+PARAMS = {'VZA_MAX': 18, 'CATEGORY': 'VIS', 'CAMERA': 'AN', 'MODE': 'ct', 'resolutions': [0.5, 1.0],
+          'output_format': 'dense', 'complevel': 4}
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        s3_client = get_s3_client()
+        s3_client.create_bucket(Bucket=BUCKET)
+        yield s3_client
+
+
+@pytest.fixture(params=['folder', 's3'])
+def manifest(request, s3_client, tmp_path):
+    if request.param == 'folder':
+        return OrbitManifest(str(tmp_path / 'manifest'))
+    return OrbitManifest('s3://{}/manifest'.format(BUCKET), s3_client)
+
+
+def put_products(s3_client, params, keys=KEYS, body=b'orbit product'):
+    for key in keys:
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=body, Metadata={PARAMS_METADATA: get_params_hash(params)})
+
+
+def test_missing_product(s3_client, manifest):
+    put_products(s3_client, PARAMS, KEYS[:1])
+    assert not is_orbit_done(s3_client, BUCKET, KEYS, BF_NAME, PARAMS, manifest)
+    assert manifest.get(BF_NAME, get_params_hash(PARAMS)) is None
+
+
+def test_stale_params_hash(s3_client, manifest):
+    put_products(s3_client, dict(PARAMS, VZA_MAX=30))
+    assert not is_orbit_done(s3_client, BUCKET, KEYS, BF_NAME, PARAMS, manifest)
+    assert manifest.get(BF_NAME, get_params_hash(PARAMS)) is None
+
+
+def test_products_are_written_back_to_the_manifest(s3_client, manifest):
+    put_products(s3_client, PARAMS)
+    assert is_orbit_done(s3_client, BUCKET, KEYS, BF_NAME, PARAMS, manifest)
+
+    record = manifest.get(BF_NAME, get_params_hash(PARAMS))
+    assert record['bf_name'] == BF_NAME and record['params'] == PARAMS
+    assert record['outputs'] == head_outputs(s3_client, BUCKET, KEYS, get_params_hash(PARAMS))
+    assert sorted(record['outputs']) == KEYS and record['outputs'][KEYS[0]]['size'] == len(b'orbit product')
+
+
+def test_manifest_hit(s3_client, manifest):
+    put_products(s3_client, PARAMS)
+    params_hash = get_params_hash(PARAMS)
+    manifest.put(BF_NAME, params_hash, PARAMS, head_outputs(s3_client, BUCKET, KEYS, params_hash))
+    assert is_orbit_done(s3_client, BUCKET, KEYS, BF_NAME, PARAMS, manifest)
+
+    # a product overwritten since the record (same parameters): done, and the record is updated
+    put_products(s3_client, PARAMS, KEYS[1:], b'orbit product gridded again')
+    assert is_orbit_done(s3_client, BUCKET, KEYS, BF_NAME, PARAMS, manifest)
+    assert manifest.get(BF_NAME, params_hash)['outputs'] == head_outputs(s3_client, BUCKET, KEYS, params_hash)
+
+    # a product deleted since the record: not done, unless the manifest is trusted
+    s3_client.delete_object(Bucket=BUCKET, Key=KEYS[0])
+    assert not is_orbit_done(s3_client, BUCKET, KEYS, BF_NAME, PARAMS, manifest)
+    assert is_orbit_done(s3_client, BUCKET, KEYS, BF_NAME, PARAMS, manifest, TRUST_MANIFEST=True)
+
+
+def test_forbidden_product(s3_client):
+    # without s3:ListBucket, S3 answers 403 for a missing key
+    put_products(s3_client, PARAMS)
+    with Stubber(s3_client) as stubber:
+        stubber.add_client_error('head_object', service_error_code='403', http_status_code=403)
+        assert head_outputs(s3_client, BUCKET, KEYS, get_params_hash(PARAMS)) is None
+
+    with Stubber(s3_client) as stubber:
+        stubber.add_client_error('head_object', service_error_code='SlowDown', http_status_code=503)
+        with pytest.raises(ClientError):
+            head_outputs(s3_client, BUCKET, KEYS, get_params_hash(PARAMS))
@@ -0,0 +1,133 @@
+"""
+The batched MISR stages (geometry upsampling, 275-m aggregation and one-pass binning) give the results of the
+original per-block code (skimage resize, np.nanmean and binned_statistic_dd).
+"""
+
+import warnings
+import numpy as np
+import pytest
+from Climate_Marble_common_functions import OrbitContext
+from Climate_Marble_basicfusion_MISR import BlockResizer, aggregate_misr_275m, misr_latslons_to_cells, main_bf_MISR, MISR_BANDS
+
+resize = pytest.importorskip('skimage.transform').resize
+binned_statistic_dd = pytest.importorskip('scipy.stats').binned_statistic_dd
+
+
+def legacy_resize(block, output_shape):
+    # skimage.transform.resize of scikit-image 0.16.2 (pinned by the original requirements) clips the output to the range
+    # of the block, so a block with a NaN is all NaN (later versions only spread the NaN to the neighbouring pixels)
+    out = resize(block, output_shape)
+    if np.isnan(block).any():
+        out[:] = np.nan
+    return out
+
+
+def legacy_aggregate_misr_275m(blk_rad):
+    # 275-m aggregation of the original main_bf_MISR (one block)
+    blk_rad = blk_rad.copy()
+    np.place(blk_rad, blk_rad<0, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(np.reshape(blk_rad, (blk_rad.shape[0]//4, 4, blk_rad.shape[1]//4,4)), axis=(1,3))
+
+
+def legacy_main_bf_MISR(h5f, MISR_blocks, SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CAMERA='AN'):
+    # per-block loop of the original main_bf_MISR (the gridded sums and numbers are returned instead of written)
+    NUM_LATS = int(180 / SPATIAL_RESOLUTION)
+    NUM_LONS = int(360 / SPATIAL_RESOLUTION)
+    LAT_EDGES = np.arange(-90.0, 90.0001, SPATIAL_RESOLUTION)
+    LON_EDGES = np.arange(-180.0, 180.0001, SPATIAL_RESOLUTION)
+    orbit_radiance_sum  = np.zeros((NUM_LATS, NUM_LONS, 4))
+    orbit_radiance_num  = np.zeros((NUM_LATS, NUM_LONS, 4))
+
+    lat = h5f['MISR/Geolocation/GeoLatitude'][:]
+    lon = h5f['MISR/Geolocation/GeoLongitude'][:]
+    rads_all = [h5f['MISR/{}/Data_Fields/{}_Radiance'.format(CAMERA, iband)][:] for iband in MISR_BANDS]
+    rad_shape = (128, 512)
+
+    for iblk in MISR_blocks:
+        raw_sza = h5f['MISR/Solar_Geometry/SolarZenith'][iblk]
+        raw_vza = h5f['MISR/{}/Sensor_Geometry/{}Zenith'.format(CAMERA, ''.join(c.lower() if i==1 else c for i,c in enumerate(CAMERA)))][iblk]
+        np.place(raw_sza, raw_sza<0, np.nan)
+        np.place(raw_vza, raw_vza<0, np.nan)
+        blk_sza = legacy_resize(raw_sza, rad_shape)
+        blk_vza = legacy_resize(raw_vza, rad_shape)
+
+        idx_geometry = np.where((blk_sza<89.0) & (blk_vza<VZA_MAX))
+        select_lat = lat[iblk][idx_geometry]
+        select_lon = lon[iblk][idx_geometry]
+
+        for iband, band_name in enumerate(MISR_BANDS):
+            blk_rad = rads_all[iband][iblk]
+            if blk_rad.shape == (512, 2048):
+                fnl_blk_rad = legacy_aggregate_misr_275m(blk_rad)
+            else:
+                fnl_blk_rad = blk_rad
+
+            select_rad = np.nan_to_num(fnl_blk_rad[idx_geometry])
+            fnl_idx = np.where((select_rad>0)&(select_rad<1000))[0]
+
+            fnl_lat = select_lat[fnl_idx] * -1
+            fnl_lon = select_lon[fnl_idx]
+            fnl_rad = select_rad[fnl_idx]
+            try:
+                rad_sum = binned_statistic_dd((fnl_lat, fnl_lon), fnl_rad, bins=[LAT_EDGES, LON_EDGES], statistic='sum')[0]
+                rad_cnt = binned_statistic_dd((fnl_lat, fnl_lon), fnl_rad, bins=[LAT_EDGES, LON_EDGES], statistic='count')[0]
+                orbit_radiance_sum[:, :, iband] += rad_sum
+                orbit_radiance_num[:, :, iband] += rad_cnt
+            except ValueError:
+                continue
+    return orbit_radiance_sum, orbit_radiance_num
+
+
+@pytest.mark.parametrize('input_shape, output_shape', [((8, 32), (128, 512)), ((2, 3), (7, 5)), ((1, 4), (3, 16))])
+def test_block_resizer_matches_skimage_resize(input_shape, output_shape):
+    rng = np.random.default_rng(0)
+    blocks = rng.uniform(0, 90, (6,) + input_shape)
+    # fill values are set to NaN before the resize
+    blocks[2, 0, 0] = np.nan
+    blocks[4, -1, -1] = np.nan
+
+    expected = np.array([legacy_resize(iblock, output_shape) for iblock in blocks])
+    np.testing.assert_allclose(BlockResizer(input_shape, output_shape)(blocks), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_aggregate_misr_275m_matches_nanmean():
+    rng = np.random.default_rng(1)
+    rads = rng.uniform(-50, 400, (3, 512, 2048)).astype('float32')
+    rads[rads < 0] = -555
+    # a 4 x 4 box without valid sample
+    rads[1, 8:12, 16:20] = -555
+
+    expected = np.array([legacy_aggregate_misr_275m(iblock) for iblock in rads])
+    out = aggregate_misr_275m(rads)
+    assert out.dtype == np.float32
+    assert np.isnan(out[1, 2, 4])
+    np.testing.assert_array_equal(np.isnan(out), np.isnan(expected))
+    np.testing.assert_allclose(out, expected, rtol=1e-6)
+
+
+def test_misr_latslons_to_cells_matches_binned_statistic_dd():
+    SPATIAL_RESOLUTION = 0.5
+    LAT_EDGES = np.arange(-90.0, 90.0001, SPATIAL_RESOLUTION)
+    LON_EDGES = np.arange(-180.0, 180.0001, SPATIAL_RESOLUTION)
+
+    rng = np.random.default_rng(2)
+    lats = np.concatenate([rng.uniform(-90, 90, 10000), [-90, 90, 0, 45.5, -45.5, 89.75, -9999, 91]]).astype('float32')
+    lons = np.concatenate([rng.uniform(-180, 180, 10000), [-180, 180, 179.5, -0.5, 0, 180, 0, 0]]).astype('float32')
+
+    cells = misr_latslons_to_cells(lats, lons, LAT_EDGES, LON_EDGES)
+    expected_cnt = binned_statistic_dd((lats * -1, lons), lats, bins=[LAT_EDGES, LON_EDGES], statistic='count')[0]
+    cnt = np.bincount(cells[cells>=0], minlength=expected_cnt.size).reshape(expected_cnt.shape)
+    np.testing.assert_array_equal(cnt, expected_cnt)
+    assert np.all(cells[-2:] == -1)
+
+
+def test_main_bf_MISR_matches_legacy(synthetic_bf):
+    orbit = OrbitContext(synthetic_bf)
+    ds = main_bf_MISR(synthetic_bf, orbit=orbit)
+    expected_sum, expected_num = legacy_main_bf_MISR(synthetic_bf, orbit.misr_blocks)
+
+    assert expected_num.sum() > 0
+    np.testing.assert_array_equal(ds['MISR spec rad num'].values, expected_num)
+    np.testing.assert_allclose(ds['MISR spec rad sum'].values, expected_sum, rtol=1e-12)
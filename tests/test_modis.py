@@ -0,0 +1,92 @@
+"""
+The MODIS gridding with the compacted-sample kernel (accumulate) and the cos(SZA) insolation gives the results of the
+original per-granule sort kernel path with per-channel insolation cubes.
+
+The sums are accumulated in float32 by both kernels, in a different order for the insolation (cos(SZA) is gridded
+once and scaled by the channel coefficient afterwards), so the float sums are compared within a relative tolerance
+(about 1 ulp of the cell) and the numbers of samples exactly (see LEGACY_RTOL in benchmarks/run_benchmarks.py).
+"""
+
+import numpy as np
+import pytest
+from Climate_Marble_common_functions import OrbitContext, latslons_to_idxs
+from Climate_Marble_basicfusion_MODIS import main_bf_MODIS
+
+sort = pytest.importorskip('sample2grid_sw').sort
+
+
+def legacy_main_bf_MODIS(h5f, MODIS_granules, SPATIAL_RESOLUTION=0.5, VZA_MAX=18):
+    # per-granule loop of the original main_bf_MODIS (VIS category, the gridded arrays are returned instead of written)
+    NUM_POINTS = 1 / SPATIAL_RESOLUTION
+    NUM_LATS = int(180 / SPATIAL_RESOLUTION)
+    NUM_LONS = int(360 / SPATIAL_RESOLUTION)
+    NUM_CHAN = 7
+    orbit_radiance_sum = np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN))
+    orbit_radiance_num = np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN), dtype='int16')
+    orbit_insolation_sum = np.zeros((NUM_LATS, NUM_LONS, NUM_CHAN))
+
+    for igranule in MODIS_granules:
+        lats = h5f['MODIS/{}/_1KM/Geolocation/Latitude'.format(igranule)][:]
+        lons = h5f['MODIS/{}/_1KM/Geolocation/Longitude'.format(igranule)][:]
+        lats_idx, lons_idx = latslons_to_idxs(lats, lons, NUM_POINTS)
+
+        sza = h5f['MODIS/{}/SolarZenith'.format(igranule)][:, :]
+        vza = h5f['MODIS/{}/SensorZenith'.format(igranule)][:, :]
+        cosine_sza = np.cos(np.deg2rad(sza))
+
+        valid_y, valid_x = np.where((sza>=0)&(sza<=89.0)&(vza>=0)&(vza<VZA_MAX)&(lons_idx>=0))
+        valid_num = len(valid_x)
+        if valid_num == 0:
+            continue
+
+        mdata = []
+        rad_scales = []
+        ref_scales = []
+        for ifld in ['EV_250_Aggr1km_RefSB', 'EV_500_Aggr1km_RefSB']:
+            sds = h5f['MODIS/{}/_1KM/Data_Fields/{}'.format(igranule, ifld)]
+            for iband in range(len(sds)):
+                mdata.append(sds[iband])
+                rad_scales.append(sds.attrs['radiance_scales'][iband])
+                ref_scales.append(sds.attrs['reflectance_scales'][iband])
+        mdata = np.array(mdata)
+        rad_scales = np.array(rad_scales)
+        ref_scales = np.array(ref_scales)
+        coeffs = rad_scales / ref_scales
+
+        sols = []
+        rads = []
+        rads_max = []
+        for iband in range(NUM_CHAN):
+            tmp_sol = cosine_sza * coeffs[iband]
+            tmp_rad = mdata[iband]
+            tmp_rad_max = 32767 * rad_scales[iband]
+            if iband > 0:
+                refill_mask = (mdata[0] > 0) & (tmp_rad == -992)
+                np.place(tmp_rad, refill_mask, tmp_rad_max)
+            sols.append(tmp_sol)
+            rads.append(tmp_rad)
+            rads_max.append(tmp_rad_max)
+
+        sols = np.rollaxis(np.array(sols), 0, 3)
+        rads = np.rollaxis(np.array(rads), 0, 3)
+        rads_max = np.array(rads_max)
+
+        orbit_insolation_sum, orbit_radiance_sum, orbit_radiance_num = sort(NUM_CHAN, NUM_LATS, NUM_LONS, \
+            valid_num, valid_x, valid_y, \
+            len(lats_idx), lats, lons, lats_idx, lons_idx, \
+            rads, sols, rads_max, \
+            orbit_insolation_sum, orbit_radiance_sum, orbit_radiance_num)
+    return orbit_radiance_sum, orbit_radiance_num, orbit_insolation_sum
+
+
+def test_main_bf_MODIS_matches_legacy(synthetic_bf):
+    orbit = OrbitContext(synthetic_bf)
+    ds = main_bf_MODIS(synthetic_bf, orbit=orbit)
+    expected_rad_sum, expected_rad_num, expected_insol_sum = legacy_main_bf_MODIS(synthetic_bf, orbit.modis_granules)
+
+    assert expected_rad_num.sum() > 0
+    np.testing.assert_array_equal(ds['MODIS spec rad num'].values, expected_rad_num)
+    np.testing.assert_allclose(ds['MODIS spec rad sum'].values, expected_rad_sum, rtol=1e-6)
+    np.testing.assert_allclose(ds['MODIS spec insol sum'].values, expected_insol_sum, rtol=1e-5)
+    # the touched cells are the same
+    np.testing.assert_array_equal(ds['MODIS spec insol sum'].values != 0, expected_insol_sum != 0)
@@ -0,0 +1,66 @@
+"""
+The sparse orbit products read back in the dense layout are the dense products, and both hold the gridded
+results of the instruments (packed to float32, as the original MODIS sums).
+"""
+
+import os
+import numpy as np
+import pytest
+import xarray as xr
+from Climate_Marble_common_functions import OrbitContext
+from Climate_Marble_basicfusion_orbit import grid_orbit_configs, main_bf_orbit
+from Climate_Marble_output_functions import dense_to_sparse, sparse_to_dense, open_orbit_dataset, open_netcdf_memory
+
+
+@pytest.fixture(scope='module')
+def orbit_datasets(synthetic_bf):
+    orbit = OrbitContext(synthetic_bf)
+    configs = [{'VZA_MAX': 18, 'CATEGORY': 'VIS', 'CAMERA': 'AN', 'MODE': 'ct'}]
+    return orbit, grid_orbit_configs(synthetic_bf, configs, orbit=orbit)[0]
+
+
+def test_dense_to_sparse_round_trip():
+    rng = np.random.default_rng(0)
+    rad_sum = np.zeros((36, 72, 3))
+    rad_num = np.zeros((36, 72, 3), dtype='int32')
+    cells = rng.choice(36*72, 100, replace=False)
+    rad_sum.reshape(-1, 3)[cells] = rng.uniform(0, 100, (100, 3))
+    rad_num.reshape(-1, 3)[cells] = rng.integers(1, 50, (100, 3))
+    # cells touched in some channels only, or only counted
+    rad_sum.reshape(-1, 3)[cells[:10], 1] = 0
+    rad_sum.reshape(-1, 3)[cells[10:20]] = 0
+    ds = xr.Dataset({'rad sum': (('latitude', 'longitude', 'channel'), rad_sum),
+                     'rad num': (('latitude', 'longitude', 'channel'), rad_num)},
+                    coords={'latitude': np.arange(36), 'longitude': np.arange(72), 'channel': range(3)})
+
+    sparse_ds = dense_to_sparse(ds, 'test')
+    np.testing.assert_array_equal(sparse_ds['test_cell'].values, np.sort(cells))
+    xr.testing.assert_identical(sparse_to_dense(sparse_ds), ds)
+
+
+@pytest.mark.parametrize('FLOAT32', [True, False])
+def test_sparse_product_matches_dense_product(synthetic_bf, orbit_datasets, tmp_path, FLOAT32):
+    orbit, instrument_datasets = orbit_datasets
+    products = {}
+    for OUTPUT_FORMAT in ['dense', 'sparse']:
+        output_folder = str(tmp_path / OUTPUT_FORMAT)
+        os.makedirs(output_folder)
+        orbit_nc_out = main_bf_orbit(synthetic_bf, output_folder, orbit=orbit, OUTPUT_FORMAT=OUTPUT_FORMAT, FLOAT32=FLOAT32)
+        products[OUTPUT_FORMAT] = open_orbit_dataset(orbit_nc_out)
+
+    # same values and coordinates (the dense variables also have a _FillValue attribute)
+    xr.testing.assert_equal(products['sparse'], products['dense'])
+    assert len(products['dense'].data_vars) == 8
+    for instrument, ds in instrument_datasets.items():
+        for name, var in ds.data_vars.items():
+            expected = var.values.astype('float32') if FLOAT32 and var.dtype.kind == 'f' else var.values
+            np.testing.assert_array_equal(products['dense'][name].values, expected)
+
+
+def test_sparse_product_in_memory(synthetic_bf, orbit_datasets):
+    orbit, instrument_datasets = orbit_datasets
+    nc_memory = main_bf_orbit(synthetic_bf, None, orbit=orbit, OUTPUT_FORMAT='sparse')
+    ds = sparse_to_dense(open_netcdf_memory(nc_memory))
+    for instrument, instrument_ds in instrument_datasets.items():
+        for name, var in instrument_ds.data_vars.items():
+            np.testing.assert_array_equal(ds[name].values, var.values.astype(ds[name].dtype))
@@ -0,0 +1,86 @@
+"""
+The levels of the pyramid block-summed from the base grid are the grids of a direct gridding at their resolution,
+including resolutions that do not divide the globe (partial last row/column dropped).
+"""
+
+import numpy as np
+import pytest
+from Climate_Marble_common_functions import OrbitContext, latslons_to_idxs
+from Climate_Marble_basicfusion_CERES import main_bf_CERES
+from Climate_Marble_basicfusion_MISR import main_bf_MISR
+from Climate_Marble_basicfusion_MODIS import main_bf_MODIS
+from Climate_Marble_pyramid_functions import get_base_resolution, get_block_factor, block_sum, coarsen_dataset
+
+
+@pytest.mark.parametrize('shape, FACTOR', [((6, 12), 3), ((7, 11), 3), ((7, 11, 2), 2), ((5, 5), 1)])
+def test_block_sum(shape, FACTOR):
+    rng = np.random.default_rng(0)
+    grid = rng.integers(0, 100, shape).astype('int16')
+    # cells of the output grid as the gridders count them (the partial last block is dropped)
+    NUM_LATS = shape[0] // FACTOR
+    NUM_LONS = shape[1] // FACTOR
+
+    expected = np.zeros((NUM_LATS, NUM_LONS) + shape[2:], dtype='int64')
+    for i in range(NUM_LATS):
+        for j in range(NUM_LONS):
+            expected[i, j] = grid[i*FACTOR:(i+1)*FACTOR, j*FACTOR:(j+1)*FACTOR].sum(axis=(0, 1))
+
+    summed = block_sum(grid, FACTOR, NUM_LATS, NUM_LONS)
+    assert summed.shape == expected.shape
+    np.testing.assert_array_equal(summed, expected)
+    if FACTOR > 1:
+        assert summed.dtype == np.int64
+        # float sums are added in float64
+        assert block_sum(grid.astype('float32'), FACTOR, NUM_LATS, NUM_LONS).dtype == np.float64
+
+
+def test_block_sum_padding():
+    # a partial last block is summed from the cells available
+    grid = np.ones((7, 11))
+    summed = block_sum(grid, 3, 3, 4)
+    np.testing.assert_array_equal(summed[:2, :3], 9)
+    np.testing.assert_array_equal(summed[2, :3], 3)
+    np.testing.assert_array_equal(summed[:2, 3], 6)
+    assert summed[2, 3] == 2
+
+
+@pytest.mark.parametrize('BASE_RESOLUTION, SPATIAL_RESOLUTION', [(0.5, 2.5), (0.25, 0.75), (0.5, 3.5)])
+def test_latslons_to_idxs_on_cell_edges(BASE_RESOLUTION, SPATIAL_RESOLUTION):
+    # the edges of the level are edges of the base grid, a lat/lon on an edge is in the same cell at both resolutions
+    FACTOR = get_block_factor(BASE_RESOLUTION, SPATIAL_RESOLUTION)
+    edges = np.arange(0, 360, SPATIAL_RESOLUTION)
+    lats = np.concatenate([90 - edges[edges<180], 90 - edges[edges<180] - BASE_RESOLUTION / 2]).astype('float32')
+    lons = np.concatenate([-180 + edges, -180 + edges + BASE_RESOLUTION / 2])[:len(lats)].astype('float32')
+
+    base_lats_idx, base_lons_idx = latslons_to_idxs(lats, lons, 1 / BASE_RESOLUTION)
+    lats_idx, lons_idx = latslons_to_idxs(lats, lons, 1 / SPATIAL_RESOLUTION)
+    np.testing.assert_array_equal(lats_idx, base_lats_idx // FACTOR)
+    np.testing.assert_array_equal(lons_idx, base_lons_idx // FACTOR)
+
+
+@pytest.mark.parametrize('SPATIAL_RESOLUTIONS, BASE_RESOLUTION', [([0.5, 1, 2.5], 0.5), ([0.5, 0.75], 0.25), ([0.5, 3.5], 0.5)])
+def test_coarsen_dataset_matches_direct_gridding(synthetic_bf, SPATIAL_RESOLUTIONS, BASE_RESOLUTION):
+    orbit = OrbitContext(synthetic_bf)
+    assert get_base_resolution(SPATIAL_RESOLUTIONS) == BASE_RESOLUTION
+
+    gridders = [(main_bf_CERES, 1e-12), (main_bf_MISR, 1e-12), (main_bf_MODIS, 1e-5)]
+    for main_bf, rtol in gridders:
+        base_ds = main_bf(synthetic_bf, SPATIAL_RESOLUTION=BASE_RESOLUTION, orbit=orbit)
+        for ires in SPATIAL_RESOLUTIONS:
+            level_ds = coarsen_dataset(base_ds, BASE_RESOLUTION, ires)
+            direct_ds = main_bf(synthetic_bf, SPATIAL_RESOLUTION=ires, orbit=orbit)
+
+            assert get_block_factor(BASE_RESOLUTION, ires) == round(ires / BASE_RESOLUTION)
+            assert level_ds.sizes == direct_ds.sizes
+            np.testing.assert_array_equal(level_ds['latitude'].values, direct_ds['latitude'].values)
+            np.testing.assert_array_equal(level_ds['longitude'].values, direct_ds['longitude'].values)
+            for name, var in direct_ds.data_vars.items():
+                if var.dtype.kind in 'iu':
+                    # the numbers of samples are the same (the gridders keep the int16 numbers of the original code,
+                    # which wrap for MISR at coarse resolutions, the levels are summed in int64)
+                    level_num = level_ds[name].values
+                    assert level_num.sum() > 0 and level_num.min() >= 0
+                    np.testing.assert_array_equal(level_num.astype(var.dtype), var.values)
+                else:
+                    # the sums are the same up to the order of the additions (float32 accumulation for MODIS)
+                    np.testing.assert_allclose(level_ds[name].values, var.values, rtol=rtol)
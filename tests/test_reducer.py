@@ -0,0 +1,56 @@
+"""
+The orbit products (dense and sparse) reduced by a pool of processes give the serial sums of the gridded arrays,
+and the daily/monthly files are named after their period.
+"""
+
+import os
+import numpy as np
+import pytest
+import xarray as xr
+from Climate_Marble_reducer import reduce_orbit_files, main_reduce, get_period_key, MEAN_VARIABLES
+
+
+def serial_sums(orbit_datasets):
+    # sum of the gridded arrays of the orbits, one by one
+    sums = {}
+    for instrument_datasets in orbit_datasets:
+        for ds in instrument_datasets.values():
+            for name, var in ds.data_vars.items():
+                sums[name] = sums.get(name, 0) + var.values
+    return sums
+
+
+@pytest.mark.parametrize('NUM_WORKERS', [1, 2, 3])
+def test_reduce_orbit_files_matches_serial_sum(orbit_products, NUM_WORKERS):
+    orbit_ncs, orbit_datasets = orbit_products
+    accumulator = reduce_orbit_files(orbit_ncs, NUM_WORKERS)
+
+    expected = serial_sums(orbit_datasets)
+    assert sorted(accumulator.grids) == sorted(expected)
+    for name, grid in accumulator.grids.items():
+        assert grid.dtype == ('int64' if name.endswith('num') else 'float64')
+        np.testing.assert_array_equal(grid, expected[name])
+    assert sorted(accumulator.orbit_ncs) == sorted(orbit_ncs)
+
+
+@pytest.mark.parametrize('PERIOD, period_keys', [('monthly', ['201206', '201207']),
+                                                 ('daily', ['20120603', '20120604', '20120701'])])
+def test_main_reduce(orbit_products, tmp_path, PERIOD, period_keys):
+    orbit_ncs, orbit_datasets = orbit_products
+    period_ncs = main_reduce(orbit_ncs, str(tmp_path), PERIOD=PERIOD, NUM_WORKERS=2)
+    assert [os.path.basename(period_nc) for period_nc in period_ncs] == \
+           ['CLIMARBLE_{}_{}.nc'.format(PERIOD.upper(), period_key) for period_key in period_keys]
+
+    for period_key, period_nc in zip(period_keys, period_ncs):
+        expected = serial_sums([instrument_datasets for orbit_nc, instrument_datasets in zip(orbit_ncs, orbit_datasets)
+                                if get_period_key(orbit_nc, PERIOD) == period_key])
+        # the sums and numbers have 0 as fill value, the means NaN
+        with xr.open_dataset(period_nc, mask_and_scale=False) as ds:
+            assert ds.attrs['number_of_orbits'] == sum(get_period_key(orbit_nc, PERIOD) == period_key for orbit_nc in orbit_ncs)
+            for name, data in expected.items():
+                np.testing.assert_array_equal(ds[name].values, data)
+            for mean_name, sum_name, num_name in MEAN_VARIABLES:
+                if sum_name in expected:
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        mean = (expected[sum_name] / expected[num_name]).astype('float32')
+                    np.testing.assert_array_equal(ds[mean_name].values, mean)
@@ -0,0 +1,53 @@
+"""
+The in-memory products are uploaded to S3 (a moto mock) without copy, in parts when larger than the part size.
+"""
+
+import io
+import numpy as np
+import pytest
+from Climate_Marble_s3_functions import BufferReader, get_s3_client, upload_bytes
+
+moto = pytest.importorskip('moto')
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        s3_client = get_s3_client()
+        s3_client.create_bucket(Bucket='climate-marble')
+        yield s3_client
+
+
+def test_buffer_reader():
+    data = memoryview(bytearray(range(256)) * 4)
+    reader = BufferReader(data)
+    assert reader.seek(0, io.SEEK_END) == 1024 and reader.tell() == 1024
+    reader.seek(1000)
+    assert reader.read(100) == bytes(data[1000:])
+    assert reader.read(100) == b''
+    reader.seek(-24, io.SEEK_CUR)
+    assert reader.read() == bytes(data[1000:])
+    # the buffer is not copied
+    data[1000] = 0
+    reader.seek(1000)
+    assert reader.read(1) == b'\x00'
+
+
+@pytest.mark.parametrize('size, num_parts', [(1000, 0), (12 * 1024 ** 2 + 1, 3)])
+def test_upload_bytes(s3_client, size, num_parts):
+    data = memoryview(np.random.default_rng(0).integers(0, 256, size, dtype='uint8').tobytes())
+    metadata = {'params-hash': 'abc123'}
+    upload_bytes(s3_client, data, 'climate-marble', 'orbit.nc', PART_SIZE_MB=5, MAX_CONCURRENCY=2, METADATA=metadata)
+
+    obj = s3_client.get_object(Bucket='climate-marble', Key='orbit.nc')
+    assert obj['Body'].read() == bytes(data)
+    assert obj['Metadata'] == metadata
+    # the ETag of a multipart upload ends with its number of parts
+    etag = obj['ETag'].strip('"')
+    if num_parts > 0:
+        assert etag.endswith('-{}'.format(num_parts))
+    else:
+        assert '-' not in etag
@@ -0,0 +1,103 @@
+"""
+The vectorized time conversion gives the julian dates of the original per-element parsing (julian.to_jd),
+and the same descending MISR blocks and CERES footprints.
+"""
+
+import datetime
+import numpy as np
+import pytest
+from Climate_Marble_time_functions import granuletime_to_jd, isotime_to_jd, jd_window_mask
+from Climate_Marble_common_functions import OrbitContext
+
+julian = pytest.importorskip('julian')
+
+
+def legacy_granuletime_to_jd(mod_granule_string, offset_mins=0):
+    # granuletime_to_jd of the original common functions
+    yr = int(mod_granule_string.split('_')[1][:4])
+    doy = int(mod_granule_string.split('_')[1][-3:])
+    hr = int(mod_granule_string.split('_')[2][:2])
+    mn = int(mod_granule_string.split('_')[2][-2:])
+
+    dt = datetime.datetime(yr, 1, 1, hr, mn) + datetime.timedelta(days=doy-1, minutes=offset_mins)
+    return julian.to_jd(dt, fmt='jd')
+
+
+def legacy_block_julian(bct):
+    # BlockCenterTime parsing of the original get_descending (the milliseconds are put in the microsecond field)
+    misr_block_julian = []
+    for ibct in bct:
+        yr, mon, day = str(ibct).split('-')
+        yr = int(yr[2:])
+        if yr == 0:
+            misr_block_julian.append(0)
+        else:
+            hr, mn, sec_decimal = day[3:].split(':')
+            sec = int(float(sec_decimal[:-2]))
+            millisec = int(1000*(float(sec_decimal[:-2]) - sec))
+
+            dt = datetime.datetime(yr, int(mon), int(day[:2]), int(hr), int(mn), sec, millisec)
+            misr_block_julian.append(julian.to_jd(dt, fmt='jd'))
+    return np.array(misr_block_julian)
+
+
+def random_times(num, rng):
+    start = datetime.datetime(2000, 2, 24)
+    seconds = rng.uniform(0, (datetime.datetime(2021, 1, 1) - start).total_seconds(), num)
+    return [start + datetime.timedelta(seconds=float(isec)) for isec in seconds]
+
+
+@pytest.mark.parametrize('offset_mins', [0, 5])
+def test_granuletime_to_jd_matches_julian(offset_mins):
+    rng = np.random.default_rng(0)
+    names = ['granule_{}{:03d}_{:02d}{:02d}'.format(dt.year, dt.timetuple().tm_yday, dt.hour, dt.minute // 5 * 5)
+             for dt in random_times(2000, rng)]
+    names += ['granule_2012366_2355', 'granule_2013001_0000', 'granule_2012155_0700']
+
+    expected = np.array([legacy_granuletime_to_jd(name, offset_mins) for name in names])
+    np.testing.assert_array_equal(granuletime_to_jd(names, offset_mins), expected)
+    assert granuletime_to_jd(names[-1], offset_mins) == expected[-1]
+
+
+def test_isotime_to_jd_matches_julian():
+    rng = np.random.default_rng(1)
+    times = random_times(2000, rng)
+    bct = np.array([dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ').encode() for dt in times] + \
+                   [b'0000-00-00T00:00:00.000000Z'], dtype='S28')
+
+    jd = isotime_to_jd(bct)
+    expected = np.array([julian.to_jd(dt, fmt='jd') for dt in times] + [0])
+    np.testing.assert_array_equal(jd, expected)
+    # the original parser only differs by the fraction of second of the times
+    np.testing.assert_allclose(jd, legacy_block_julian(bct), rtol=0, atol=1. / 86400)
+
+
+@pytest.mark.parametrize('kind', ['bytes', 'str'])
+def test_isotime_to_jd_variable_length_strings(kind):
+    # variable-length strings are read by h5py as object arrays
+    times = [b'2012-06-03T07:34:23.000532Z', b'0000-00-00T00:00:00.000000Z', b'2012-06-03T07:34:56.000532Z']
+    if kind == 'str':
+        times = [itime.decode() for itime in times]
+    bct = np.empty(len(times), dtype=object)
+    bct[:] = times
+
+    jd = isotime_to_jd(bct)
+    np.testing.assert_array_equal(jd, isotime_to_jd(np.array(times)))
+    assert jd[1] == 0 and np.all(jd[[0, 2]] > 2456081)
+
+
+def test_descending_blocks_and_footprints_match_legacy(synthetic_bf):
+    orbit = OrbitContext(synthetic_bf)
+    t0, t1 = legacy_granuletime_to_jd(orbit.modis_granules[0]), legacy_granuletime_to_jd(orbit.modis_granules[-1], offset_mins=5)
+    np.testing.assert_array_equal(orbit.julian_bound, [t0, t1])
+
+    bct = synthetic_bf['MISR/AN/BlockCenterTime'][:]
+    misr_block_julian = legacy_block_julian(bct)
+    expected_blocks = np.where((misr_block_julian>=t0)&(misr_block_julian<=t1))[0]
+    np.testing.assert_array_equal(orbit.misr_blocks, expected_blocks)
+    assert 0 < len(expected_blocks) < len(bct)
+
+    for igranule in synthetic_bf['CERES']:
+        ssf_time = synthetic_bf['CERES/{}/FM1/Time_and_Position/Time_of_observation'.format(igranule)][:]
+        np.testing.assert_array_equal(np.where(jd_window_mask(ssf_time, orbit.julian_bound))[0],
+                                      np.where((ssf_time>=t0)&(ssf_time<=t1))[0])
@@ -0,0 +1,173 @@
+"""
+The queue worker (process_from_queue) receives batches of messages with long polling, extends the visibility
+of the running jobs, deletes a message only when its job is done (or sent to the dead letter queue), and releases
+the messages of a broken process pool before rebuilding it (moto SQS, with a fake process_job).
+"""
+
+import os
+import json
+import time
+import pytest
+import work_flow
+
+moto = pytest.importorskip('moto')
+
+QUEUE = 'climate_marble_work'
+DEAD_LETTER_QUEUE = 'climate_marble_dead_letter'
+
+
+def fake_process_job(job_record):
+    # run in the worker processes: log the end of the job (or crash the worker on the first delivery)
+    log_file = job_record['log']
+    if job_record['action'] == 'crash' and not os.path.exists(log_file + '.crashed'):
+        open(log_file + '.crashed', 'w').close()
+        os._exit(1)
+    time.sleep(job_record.get('seconds', 0))
+    with open(log_file, 'a') as log:
+        log.write(job_record['terra-file'] + '\n')
+    if job_record['action'] == 'fail':
+        return None, 'gridding error', 'traceback of the gridding error'
+    return [os.path.basename(job_record['terra-file'])], None, None
+
+
+class SQSCalls(object):
+    # calls of the worker to SQS (botocore events)
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.receives = []
+        self.bodies = {}
+        self.deletes = []
+        self.visibilities = []
+
+    def register(self, events):
+        events.register('provide-client-params.sqs.ReceiveMessage', self.receive)
+        events.register('after-call.sqs.ReceiveMessage', self.received)
+        events.register('provide-client-params.sqs.DeleteMessage', self.delete)
+        events.register('provide-client-params.sqs.ChangeMessageVisibility', self.change_visibility)
+
+    def receive(self, params, **kwargs):
+        self.receives.append(dict(params))
+
+    def received(self, parsed, **kwargs):
+        for message in parsed.get('Messages', []):
+            self.bodies[message['ReceiptHandle']] = message['Body']
+
+    def delete(self, params, **kwargs):
+        # the job of the message is done when the message is deleted
+        try:
+            terra_file = json.loads(self.bodies[params['ReceiptHandle']])['terra-file']
+        except ValueError:
+            # a message that is not a job record
+            self.deletes.append((self.bodies[params['ReceiptHandle']], None))
+            return
+        self.deletes.append((terra_file, terra_file in read_log(self.log_file)))
+
+    def change_visibility(self, params, **kwargs):
+        self.visibilities.append(params['VisibilityTimeout'])
+
+
+@pytest.fixture
+def queues(monkeypatch, tmp_path):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(work_flow, 'process_job', fake_process_job)
+    monkeypatch.setattr(work_flow, 'SQS_WAIT_SECONDS', 1)
+    calls = SQSCalls(str(tmp_path / 'jobs.log'))
+
+    get_sqs_resource = work_flow.get_sqs_resource
+    def get_recorded_sqs_resource(endpoint_url=None):
+        sqs = get_sqs_resource(endpoint_url)
+        calls.register(sqs.meta.client.meta.events)
+        return sqs
+    monkeypatch.setattr(work_flow, 'get_sqs_resource', get_recorded_sqs_resource)
+
+    with moto.mock_aws():
+        sqs = get_sqs_resource()
+        yield sqs.create_queue(QueueName=QUEUE), sqs.create_queue(QueueName=DEAD_LETTER_QUEUE), calls
+
+
+def send_jobs(queue, log_file, actions, **job_params):
+    jobs = []
+    for ijob, action in enumerate(actions):
+        job_record = dict(job_params, action=action, log=log_file, year=2012, month=6, **{'hsds-endpoint': 'http://hsds'},
+                          **{'terra-file': '/hdfgroup/terra/TERRA_BF_L1B_O{}_20120603070000_F000_V001.h5'.format(69365 + ijob)})
+        queue.send_message(MessageBody=json.dumps(job_record))
+        jobs.append(job_record)
+    return jobs
+
+
+def run_worker(*options):
+    work_flow.setup(['-q', QUEUE, '--dead-letter-queue', DEAD_LETTER_QUEUE] + list(options))
+    work_flow.process_from_queue()
+
+
+def read_log(log_file):
+    return open(log_file).read().split() if os.path.exists(log_file) else []
+
+
+def get_messages(queue):
+    messages = queue.receive_messages(MaxNumberOfMessages=10, VisibilityTimeout=0)
+    return [json.loads(message.body) for message in messages]
+
+
+def test_batched_receives_and_deletes(queues):
+    queue, dead_letter_queue, calls = queues
+    jobs = send_jobs(queue, calls.log_file, ['ok'] * 12, seconds=0.2)
+    run_worker('--workers', '10')
+
+    # batches of up to 10 messages (one per free worker), with long polling
+    assert calls.receives[0]['MaxNumberOfMessages'] == 10
+    assert all(1 <= receive['MaxNumberOfMessages'] <= 10 for receive in calls.receives)
+    assert all(receive['WaitTimeSeconds'] >= 1 for receive in calls.receives)
+
+    # each job runs once, and its message is deleted after the job is done
+    assert sorted(read_log(calls.log_file)) == sorted(job['terra-file'] for job in jobs)
+    assert sorted(calls.deletes) == sorted((job['terra-file'], True) for job in jobs)
+    assert get_messages(queue) == [] and get_messages(dead_letter_queue) == []
+
+
+def test_visibility_heartbeat(queues):
+    queue, dead_letter_queue, calls = queues
+    # the job runs longer than the visibility timeout
+    jobs = send_jobs(queue, calls.log_file, ['ok'], seconds=5)
+    run_worker('--workers', '2', '--visibility-timeout', '2')
+
+    # the message is not delivered again while its job is running
+    assert read_log(calls.log_file) == [jobs[0]['terra-file']]
+    assert len(calls.visibilities) >= 3 and set(calls.visibilities) == {2}
+    assert calls.deletes == [(jobs[0]['terra-file'], True)]
+    assert get_messages(queue) == []
+
+
+def test_dead_letter(queues):
+    queue, dead_letter_queue, calls = queues
+    jobs = send_jobs(queue, calls.log_file, ['ok', 'fail'])
+    queue.send_message(MessageBody='not a job record')
+    run_worker('--workers', '2')
+
+    dead_letters = get_messages(dead_letter_queue)
+    assert sorted(dead_letter.get('error') for dead_letter in dead_letters) == ['Expecting value: line 1 column 1 (char 0)',
+                                                                                'gridding error']
+    failed = [dead_letter for dead_letter in dead_letters if dead_letter['error'] == 'gridding error'][0]
+    assert failed['job_record'] == jobs[1] and failed['traceback'] == 'traceback of the gridding error'
+
+    # the failed job is deleted once it is in the dead letter queue
+    expected = [(job['terra-file'], True) for job in jobs] + [('not a job record', None)]
+    assert sorted(calls.deletes, key=str) == sorted(expected, key=str)
+    assert get_messages(queue) == []
+
+
+def test_broken_process_pool(queues):
+    queue, dead_letter_queue, calls = queues
+    # the first delivery of the job kills its worker process
+    jobs = send_jobs(queue, calls.log_file, ['crash', 'ok', 'ok'], seconds=0.5)
+    run_worker('--workers', '2', '--visibility-timeout', '30')
+
+    # the messages of the broken pool are released (not deleted) and processed by the new pool
+    assert os.path.exists(calls.log_file + '.crashed')
+    assert 0 in calls.visibilities
+    assert read_log(calls.log_file).count(jobs[0]['terra-file']) == 1
+    assert set(read_log(calls.log_file)) == set(job['terra-file'] for job in jobs)
+    assert sorted(set(calls.deletes)) == sorted((job['terra-file'], True) for job in jobs)
+    assert get_messages(queue) == [] and get_messages(dead_letter_queue) == []
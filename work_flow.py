@@ -7,6 +7,7 @@ Created on Wed Sep 12 12:41:35 2019
 """
 import io
 import json
+import time
 import traceback
 
 import sys
@@ -14,21 +15,208 @@ import sys
 import numpy as np
 import os
 import boto3
-from Climate_Marble_basicfusion_MODIS import main_bf_MODIS
-from Climate_Marble_basicfusion_CERES import main_bf_CERES
-from Climate_Marble_basicfusion_MISR import main_bf_MISR
+from Climate_Marble_basicfusion_orbit import main_bf_orbit
+from Climate_Marble_common_functions import get_output_nc_name, get_bf_name, bf_name_to_nc_name
+from Climate_Marble_s3_functions import get_s3_client, upload_bytes
+from Climate_Marble_manifest import OrbitManifest, is_orbit_done, head_outputs, get_params_hash, PARAMS_METADATA
+from Climate_Marble_output_functions import open_netcdf_memory
+from Climate_Marble_composite import CompositeStore
+from Climate_Marble_io_functions import FilePool, ReadCache, CachedFile
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.util import Finalize
 
-# Get the service resource
-sqs = boto3.resource('sqs', region_name='us-west-2')
-s3_client = boto3.client('s3')
+# Long polling of the work queue (SQS limits)
+SQS_WAIT_SECONDS = 20
+SQS_MAX_MESSAGES = 10
 
-parser = ArgumentParser("Compute Radiance")
-parser.add_argument("-q", dest="sqs_queue", required=False, help="SQS Work Queue")
-parser.add_argument("-u", dest='user', default='admin')
-parser.add_argument("-p", dest='password', default='admin')
-parser.add_argument("-f", dest='bf_name', help="Basic Fusion File S3 URL", required=False)
-parser.add_argument("--hsds", dest='hsds_endpoint', help="HSDS Endpoint", required=False)
+# QC configuration of the orbit products
+QC_CONFIG = {'VZA_MAX': 18, 'CATEGORY': 'VIS', 'CAMERA': 'AN', 'MODE': 'ct'}
+
+
+def get_parser():
+    """
+    Command line options of the worker.
+    """
+    parser = ArgumentParser("Compute Radiance")
+    parser.add_argument("-q", dest="sqs_queue", required=False, help="SQS Work Queue")
+    parser.add_argument("-u", dest='user', default='admin')
+    parser.add_argument("-p", dest='password', default='admin')
+    parser.add_argument("-f", dest='bf_name', help="Basic Fusion File S3 URL", required=False)
+    parser.add_argument("--hsds", dest='hsds_endpoint', help="HSDS Endpoint", required=False)
+    parser.add_argument("--output-format", dest='output_format', choices=['dense', 'sparse'], default='dense',
+                        help="Orbit output format: dense global grids or sparse touched cells")
+    parser.add_argument("--complevel", dest='complevel', type=int, default=4,
+                        help="zlib compression level of the orbit output (0 for no compression)")
+    parser.add_argument("--stream", dest='stream', action='store_true',
+                        help="Serialize the orbit output in memory and stream it to S3 (no local file)")
+    parser.add_argument("--s3-endpoint", dest='s3_endpoint', required=False,
+                        help="S3 Endpoint (e.g., a local S3 stand-in), AWS if not given")
+    parser.add_argument("--part-size", dest='part_size', type=int, default=8,
+                        help="Part size of the multipart upload in MB (with --stream)")
+    parser.add_argument("--upload-concurrency", dest='upload_concurrency', type=int, default=4,
+                        help="Number of parts uploaded concurrently (with --stream)")
+    parser.add_argument("--composite", dest='composite_folder', required=False,
+                        help="Folder of the running daily/monthly composites updated with each orbit")
+    parser.add_argument("--resolutions", dest='resolutions', type=float, nargs='+', default=[0.5],
+                        help="Spatial resolution(s) in degree, several resolutions are gridded in one pass (pyramid)")
+    parser.add_argument("--sqs-endpoint", dest='sqs_endpoint', required=False,
+                        help="SQS Endpoint (e.g., a local SQS stand-in), AWS if not given")
+    parser.add_argument("--dead-letter-queue", dest='dead_letter_queue', default='climate_marble_dead_letter.fifo',
+                        help="SQS queue receiving the failed jobs")
+    parser.add_argument("--workers", dest='workers', type=int, default=1,
+                        help="Number of worker processes gridding orbits from the queue")
+    parser.add_argument("--visibility-timeout", dest='visibility_timeout', type=int, default=300,
+                        help="Visibility timeout (in seconds) of the messages being processed, extended until they are done")
+    parser.add_argument("--idle-polls", dest='idle_polls', type=int, default=1,
+                        help="Number of consecutive empty polls (with no job running) before the worker exits")
+    parser.add_argument("--manifest", dest='manifest', required=False,
+                        help="Manifest of the finished jobs: local folder or S3 prefix (s3://bucket/prefix)")
+    parser.add_argument("--trust-manifest", dest='trust_manifest', action='store_true',
+                        help="Skip the jobs in the manifest without checking their products in S3")
+    parser.add_argument("--force", dest='force', action='store_true',
+                        help="Process the orbit even if its products already exist with the same parameters")
+    parser.add_argument("--max-connections", dest='max_connections', type=int, default=8,
+                        help="Maximum number of concurrent HTTP connections per HSDS endpoint (per worker process)")
+    parser.add_argument("--parallelism", dest='parallelism', type=int, default=3,
+                        help="Number of instrument gridders (MODIS, MISR, CERES) running at once for an orbit")
+    parser.add_argument("--cache-dir", dest='cache_dir', required=False,
+                        help="Local folder caching the BF reads (reprocessing an orbit reads the local disk)")
+    parser.add_argument("--cache-size", dest='cache_size', type=float, default=20,
+                        help="Maximum size of the read cache in GB (least recently used reads are evicted)")
+    return parser
+
+
+def setup(argv=None):
+    """
+    Parse the command line options and create the clients of the main process.
+    """
+    global args, s3_client, read_cache
+    args = get_parser().parse_args(argv)
+    s3_client = get_s3_client(args.s3_endpoint)
+    read_cache = get_read_cache()
+    return args
+
+
+def get_read_cache():
+    """
+    Cache of the BF reads (None without --cache-dir).
+    """
+    if not args.cache_dir:
+        return None
+    return ReadCache(args.cache_dir, MAX_BYTES=int(args.cache_size * 1024**3))
+
+
+def open_cached(f):
+    """
+    Read the BF file through the read cache (if any).
+    """
+    return CachedFile(f, read_cache) if read_cache is not None else f
+
+
+def get_job_params():
+    """
+    Processing parameters of the orbit products (hashed to identify a finished job).
+    """
+    return dict(QC_CONFIG, resolutions=args.resolutions, output_format=args.output_format, complevel=args.complevel)
+
+
+def get_output_keys(bf_name, iyr, imon):
+    """
+    S3 keys of the orbit products of a BF file (one per resolution for a pyramid).
+    """
+    key_prefix = 'climarble/{}.{}/'.format(iyr, str(imon).zfill(2))
+    if len(args.resolutions) > 1:
+        return [key_prefix + bf_name_to_nc_name(bf_name, ires) for ires in args.resolutions]
+    return [key_prefix + bf_name_to_nc_name(bf_name)]
+
+
+def get_composite_folders():
+    """
+    Composite folders of the orbit products (one sub-folder per resolution for a pyramid, None without --composite).
+    """
+    if len(args.resolutions) > 1:
+        return [os.path.join(args.composite_folder, '{:g}deg'.format(ires)) if args.composite_folder else None
+                for ires in args.resolutions]
+    return [args.composite_folder]
+
+
+def is_job_done(bf_name, bucket_name, iyr, imon):
+    """
+    Pre-flight check (before opening the BF file): True if the orbit products already exist
+    with the same processing parameters (see Climate_Marble_manifest)
+    and, with --composite, the orbit is in the ledger of its composites.
+    """
+    if args.force:
+        return False
+    if args.composite_folder:
+        nc_names = [key.split('/')[-1] for key in get_output_keys(bf_name, iyr, imon)]
+        for nc_name, composite_folder in zip(nc_names, get_composite_folders()):
+            if not CompositeStore(composite_folder).has_orbit(nc_name):
+                return False
+    manifest = OrbitManifest(args.manifest, s3_client) if args.manifest else None
+    return is_orbit_done(s3_client, bucket_name, get_output_keys(bf_name, iyr, imon), bf_name, get_job_params(), manifest,
+                         TRUST_MANIFEST=args.trust_manifest)
+
+
+def grid_and_upload(f, bucket_name, iyr, imon):
+    """
+    Grid an orbit (MODIS, MISR and CERES) and upload the gridded file to S3.
+
+    With several --resolutions, the orbit is gridded once and one file per resolution (pyramid) is uploaded.
+    With --stream, the gridded file is serialized in memory and streamed to S3 with a multipart upload,
+    otherwise it is written to the local disk, uploaded and then removed.
+    With --composite, the orbit is first merged into the running daily/monthly composites
+    (in a sub-folder per resolution for a pyramid), so that an uploaded orbit is always in its composites
+    (a job interrupted after the merge is gridded again, and the composites skip the orbits of their ledger).
+    The uploaded files carry the hash of the processing parameters (S3 metadata), 
+    and the job is recorded in the --manifest.
+    """
+    key_prefix = 'climarble/{}.{}/'.format(iyr, str(imon).zfill(2))
+    params = get_job_params()
+    params_hash = get_params_hash(params)
+    metadata = {PARAMS_METADATA: params_hash}
+
+    # a single resolution keeps the original file name
+    PYRAMID = len(args.resolutions) > 1
+    if PYRAMID:
+        SPATIAL_RESOLUTION = args.resolutions
+        nc_names = [get_output_nc_name(f, ires) for ires in args.resolutions]
+    else:
+        SPATIAL_RESOLUTION = args.resolutions[0]
+        nc_names = [get_output_nc_name(f)]
+    composite_folders = get_composite_folders()
+
+    outputs = main_bf_orbit(f, None if args.stream else '', SPATIAL_RESOLUTION=SPATIAL_RESOLUTION, \
+                            OUTPUT_FORMAT=args.output_format, COMPLEVEL=args.complevel, PARALLELISM=args.parallelism, **QC_CONFIG)
+    if not PYRAMID:
+        outputs = [outputs]
+    if any(output is None for output in outputs):
+        raise IOError("no gridded result for {}".format(get_output_nc_name(f)))
+
+    for nc_name, output, composite_folder in zip(nc_names, outputs, composite_folders):
+        print(nc_name)
+        if args.stream:
+            if composite_folder:
+                print(CompositeStore(composite_folder).add_orbit(nc_name, open_netcdf_memory(output, nc_name)))
+            upload_bytes(s3_client, output, bucket_name, key_prefix + nc_name,
+                         PART_SIZE_MB=args.part_size, MAX_CONCURRENCY=args.upload_concurrency, METADATA=metadata)
+        else:
+            try:
+                if composite_folder:
+                    print(CompositeStore(composite_folder).add_orbit_file(output))
+                s3_client.upload_file(output, bucket_name, key_prefix + nc_name, ExtraArgs={'Metadata': metadata})
+            finally:
+                os.remove(output)
+
+    if args.manifest:
+        bf_name = get_bf_name(f)
+        keys = [key_prefix + nc_name for nc_name in nc_names]
+        uploaded = head_outputs(s3_client, bucket_name, keys, params_hash)
+        if uploaded is not None:
+            OrbitManifest(args.manifest, s3_client).put(bf_name, params_hash, params, uploaded)
+    return nc_names
 
 
 def process_single_file():
@@ -43,23 +231,22 @@ def process_single_file():
     iyr = 2005
     imon = 5
     try:
-        f = None
-        if args.hsds_endpoint:
-            f = h5py.File(args.bf_name, "r",
-                          username=args.user, password=args.password,
-                          endpoint=args.hsds_endpoint)
-        else:
-            f = h5py.File(args.bf_name, "r")
+        if is_job_done(args.bf_name, bucket_name, iyr, imon):
+            return
 
-        print(f.fid)
+        # the file is opened as in the queue workers (capped HTTP connections)
+        with FilePool(h5py, MAX_CONNECTIONS=args.max_connections) as file_pool:
+            if args.hsds_endpoint:
+                h5f_context = file_pool.open(args.bf_name, endpoint=args.hsds_endpoint, username=args.user, password=args.password)
+            else:
+                h5f_context = file_pool.open(args.bf_name)
 
-        nc_name = main_bf_MODIS(f, '', SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CATEGORY='VIS')
-        nc_name = main_bf_MISR(f, '', SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CAMERA='AN')
-        nc_name = main_bf_CERES(f, '', SPATIAL_RESOLUTION=0.5, VZA_MAX=18, MODE='ct')
-        print(nc_name)
-        s3_client.upload_file(nc_name, bucket_name, 'climarble/{}.{}/'.
-                              format(iyr, str(imon).zfill(2)) + nc_name)
-        os.remove(nc_name)
+            with h5f_context as f:
+                print(get_bf_name(f))
+
+                grid_and_upload(open_cached(f), bucket_name, iyr, imon)
+        if read_cache is not None:
+            print(">> ReadCache( {} )".format(read_cache))
 
     except Exception as ex:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -70,75 +257,215 @@ def process_single_file():
         print(string_out.getvalue())
 
 
+def get_sqs_resource(endpoint_url=None):
+    """
+    SQS service resource (AWS, or a local SQS stand-in given its endpoint).
+    """
+    return boto3.resource('sqs', region_name='us-west-2', endpoint_url=endpoint_url)
+
+
+def init_worker(worker_args):
+    """
+    Initialize a worker process of process_from_queue (boto3 clients are not shared between processes).
+    The HTTP sessions of the worker are pooled across its jobs and closed when the worker exits.
+    """
+    import h5pyd
+
+    global args, s3_client, file_pool, read_cache
+    args = worker_args
+    s3_client = get_s3_client(args.s3_endpoint)
+    read_cache = get_read_cache()
+    file_pool = FilePool(h5pyd, MAX_CONNECTIONS=args.max_connections)
+    Finalize(file_pool, file_pool.close, exitpriority=10)
+
+
+def process_job(job_record):
+    """
+    Grid and upload the orbit of a queue message (run in a worker process).
+
+    Returns:
+        nc_names (list)  : names of the uploaded files (None if the job failed)
+        error (str)      : error message (None if the job succeeded)
+        traceback (str)  : traceback of the error (None if the job succeeded)
+    """
+    # Run script
+    print("Running Climarble script...")
+    bucket_name = "climatemarble"
+    iyr = job_record['year']
+    imon = job_record['month']
+    bf_name = job_record['terra-file']
+    try:
+        # skip a re-queued or duplicated job whose orbit is already done
+        if is_job_done(bf_name, bucket_name, iyr, imon):
+            return [key.split('/')[-1] for key in get_output_keys(bf_name, iyr, imon)], None, None
+
+        with file_pool.open(bf_name, endpoint=job_record['hsds-endpoint'], username=args.user, password=args.password) as f:
+            print(get_bf_name(f))
+
+            nc_names = grid_and_upload(open_cached(f), bucket_name, iyr, imon)
+        print(">> FilePool( {} )".format(file_pool))
+        if read_cache is not None:
+            print(">> ReadCache( {} )".format(read_cache))
+        return nc_names, None, None
+
+    except Exception as ex:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        string_out = io.StringIO()
+        traceback.print_tb(exc_traceback, limit=20, file=string_out)
+
+        print(str(ex))
+        print(string_out.getvalue())
+        return None, str(ex), string_out.getvalue()
+
+
+def send_dead_letter(dead_letter_queue, message, job_record, error, traceback_str):
+    """
+    Send a failed job to the dead letter queue.
+    """
+    dead_letter_record = {
+        "error": error,
+        "traceback": traceback_str,
+        "job_record": job_record.copy()
+    }
+    fifo_params = {}
+    if dead_letter_queue.url.endswith('.fifo'):
+        fifo_params = {'MessageGroupId': 'hsds', 'MessageDeduplicationId': message.message_id}
+    dead_letter_queue.send_message(MessageBody=json.dumps(dead_letter_record), **fifo_params)
+
+
+def release_message(message):
+    """
+    Make a message visible again, so that its job is delivered again (e.g., after its worker process died).
+    """
+    try:
+        message.change_visibility(VisibilityTimeout=0)
+    except Exception as ex:
+        # the message becomes visible again after its visibility timeout anyway
+        print(">> SQSError( cannot release {}: {} )".format(message.message_id, ex))
+
+
 def process_from_queue():
-    import h5pyd as h5py
+    """
+    Grid the orbits of the work queue with a pool of worker processes.
 
+    Messages are received in batches (up to 10) with long polling whenever a worker is free.
+    The visibility of the messages being processed is extended every third of the visibility timeout,
+    so that a long orbit is not delivered to another worker, and a message is deleted only when its job
+    is done (uploaded, or sent to the dead letter queue when process_job reports an error).
+    If a worker process dies, the pool is broken and all its jobs are lost: their messages are made visible
+    again (not deleted) and the pool is rebuilt (a message that keeps killing its worker is moved to the
+    dead letter queue by the redrive policy of the queue).
+    The worker exits after --idle-polls consecutive empty polls with no job running.
+    """
     print("Ready to index files from "+args.sqs_queue)
+    sqs = get_sqs_resource(args.sqs_endpoint)
     queue = sqs.get_queue_by_name(QueueName=args.sqs_queue)
-    dead_letter_queue = sqs.get_queue_by_name(QueueName='climate_marble_dead_letter.fifo')
+    dead_letter_queue = sqs.get_queue_by_name(QueueName=args.dead_letter_queue)
+
+    NUM_WORKERS = max(1, args.workers)
+    HEARTBEAT_SECONDS = max(1, args.visibility_timeout // 3)
 
-    done = False
-    while not done:
-        messages = queue.receive_messages(WaitTimeSeconds=1)
-        if not messages:
-            break
+    def new_executor():
+        return ProcessPoolExecutor(max_workers=NUM_WORKERS, initializer=init_worker, initargs=(args,))
 
-        for message in messages:
-            message_id = message.message_id
-            job_record = json.loads(message.body)
-            print(job_record)
-            message.delete()
+    # future -> (message, job_record)
+    running = {}
+    idle_polls = 0
+    last_heartbeat = time.time()
+    executor = new_executor()
+    try:
+        while True:
+            broken = False
 
-            iyr = job_record['year']
-            imon = job_record['month']
-            bf_name = job_record['terra-file']
+            # RECEIVE a batch of messages when workers are free
+            # (short wait when jobs are running, so that their visibility keeps being extended)
+            free = NUM_WORKERS - len(running)
+            if free > 0:
+                wait_seconds = SQS_WAIT_SECONDS if not running else min(SQS_WAIT_SECONDS, HEARTBEAT_SECONDS)
+                messages = queue.receive_messages(MaxNumberOfMessages=min(free, SQS_MAX_MESSAGES),
+                                                  WaitTimeSeconds=wait_seconds,
+                                                  VisibilityTimeout=args.visibility_timeout)
+                if messages:
+                    idle_polls = 0
+                elif not running:
+                    idle_polls += 1
+                    if idle_polls >= args.idle_polls:
+                        break
 
-            bucket_name = "climatemarble"
+                for message in messages:
+                    try:
+                        job_record = json.loads(message.body)
+                    except ValueError as ex:
+                        print(">> ValueError( cannot parse message {}: {} )".format(message.message_id, ex))
+                        send_dead_letter(dead_letter_queue, message, {'body': message.body}, str(ex), '')
+                        message.delete()
+                        continue
+                    if broken:
+                        release_message(message)
+                        continue
+                    print(job_record)
+                    try:
+                        running[executor.submit(process_job, job_record)] = (message, job_record)
+                    except BrokenProcessPool as ex:
+                        print(">> WorkerError( process pool is broken, {} is released: {} )".format(message.message_id, ex))
+                        release_message(message)
+                        broken = True
+            else:
+                wait(list(running), timeout=HEARTBEAT_SECONDS, return_when=FIRST_COMPLETED)
 
-            # Run script
-            print("Running Climarble script...")
-            try:
-                f = h5py.File(bf_name, "r",
-                              username=args.user, password=args.password, endpoint=job_record['hsds-endpoint'])
-
-                print(f.fid)
-
-                nc_name = main_bf_MODIS(f, '', SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CATEGORY='VIS')
-                nc_name = main_bf_MISR(f, '', SPATIAL_RESOLUTION=0.5, VZA_MAX=18, CAMERA='AN')
-                nc_name = main_bf_CERES(f, '', SPATIAL_RESOLUTION=0.5, VZA_MAX=18, MODE='ct')
-                print(nc_name)
-                s3_client.upload_file(nc_name, bucket_name, 'climarble/{}.{}/'.
-                                      format(iyr,str(imon).zfill(2)) + nc_name)
-                os.remove(nc_name)
-
-            except Exception as ex:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                string_out = io.StringIO()
-                traceback.print_tb(exc_traceback, limit=20, file=string_out)
-
-                print(str(ex))
-                print(string_out.getvalue())
-
-                dead_letter_record = {
-                    "error": str(ex),
-                    "traceback": string_out.getvalue(),
-                    "job_record": job_record.copy()
-                }
-                response = dead_letter_queue.send_message(
-                    MessageBody=json.dumps(dead_letter_record),
-                    MessageGroupId='hsds',
-                    MessageDeduplicationId=message_id
-                )
-    # else:
-    #     # Move nc file to my s3
-    #     s3_client = boto3.client('s3')
-    #     s3_client.upload_file(nc_name, bucket_name, 'climarble/{}.{}/'.format(iyr, str(imon).zfill(2))+nc_name)
-    #     os.remove(nc_name)
-
-
-args = parser.parse_args()
-
-if args.sqs_queue:
-    process_from_queue()
-else:
-    process_single_file()
+            # DELETE the messages of the finished jobs
+            for future in [ifuture for ifuture in running if ifuture.done()]:
+                message, job_record = running.pop(future)
+                try:
+                    nc_names, error, traceback_str = future.result()
+                except BrokenProcessPool as ex:
+                    # a worker process died (e.g., killed for its memory): the job did not fail by itself
+                    print(">> WorkerError( process pool is broken, {} is released: {} )".format(message.message_id, ex))
+                    release_message(message)
+                    broken = True
+                    continue
+                except Exception as ex:
+                    # the job raised outside of process_job (e.g., its result cannot be pickled)
+                    nc_names, error, traceback_str = None, str(ex), ''
+
+                if error is not None:
+                    try:
+                        send_dead_letter(dead_letter_queue, message, job_record, error, traceback_str)
+                    except Exception as ex:
+                        # the message is not deleted, so the job is delivered again after its visibility timeout
+                        print(">> SQSError( cannot send {} to the dead letter queue: {} )".format(message.message_id, ex))
+                        continue
+                message.delete()
+
+            # REBUILD a broken pool, the jobs still running in it are lost as well
+            if broken:
+                for message, job_record in running.values():
+                    print(">> WorkerError( process pool is broken, {} is released )".format(message.message_id))
+                    release_message(message)
+                running = {}
+                executor.shutdown(wait=True)
+                executor = new_executor()
+                continue
+
+            # EXTEND the visibility of the messages being processed
+            if running and time.time() - last_heartbeat >= HEARTBEAT_SECONDS:
+                for message, job_record in running.values():
+                    try:
+                        message.change_visibility(VisibilityTimeout=args.visibility_timeout)
+                    except Exception as ex:
+                        print(">> SQSError( cannot extend the visibility of {}: {} )".format(message.message_id, ex))
+                last_heartbeat = time.time()
+    finally:
+        executor.shutdown(wait=True)
+
+
+def main(argv=None):
+    setup(argv)
+    if args.sqs_queue:
+        process_from_queue()
+    else:
+        process_single_file()
+
+
+if __name__ == "__main__":
+    main()